@@ -31,6 +31,15 @@ def main(argv=None):
                         help="overwrite existing html")
     parser.add_argument("--wipe",action="store_true",
                         help="delete output directory and render all files from scratch")
+    parser.add_argument("-j","--jobs",type=int,default=1,
+                        help="number of renders to run in parallel")
+
+    # Watching keeps every slide in memory between builds, so cannot stream
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--watch",action="store_true",
+                      help="keep running, rebuilding whenever an input changes")
+    mode.add_argument("--stream",action="store_true",
+                      help="process and write one slide at a time to limit memory use")
 
 
     args = parser.parse_args(argv)
@@ -40,10 +49,16 @@ def main(argv=None):
                                   target_dir=args.target_dir,
                                   json_file=args.config,
                                   force=args.force,
-                                  wipe=args.wipe)
+                                  wipe=args.wipe,
+                                  jobs=args.jobs,
+                                  stream=args.stream)
 
-    s.process(output_file=args.out,
-              reveal_html_file=args.template)
+    if args.watch:
+        s.watch(output_file=args.out,
+                reveal_html_file=args.template)
+    else:
+        s.process(output_file=args.out,
+                  reveal_html_file=args.template)
 
 
 if __name__ == "__main__":
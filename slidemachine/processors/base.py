@@ -5,7 +5,19 @@ Define base processor class.
 __author__ = "Michael J. Harms"
 __date__ = "2018-05-10"
 
-import os, hashlib, shutil, re, json, copy
+from .hashes import get_file_hash, get_data_hash
+
+import os, shutil, re, copy
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request that asks the filesystem for a copy-on-write clone (Linux)
+_FICLONE = 0x40049409
+
+COPY_MODES = ("copy","hardlink","reflink","symlink")
 
 def _split_string(s, delim, escape='\\'):
     """
@@ -34,21 +46,128 @@ def _split_string(s, delim, escape='\\'):
     ret.append(''.join(current))
     return ret
 
+def _reflink(input_file,output_file):
+    """
+    Make output_file a copy-on-write clone of input_file.  Raises OSError if
+    the filesystem (or platform) cannot do this.
+    """
+
+    if fcntl is None:
+        err = "reflinks are not supported on this platform\n"
+        raise OSError(err)
+
+    with open(input_file,"rb") as src:
+        try:
+            with open(output_file,"wb") as dst:
+                fcntl.ioctl(dst.fileno(),_FICLONE,src.fileno())
+        except OSError:
+            os.remove(output_file)
+            raise
+
+    shutil.copymode(input_file,output_file)
+
+def copy_with_mode(input_file,output_file,copy_mode="copy"):
+    """
+    Put input_file at output_file.
+
+    copy_mode: "copy" copies the file.  "hardlink" links it (same filesystem
+               only).  "reflink" makes a copy-on-write clone (filesystems
+               such as btrfs and xfs).  "symlink" points to the real path
+               of input_file.  If the requested mode is not possible, the
+               file is copied.
+    """
+
+    try:
+        if copy_mode == "hardlink":
+            os.link(input_file,output_file)
+            return
+        if copy_mode == "reflink":
+            _reflink(input_file,output_file)
+            return
+        if copy_mode == "symlink":
+            os.symlink(os.path.realpath(input_file),output_file)
+            return
+    except OSError:
+        pass
+
+    shutil.copy(input_file,output_file)
+
+def _get_literal_prefix(pattern):
+    """
+    Return the literal text that any match of the regular expression pattern
+    must start with (i.e. "![sm" for "!\\[sm.inkscape\\]").  Returns an empty
+    string if the pattern does not start with literal text.
+    """
+
+    special = ".^$*+?{}[]|()"
+
+    prefix = []
+    i = 0
+    while i < len(pattern):
+
+        c = pattern[i]
+
+        # Escaped character.  Only punctuation escapes are literal (\w, \d,
+        # etc. are character classes).
+        if c == "\\":
+            if i + 1 >= len(pattern) or pattern[i+1].isalnum():
+                break
+            c = pattern[i+1]
+            i += 2
+        elif c in special:
+            break
+        else:
+            i += 1
+
+        # If this character can be repeated zero times, it is not required
+        if i < len(pattern) and pattern[i] in "*?{":
+            break
+
+        prefix.append(c)
+
+        if i < len(pattern) and pattern[i] in "+|":
+            break
+
+    # An alternation anywhere means the prefix is not required
+    if "|" in pattern:
+        return ""
+
+    return "".join(prefix)
+
 class Processor:
     """
     Base class for all processor subclasses in slidemachine.
     """
 
     def __init__(self,target_dir,pattern="!\[sm.dummy\]",
-                 prev_build_json="prev-build.json"):
+                 prev_build_json="prev-build.json",copy_mode="copy",
+                 hash_names=False):
         """
         target_dir: place to store output files
         pattern: markdown pattern that should invoke this processor
+        prev_build_json: previous build json written by older versions; read
+                         if the build manifest has nothing for this processor
+        copy_mode: how files are put into target_dir: "copy", "hardlink",
+                   "reflink" or "symlink".  Falls back to copying if the mode
+                   is not possible for a file.
+        hash_names: name output files by their content (i.e.
+                    figure.3f9a1c0b2d4e.png) rather than by the input file
+                    name.  Files already in target_dir are not copied again
+                    and names never change while the content is the same, so
+                    the output directory can be cached by browsers.
         """
 
+        if copy_mode not in COPY_MODES:
+            err = "copy_mode {} not recognized. Should be one of:\n".format(copy_mode)
+            err += "".join(["    {}\n".format(m) for m in COPY_MODES])
+            raise ValueError(err)
+
         self._target_dir = target_dir
         self._pattern = re.compile(pattern)
+        self._pattern_prefix = _get_literal_prefix(pattern)
         self._prev_build_json = prev_build_json
+        self._copy_mode = copy_mode
+        self._hash_names = hash_names
 
         # Dictionary of every file seen during processing. key is the
         # md5 hash of the file; value is the filename.  This is used to
@@ -57,8 +176,8 @@ class Processor:
         self._file_seen_dict = {}
 
         # Dictionary holding every file processed that will be written out
-        # as "target_dir/prev-build.json".  Keys will be md5 hashes of input
-        # files; values will depend on subclass.
+        # to the build manifest.  Keys depend on subclass (i.e. hashes of
+        # inkscape layer configurations); values are output files.
         self._this_proc_dict = {}
 
         # List of output files associated with this processor
@@ -67,18 +186,31 @@ class Processor:
         self._name = self.__class__.__name__
         self._prev_build_dict = {}
 
+        # Files written by the previous build.  Keys are file hashes; values
+        # are output files.
+        self._prev_file_dict = {}
+
+        # Records (i.e. what is in an input file) kept in the build manifest
+        # for this build and the previous one.  Keys depend on subclass.
+        self._this_record_dict = {}
+        self._prev_record_dict = {}
+
+        # RenderCache holding output files that earlier builds no longer
+        # needed, keyed by build key.  None if not used.
+        self._stale_store = None
+
+        # Record of the input and output files used by the slide currently
+        # being processed.  None when not processing a slide.
+        self._slide_record = None
+
     def _get_file_md5(self,input_file):
         """
-        Determine the md5 hash of the input file
+        Determine the hash of the input file.  This is md5 unless another
+        algorithm was selected with hashes.set_hash_algorithm.  Files that
+        have not changed since they were last hashed are not read again.
         """
 
-        hash_md5 = hashlib.md5()
-        with open(input_file, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        file_hash = hash_md5.hexdigest()
-
-        return file_hash
+        return get_file_hash(input_file)
 
     def _copy_file(self,input_file):
         """
@@ -92,31 +224,213 @@ class Processor:
 
         file_hash = self._get_file_md5(input_file)
 
+        def write(new_file):
+            copy_with_mode(input_file,new_file,self._copy_mode)
+
+        return self._place_file(input_file,file_hash,write)
+
+    def _write_data(self,data,file_name):
+        """
+        Write bytes held in memory (i.e. a render read from inkscape's
+        stdout) into target_dir, named after file_name.  Works like
+        _copy_file: the data are hashed in memory and only written if no
+        file with the same content is already there.  Returns the path of the
+        file in target_dir.
+        """
+
+        file_hash = get_data_hash(data)
+
+        def write(new_file):
+            f = open(new_file,"wb")
+            f.write(data)
+            f.close()
+
+        return self._place_file(file_name,file_hash,write)
+
+    def _place_file(self,input_file,file_hash,write):
+        """
+        Find where a file with content file_hash named after input_file goes
+        in target_dir, calling write with that path if the file has to be
+        written.  Returns the path.
+        """
+
         # see if this file has been seen before
         try:
             new_file = self._file_seen_dict[file_hash]
+            self._record_output(new_file,file_hash=file_hash)
 
         # if not, process it
         except KeyError:
 
+            # Reuse the copy made by the previous build if it is unchanged
+            prev_file = self._prev_file_dict.get(file_hash,None)
+            if prev_file is not None and os.path.isfile(prev_file):
+                if self._get_file_md5(prev_file) == file_hash:
+                    self._record_output(prev_file,file_hash=file_hash)
+                    return prev_file
+
+            if self._hash_names:
+                new_file = self._get_hashed_name(input_file,file_hash)
+
+                # Same name means same content, so only write if missing.
+                # Write under a temporary name so a build that stops part way
+                # never leaves a partial file under the hashed name.
+                if not os.path.isfile(new_file):
+                    tmp_file = "{}.{}.tmp".format(new_file,os.getpid())
+                    if os.path.lexists(tmp_file):
+                        os.remove(tmp_file)
+                    write(tmp_file)
+                    os.replace(tmp_file,new_file)
+
+                self._record_output(new_file,file_hash=file_hash)
+
+                return new_file
+
             file_root = os.path.split(input_file)[1]
             new_file = os.path.join(self._target_dir,file_root)
 
-            # name conflict, add counter until no conflict
+            # name conflict, add counter until no conflict.  (lexists so
+            # dangling symlinks count as conflicts)
             counter = 0
-            while os.path.isfile(new_file):
+            while os.path.lexists(new_file):
                 new_root = "{:05d}_{:s}".format(counter,file_root)
                 new_file = os.path.join(self._target_dir,new_root)
                 counter += 1
 
-            self._file_seen_dict[file_hash] = new_file
+            write(new_file)
 
-            shutil.copy(input_file,new_file)
-
-            self._output_files.append(new_file)
+            self._record_output(new_file,file_hash=file_hash)
 
         return new_file
 
+    def _get_hashed_name(self,input_file,file_hash):
+        """
+        Name for input_file in target_dir that includes the start of its hash
+        (i.e. figure.png -> target_dir/figure.3f9a1c0b2d4e.png).
+        """
+
+        file_root, ext = os.path.splitext(os.path.split(input_file)[1])
+
+        # Do not add the hash twice to a file that already has a hashed name
+        tag = ".{}".format(file_hash[:12])
+        if file_root.endswith(tag):
+            file_root = file_root[:-len(tag)]
+
+        new_root = "{}{}{}".format(file_root,tag,ext)
+
+        return os.path.join(self._target_dir,new_root)
+
+    def _record_output(self,output_file,file_hash=None,build_key=None):
+        """
+        Record that the line being processed uses output_file.
+
+        file_hash: hash of the file, so later copies of the same file are
+                   deduplicated against it
+        build_key: key under which output_file is written to the build
+                   manifest
+        """
+
+        self._output_files.append(output_file)
+
+        if file_hash is not None:
+            self._file_seen_dict[file_hash] = output_file
+
+        if build_key is not None:
+            self._this_proc_dict[build_key] = output_file
+
+        if self._slide_record is not None:
+            self._slide_record["outputs"].append([output_file,file_hash,
+                                                  build_key])
+
+    def _get_stale_key(self,build_key):
+        return self._stale_store.get_key(self._name,build_key)
+
+    def _get_stale(self,build_key,output_file):
+        """
+        Write the stale output file stored for build_key to output_file.
+        Returns True if there was one, False otherwise.
+        """
+
+        if self._stale_store is None:
+            return False
+
+        return self._stale_store.get(self._get_stale_key(build_key),output_file)
+
+    def _get_stale_data(self,build_key,extension):
+        """
+        Return the stale output file stored for build_key, a file with
+        extension, as bytes.  Returns None if there is not one.
+        """
+
+        if self._stale_store is None:
+            return None
+
+        return self._stale_store.get_data(self._get_stale_key(build_key),
+                                          extension)
+
+    def retire(self,build_key,output_file):
+        """
+        Move an output file from a previous build that this build did not use
+        into the stale store, so a later build can bring it back.  Deletes the
+        file if there is no stale store.
+        """
+
+        if self._stale_store is None:
+            os.remove(output_file)
+            return
+
+        self._stale_store.put(self._get_stale_key(build_key),output_file,
+                              move=True)
+
+    def _record_input(self,input_file):
+        """
+        Record that the line being processed reads input_file.
+        """
+
+        if self._slide_record is not None:
+            self._slide_record["inputs"].append(input_file)
+
+    def start_slide(self):
+        """
+        Start recording the files used by a slide.
+        """
+
+        self._slide_record = {"inputs":[],"outputs":[]}
+
+    def end_slide(self):
+        """
+        Stop recording the files used by a slide, returning the record.
+        """
+
+        record = self._slide_record
+        self._slide_record = None
+
+        return record
+
+    def restore_slide(self,record):
+        """
+        Register the output files from the record of a slide that was
+        processed earlier, as if the slide had just been processed again.
+        """
+
+        for output_file, file_hash, build_key in record["outputs"]:
+            self._record_output(output_file,file_hash,build_key)
+
+    def start_rebuild(self):
+        """
+        Start a new build in the same session.  What was built last time
+        becomes the previous build.
+        """
+
+        self._prev_build_dict = self._this_proc_dict
+        self._prev_file_dict = self._file_seen_dict
+        self._prev_record_dict = self._this_record_dict
+
+        self._file_seen_dict = {}
+        self._this_proc_dict = {}
+        self._this_record_dict = {}
+        self._output_files = []
+
     def _parse_markdown_line(self,line,delim=","):
         """
         Parse a slidemachine markdown line, returning the input file and the
@@ -143,35 +457,72 @@ class Processor:
 
         return input_file, args
 
-    def add_previous_build_information(self,prev_build_dict):
+    def add_previous_build_information(self,prev_build_dict,prev_file_dict=None,
+                                       prev_record_dict=None):
         """
-        Load a dictionary of previous build information.
+        Load previous build information.
+
+        prev_build_dict: output files keyed by build key
+        prev_file_dict: output files keyed by file hash
+        prev_record_dict: records kept by the previous build
         """
 
         self._prev_build_dict = copy.deepcopy(prev_build_dict)
 
-    def write_build_json(self):
+        if prev_file_dict is not None:
+            self._prev_file_dict = copy.deepcopy(prev_file_dict)
+
+        if prev_record_dict is not None:
+            self._prev_record_dict = copy.deepcopy(prev_record_dict)
+
+    def _get_record(self,key):
         """
-        Write build information from this run to previous build json.
+        Return the record stored under key by this build or the previous
+        one, or None.  A record from the previous build is kept for the next.
         """
 
-        # Json output file
-        json_file = os.path.join(self._target_dir,self._prev_build_json)
-
-        # Get current json content
         try:
-            current_json_contents = json.load(open(json_file,'r'))
-        except FileNotFoundError:
-            current_json_contents = {}
+            return self._this_record_dict[key]
+        except KeyError:
+            pass
+
+        record = self._prev_record_dict.get(key,None)
+        if record is not None:
+            self._this_record_dict[key] = record
+
+        return record
+
+    def _set_record(self,key,record):
+        """
+        Keep a json-serializable record under key in the build manifest.
+        """
 
-        # Add this processor to the content
-        current_json_contents[self.name] = copy.deepcopy(self._this_proc_dict)
+        self._this_record_dict[key] = record
 
-        # Write out
-        f = open(json_file,'w')
-        json.dump(current_json_contents,f)
-        f.close()
+    def set_display_size(self,width,height):
+        """
+        Set the size (in pixels) of the slides the output is shown on.
+        Dummy method.  Overwritten in subclasses that size their output.
+        """
 
+        pass
+
+    def prefetch(self,lines,executor,jobs):
+        """
+        Start slow work for lines on executor (a concurrent.futures executor
+        with jobs workers) before the lines are processed one at a time.
+        Dummy method.  Overwritten in subclasses that have slow work that
+        can be done in parallel.
+        """
+
+        pass
+
+    def cleanup(self):
+        """
+        Clean up after processing.  Dummy method.  Overwritten in subclasses.
+        """
+
+        pass
 
     def process(self,line):
         """
@@ -192,10 +543,69 @@ class Processor:
     def name(self):
         return self._name
 
+    @property
+    def trigger(self):
+        """
+        Literal text that a line must contain for this processor to change
+        it, or None if the processor has to see every line.  Used to skip
+        lines cheaply.  By default this is the literal start of the pattern;
+        subclasses that do not act only on lines matching their pattern must
+        override it.
+        """
+
+        if self._pattern_prefix == "":
+            return None
+
+        return self._pattern_prefix
+
     @property
     def output_files(self):
         return self._output_files
 
+    @property
+    def stale_store(self):
+        return self._stale_store
+
+    @stale_store.setter
+    def stale_store(self,stale_store):
+        self._stale_store = stale_store
+
+    @property
+    def prev_build_info(self):
+        """
+        Output files from the previous build keyed by build key.
+        """
+
+        return self._prev_build_dict
+
+    @property
+    def build_info(self):
+        """
+        Output files from this build keyed by build key.
+        """
+
+        return self._this_proc_dict
+
+    @property
+    def file_info(self):
+        """
+        Output files from this build keyed by file hash.
+        """
+
+        return self._file_seen_dict
+
+    @property
+    def record_info(self):
+        """
+        Records kept by this build.
+        """
+
+        return self._this_record_dict
+
     @property
     def prev_build_json(self):
+        """
+        Previous build json written by older versions of slidemachine.
+        """
+
         return os.path.join(self._target_dir,self._prev_build_json)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+User-level cache shared by every deck built on this machine.  Holds renders
+keyed by their content, so the same figure used in several talks is only
+rendered once.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-16"
+
+import os, json, time, hashlib, shutil, threading
+
+def get_cache_dir():
+    """
+    Return the user-level slidemachine cache directory, creating it if
+    necessary.
+    """
+
+    try:
+        cache_root = os.environ["XDG_CACHE_HOME"]
+    except KeyError:
+        cache_root = os.path.join(os.path.expanduser("~"),".cache")
+
+    cache_dir = os.path.join(cache_root,"slidemachine")
+    os.makedirs(cache_dir,exist_ok=True)
+
+    return cache_dir
+
+def _link_or_copy(input_file,output_file):
+    """
+    Hard link input_file to output_file, copying if a link is not possible.
+    """
+
+    try:
+        os.link(input_file,output_file)
+    except OSError:
+        shutil.copy(input_file,output_file)
+
+class RenderCache:
+    """
+    Content-addressed store of rendered files with a size-bounded (and
+    optionally age-bounded) least-recently-used eviction policy.  Safe to use
+    from multiple threads.
+    """
+
+    def __init__(self,cache_dir=None,max_size=1024,max_age=None):
+        """
+        cache_dir: directory holding the cache.  If None, use "renders" in
+                   the user-level slidemachine cache directory.
+        max_size: maximum size of the cache in MB
+        max_age: files not used for this many days are removed.  If None,
+                 files are only removed to keep the cache under max_size.
+        """
+
+        if cache_dir is None:
+            cache_dir = os.path.join(get_cache_dir(),"renders")
+
+        self._cache_dir = os.path.expanduser(cache_dir)
+        self._max_size = int(max_size*1024*1024)
+
+        self._max_age = None
+        if max_age is not None:
+            self._max_age = max_age*24*3600
+
+        os.makedirs(self._cache_dir,exist_ok=True)
+
+        # Total size of the cache.  Only measured when first needed.
+        self._size = None
+        self._lock = threading.Lock()
+
+    def get_key(self,*args):
+        """
+        Build a cache key from json-serializable arguments that, together,
+        determine the content of a render.
+        """
+
+        key = json.dumps(args,sort_keys=True)
+
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _get_path(self,key,extension):
+        return os.path.join(self._cache_dir,key[:2],
+                            "{}.{}".format(key,extension))
+
+    def get(self,key,output_file):
+        """
+        Write the cached render for key to output_file. Returns True if the
+        render was in the cache, False if it was not.
+        """
+
+        extension = os.path.splitext(output_file)[1][1:]
+        cache_file = self._get_path(key,extension)
+
+        with self._lock:
+
+            try:
+                _link_or_copy(cache_file,output_file)
+            except FileNotFoundError:
+                return False
+
+            # Record that this render was just used
+            os.utime(cache_file)
+
+        return True
+
+    def get_data(self,key,extension):
+        """
+        Return the cached render for key, a file with extension (i.e. "png"),
+        as bytes.  Returns None if the render is not in the cache.
+        """
+
+        cache_file = self._get_path(key,extension)
+
+        with self._lock:
+
+            try:
+                f = open(cache_file,"rb")
+            except FileNotFoundError:
+                return None
+
+            data = f.read()
+            f.close()
+
+            # Record that this render was just used
+            os.utime(cache_file)
+
+        return data
+
+    def put_data(self,key,data,extension):
+        """
+        Store bytes in the cache under key as a file with extension.
+        """
+
+        def write(tmp_file):
+            f = open(tmp_file,"wb")
+            f.write(data)
+            f.close()
+
+        self._store(self._get_path(key,extension),write)
+
+    def put(self,key,input_file,move=False):
+        """
+        Store input_file in the cache under key.
+
+        move: move input_file into the cache rather than copying it
+        """
+
+        extension = os.path.splitext(input_file)[1][1:]
+
+        def write(tmp_file):
+            if move:
+                shutil.move(input_file,tmp_file)
+            else:
+                shutil.copy(input_file,tmp_file)
+
+        stored = self._store(self._get_path(key,extension),write)
+        if move and not stored:
+            os.remove(input_file)
+
+    def _store(self,cache_file,write):
+        """
+        Put a file in the cache at cache_file by calling write with a
+        temporary file name.  Returns False (and does not call write) if the
+        file was already cached.
+        """
+
+        with self._lock:
+
+            if os.path.isfile(cache_file):
+                os.utime(cache_file)
+                return False
+
+            os.makedirs(os.path.split(cache_file)[0],exist_ok=True)
+
+            # Write under a temporary name so other builds never see a
+            # partial file
+            tmp_file = "{}.{}.tmp".format(cache_file,os.getpid())
+            write(tmp_file)
+            os.replace(tmp_file,cache_file)
+            os.utime(cache_file)
+
+            # Old files are only looked for the first time something is
+            # stored, as this means looking at every file
+            if self._size is None:
+                self._evict()
+            else:
+                self._size += os.path.getsize(cache_file)
+                if self._size > self._max_size:
+                    self._evict()
+
+        return True
+
+    def _list_files(self):
+        """
+        Return a list of (mtime,size,path) for every file in the cache.
+        """
+
+        out = []
+        for d in os.scandir(self._cache_dir):
+            if not d.is_dir():
+                continue
+            for f in os.scandir(d.path):
+                try:
+                    stat = f.stat()
+                except FileNotFoundError:
+                    continue
+                out.append((stat.st_mtime,stat.st_size,f.path))
+
+        return out
+
+    def _evict(self):
+        """
+        Delete files older than max_age, then least recently used files until
+        the cache fits in max_size.
+        """
+
+        files = self._list_files()
+        files.sort()
+
+        oldest = None
+        if self._max_age is not None:
+            oldest = time.time() - self._max_age
+
+        self._size = sum([f[1] for f in files])
+        for mtime, size, path in files:
+
+            too_old = oldest is not None and mtime < oldest
+            if self._size <= self._max_size and not too_old:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            self._size -= size
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
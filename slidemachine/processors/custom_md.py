@@ -28,3 +28,11 @@ class CustomMDProcessor(Processor):
             line = pattern.sub(replacement,line)
 
         return line
+
+    @property
+    def trigger(self):
+        """
+        Only lines with @ can be changed.
+        """
+
+        return "@"
@@ -5,7 +5,7 @@ __description__ = \
 __author__ = "Michael J. Harms"
 __date__ = "2020-09-07"
 
-import re
+import os, re
 
 from .base import Processor
 
@@ -28,8 +28,22 @@ class FileProcessor(Processor):
             if file.startswith("http"):
                 continue
 
+            # Already in the output directory (i.e. written by another
+            # processor)
+            if os.path.dirname(os.path.abspath(file)) == os.path.abspath(self._target_dir):
+                continue
+
+            self._record_input(file)
             new_file = self._copy_file(file)
 
             re.sub(file,new_file,line)
 
         return line
+
+    @property
+    def trigger(self):
+        """
+        Only lines with src= can point to local files.
+        """
+
+        return "src="
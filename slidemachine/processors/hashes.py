@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Hashing of input and output files.  Hashes are cached by the path, size,
+modification time and inode of the file, so unchanged files are never read
+twice.  The cache is saved with the build information and reused by the
+next build.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+import os, json, time, hashlib, threading
+
+# Size of the buffer used to read files
+_READ_SIZE = 1024*1024
+
+# Files modified this recently (seconds) are not cached, as they could change
+# again without their modification time changing.
+_RACY_WINDOW = 2
+
+AVAILABLE_ALGORITHMS = ("md5","sha1","sha256","blake2b","blake2s")
+
+def _new_hasher(algorithm):
+    """
+    Return a new hash object for algorithm.
+    """
+
+    if algorithm not in AVAILABLE_ALGORITHMS:
+        err = "hash algorithm {} not recognized. Should be one of:\n".format(algorithm)
+        err += "".join(["    {}\n".format(a) for a in AVAILABLE_ALGORITHMS])
+        raise ValueError(err)
+
+    # blake2 digests are trimmed to the length of an md5 digest
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "blake2s":
+        return hashlib.blake2s(digest_size=16)
+
+    return hashlib.new(algorithm)
+
+def hash_file(input_file,algorithm="md5"):
+    """
+    Hash the contents of input_file, reading it in large chunks.
+    """
+
+    h = _new_hasher(algorithm)
+
+    buffer = bytearray(_READ_SIZE)
+    view = memoryview(buffer)
+    with open(input_file,"rb",buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            h.update(view[:size])
+
+    return h.hexdigest()
+
+def hash_data(data,algorithm="md5"):
+    """
+    Hash bytes already in memory.
+    """
+
+    h = _new_hasher(algorithm)
+    h.update(data)
+
+    return h.hexdigest()
+
+class FileHashCache:
+    """
+    Hashes of files keyed by path and validated against the size,
+    modification time and inode of the file.  Safe to use from multiple
+    threads.
+    """
+
+    def __init__(self,algorithm="md5"):
+        """
+        algorithm: hash algorithm to use (see AVAILABLE_ALGORITHMS)
+        """
+
+        _new_hasher(algorithm)
+        self._algorithm = algorithm
+
+        # Keys are absolute paths; values are [size,mtime_ns,inode,hash]
+        self._entries = {}
+
+        # Paths looked up since the cache was loaded or saved
+        self._used = set()
+
+        self._lock = threading.Lock()
+
+    def get_hash(self,input_file):
+        """
+        Return the hash of input_file, only reading the file if it changed
+        since it was last hashed.
+        """
+
+        path = os.path.abspath(input_file)
+        stat = os.stat(path)
+        stamp = [stat.st_size,stat.st_mtime_ns,stat.st_ino]
+
+        with self._lock:
+            self._used.add(path)
+            entry = self._entries.get(path,None)
+            if entry is not None and entry[:3] == stamp:
+                return entry[3]
+
+        file_hash = hash_file(path,self._algorithm)
+
+        if time.time() - stat.st_mtime_ns/1e9 > _RACY_WINDOW:
+            with self._lock:
+                self._entries[path] = stamp + [file_hash]
+
+        return file_hash
+
+    def load(self,json_file):
+        """
+        Load hashes saved by a previous build.  Hashes made with a different
+        algorithm are ignored.
+        """
+
+        try:
+            saved = json.load(open(json_file,'r'))
+        except (FileNotFoundError,ValueError):
+            return
+
+        try:
+            if saved["algorithm"] != self._algorithm:
+                return
+            entries = saved["files"]
+        except (KeyError,TypeError):
+            return
+
+        with self._lock:
+            for path in entries:
+                if path not in self._entries:
+                    self._entries[path] = entries[path]
+
+    def save(self,json_file):
+        """
+        Write out the hashes of every file looked up since the last load or
+        save.
+        """
+
+        with self._lock:
+            entries = dict([(p,self._entries[p]) for p in self._used
+                            if p in self._entries])
+            self._used = set()
+
+        tmp_file = "{}.{}".format(json_file,os.getpid())
+        f = open(tmp_file,'w')
+        json.dump({"algorithm":self._algorithm,"files":entries},f)
+        f.close()
+        os.replace(tmp_file,json_file)
+
+    @property
+    def algorithm(self):
+        return self._algorithm
+
+
+# Cache shared by everything in this python process
+_shared_cache = FileHashCache()
+
+def set_hash_algorithm(algorithm):
+    """
+    Select the algorithm used to hash files.  Changing the algorithm starts a
+    new, empty cache.
+    """
+
+    global _shared_cache
+
+    if algorithm != _shared_cache.algorithm:
+        _shared_cache = FileHashCache(algorithm)
+
+def get_hash_cache():
+    """
+    Return the shared FileHashCache.
+    """
+
+    return _shared_cache
+
+def get_file_hash(input_file):
+    """
+    Hash input_file using the shared cache.
+    """
+
+    return _shared_cache.get_hash(input_file)
+
+def get_data_hash(data):
+    """
+    Hash bytes with the algorithm used for files.
+    """
+
+    return hash_data(data,_shared_cache.algorithm)
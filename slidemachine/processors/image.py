@@ -28,6 +28,7 @@ class ImageProcessor(Processor):
 
         image_file, args = self._parse_markdown_line(line,delim=None)
 
+        self._record_input(image_file)
         new_file = self._copy_file(image_file)
 
         if args is not None:
@@ -8,439 +8,2084 @@ __author__ = "Michael J. Harms"
 __date__ = "2018-05-09"
 
 from .base import Processor
+from . import inkscape_pool
+from . import toolchain
+from .cache import RenderCache
+from .hashes import hash_data
+from .optimize import ImageOptimizer
+
+import sys, os, re, subprocess, copy, shutil, threading, tempfile, warnings
+import io, hashlib, math, json, base64, binascii, pathlib, atexit, weakref
+from xml.sax.saxutils import escape
+from xml.parsers import expat
+from xml.etree import ElementTree
+
+# Bytes of the svg file fed to the xml parser at a time when looking for layers
+_SCAN_BLOCK_SIZE = 1024*1024
+
+# Version of InkscapeSVG.summary.  Summaries of other versions are ignored.
+SUMMARY_VERSION = 2
+
+# Raster images embedded in svg files as base64 data uris, and the extension
+# of the file each type is written to when pulled out of the svg
+EMBEDDED_RASTER_PATTERN = re.compile(r"""(\s(?:xlink:)?href\s*=\s*)(["'])data:image/([a-zA-Z]+);base64,([^"']*)\2""")
+RASTER_EXTENSIONS = {"png":"png","jpeg":"jpg","jpg":"jpg","gif":"gif",
+                     "bmp":"bmp","tiff":"tif"}
+
+# Size of svg units in pixels (96 dpi)
+UNITS_TO_PX = {"":1.0,"px":1.0,"pt":96/72,"pc":16.0,"mm":96/25.4,
+               "cm":96/2.54,"in":96.0}
+
+# Numbers and lengths (number then units) in svg attributes
+_NUMBER = r"[-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?"
+_LENGTH_PATTERN = re.compile(r"\s*({})\s*([a-z]*)".format(_NUMBER))
+
+# Namespace of xml:space, xml:lang, etc.; never declared
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+
+# Namespaces used only by inkscape.  Elements and attributes in these
+# namespaces are dropped when writing a plain svg without inkscape.
+INKSCAPE_ONLY_NAMESPACES = ("http://www.inkscape.org/namespaces/inkscape",
+                            "http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd")
+
+class RasterStore:
+    """
+    Files holding raster images pulled out of svg files, named by their
+    content, in a temporary directory that lasts as long as this python
+    process.  A raster embedded in several svg files is written once.  Each
+    file is counted for every svg using it and deleted when the last one
+    lets go, so nothing is removed while a render may still read it.  Safe
+    to use from multiple threads.
+    """
+
+    def __init__(self):
+
+        self._dir = None
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self,data,extension):
+        """
+        Store bytes as a file with extension (i.e. "png"), returning its path.
+        Every call must be matched by a call to release.
+        """
+
+        with self._lock:
+
+            if self._dir is None:
+                self._dir = tempfile.mkdtemp(prefix="slidemachine_rasters_")
+
+            raster_file = os.path.join(self._dir,"{}.{}".format(hash_data(data),
+                                                                extension))
+
+            if raster_file not in self._counts:
+                f = open(raster_file,"wb")
+                f.write(data)
+                f.close()
+                self._counts[raster_file] = 0
+
+            self._counts[raster_file] += 1
+
+        return raster_file
+
+    def release(self,raster_files):
+        """
+        Let go of a list of files returned by add, deleting any no longer
+        used.
+        """
+
+        with self._lock:
+            for raster_file in raster_files:
+                self._counts[raster_file] -= 1
+                if self._counts[raster_file] == 0:
+                    self._counts.pop(raster_file)
+                    try:
+                        os.remove(raster_file)
+                    except FileNotFoundError:
+                        pass
+
+    def close(self):
+        """
+        Delete every file in the store.
+        """
+
+        with self._lock:
+            if self._dir is not None:
+                shutil.rmtree(self._dir,ignore_errors=True)
+            self._dir = None
+            self._counts = {}
+
+
+# Store shared by every InkscapeSVG in this python process
+_raster_store = RasterStore()
+atexit.register(_raster_store.close)
+
+def _parse_length(value):
+    """
+    Split a length attribute like "210mm" into its number and units.  None
+    if value is None or not a length.
+    """
+
+    if value is None:
+        return None
+
+    m = _LENGTH_PATTERN.fullmatch(value)
+    if m is None:
+        return None
+
+    return float(m.group(1)), m.group(2)
+
+def link_rasters(svg,raster_files):
+    """
+    Replace raster images embedded in svg text as base64 data uris with
+    file:// links to the same images in the raster store.  Inkscape then
+    reads a much smaller file and decodes each image from disk.  Only use
+    the result for renders that do not keep the links (png, pdf).
+
+    svg: svg text
+    raster_files: list to which the path of every stored raster is added.
+                  These must be released from the store when no longer used.
+    """
+
+    def link(m):
 
-import sys, os, re, subprocess, copy, random, string, shutil
-from xml.dom import minidom
+        extension = RASTER_EXTENSIONS.get(m.group(3).lower(),None)
+        if extension is None:
+            return m.group(0)
+
+        # Inkscape wraps long base64 text, sometimes with escaped newlines
+        payload = re.sub(r"&#[0-9]+;|&#x[0-9a-fA-F]+;|\s","",m.group(4))
+        try:
+            data = base64.b64decode(payload,validate=True)
+        except (binascii.Error,ValueError):
+            return m.group(0)
+
+        raster_file = _raster_store.add(data,extension)
+        raster_files.append(raster_file)
+
+        uri = pathlib.Path(os.path.abspath(raster_file)).as_uri()
+        uri = escape(uri,{"\"":"&quot;","'":"&apos;"})
+
+        return "{}{}{}{}".format(m.group(1),m.group(2),uri,m.group(2))
+
+    return EMBEDDED_RASTER_PATTERN.sub(link,svg)
 
 class InkscapeSVG:
     """
     Class that holds an inkscape svg file and allows manipulation of layers.
     """
 
-    def __init__(self,svg_file):
+    def __init__(self,svg_file,summary=None):
+        """
+        svg_file: inkscape svg file
+        summary: summary of the same file made by an earlier InkscapeSVG (see
+                 the summary property).  If given, the file is not read until
+                 something needs its content (i.e. a render), so layers and
+                 configuration hashes are available without parsing it.
+        """
+
+        self._svg_file = svg_file
+
+        # Lock making sure the file is only read once
+        self._load_lock = threading.Lock()
+        self._loaded = False
+
+        # Chunks of svg text with embedded rasters replaced by links to
+        # files, made on the first render that can use them
+        self._linked_chunks = None
+        self._raster_lock = threading.Lock()
+
+        if summary is None or summary.get("version",None) != SUMMARY_VERSION:
+            self._load()
+            return
+
+        self._layer_list = list(summary["layers"])
+        self._layer_hashes = list(summary["layer_hashes"])
+        self._shared_hash = summary["shared_hash"]
+        self._layer_ancestors = [list(a) for a in summary["ancestors"]]
+        self._page_size = summary["page_size"]
+        if self._page_size is not None:
+            self._page_size = tuple(self._page_size)
+        self._page_aspect = summary["page_aspect"]
+
+    def _load(self):
+        """
+        Read and parse the svg file, if this has not been done already.
+        """
 
-        cmd = ["inkscape","--version"]
-        result = subprocess.check_output(cmd)
+        with self._load_lock:
 
-        if result.split()[1].decode().startswith("1."):
-            self._use_new_cmd_line = True
-        else:
-            self._use_new_cmd_line = False
+            if self._loaded:
+                return
 
-        self._svg_file = svg_file
+            # Find the layers, where they sit in the file and the attributes
+            # of the svg element
+            scanned, root = self._scan_layers()
+            self._layer_list = [l[0] for l in scanned]
 
-        # Read in the svg file
-        f = open(svg_file)
-        self._original_svg = f.read()
-        f.close()
+            # Read in the svg file
+            f = open(self._svg_file,"rb")
+            data = f.read()
+            f.close()
 
-        self._current_svg = copy.deepcopy(self._original_svg)
+            # None means the layers are set as in the file
+            self._current_svg = None
 
-        # Extract layers from file
-        self._parse_layers()
+            # Cut the text up around the layer tags and hash the content of
+            # each layer
+            self._index_layers(data,scanned)
+            self._hash_layers(data)
 
-        # patterns to find "g" tags and style attributes
-        self._before_pattern = re.compile("<g")
-        self._after_pattern = re.compile(">")
-        self._style_pattern = re.compile("style=")
+            self._page_size = self._find_page_size(root)
+            self._page_aspect = self._find_page_aspect(root)
 
-    def _parse_layers(self):
+            self._loaded = True
+
+    def _scan_layers(self):
         """
-        Create a list of layers in the svg file.
+        Find the layers in the svg file without building a document tree.
+        The file is fed a block at a time to an incremental xml parser, so
+        memory use does not grow with the size of the file.
+
+        A group is a layer if it has inkscape:groupmode="layer" or, failing
+        that, an id starting with "layer" (allows this to parse illustrator
+        svg files).
+
+        Returns a list of [layer_id,start,close] in the order the layers
+        appear in the file and the attributes of the svg element (None if the
+        document is not an svg).  start is the byte offset of the opening tag
+        of the layer and close the byte offset of its closing tag.
         """
 
-        # Read the svg file xml
-        xmldoc = minidom.parseString(self._current_svg)
+        parser = expat.ParserCreate()
 
-        # Make list of groups
-        group_list = xmldoc.getElementsByTagName('g')
+        layers = []
+        seen = set()
 
-        # Go through each group
-        self._layer_list = []
-        for g in group_list:
+        # Attributes of the document element, if it is an svg
+        root = []
 
-            # See if this is a layer (inkscape:groupmode="layer")
-            try:
-                group_type = g.attributes['inkscape:groupmode'].value
-                if group_type != "layer":
-                    raise KeyError
+        # For every open group, its index in layers (None if not a layer)
+        open_groups = []
 
-            # If the inkscape layer isn't found, try to parse by id (allows
-            # this to parse illustrator svg files)
-            except KeyError:
-                try:
-                    second_check = g.attributes["id"].value.lower()
-                    if not second_check.startswith("layer"):
-                        continue
-                except KeyError:
+        # Names are as written in the file (no namespace processing), so
+        # only unprefixed "g" tags are groups
+        def start_element(name,attributes):
+
+            if len(root) == 0:
+                root.append(attributes if name == "svg" else None)
+
+            if name != "g":
+                return
+
+            layer_id = attributes.get("id",None)
+
+            is_layer = attributes.get("inkscape:groupmode",None) == "layer"
+            if not is_layer and layer_id is not None:
+                is_layer = layer_id.lower().startswith("layer")
+
+            # A layer without an id cannot be toggled
+            if not is_layer or layer_id is None:
+                open_groups.append(None)
+                return
+
+            if layer_id in seen:
+                err = "Mangled xml. Layer id {} is used twice.\n".format(layer_id)
+                raise ValueError(err)
+            seen.add(layer_id)
+
+            open_groups.append(len(layers))
+            layers.append([layer_id,parser.CurrentByteIndex,None])
+
+        def end_element(name):
+
+            if name != "g":
+                return
+
+            i = open_groups.pop()
+            if i is not None:
+                layers[i][2] = parser.CurrentByteIndex
+
+        parser.StartElementHandler = start_element
+        parser.EndElementHandler = end_element
+
+        try:
+            with open(self._svg_file,"rb") as f:
+                while True:
+                    block = f.read(_SCAN_BLOCK_SIZE)
+                    if not block:
+                        break
+                    parser.Parse(block,False)
+            parser.Parse(b"",True)
+        except expat.ExpatError as e:
+            err = "Mangled xml ({}).\n".format(e)
+            raise ValueError(err)
+
+        return layers, root[0]
+
+    def _index_layers(self,data,scanned):
+        """
+        Cut the svg text into chunks around the opening tag of every layer,
+        and make a visible and hidden version of each layer tag.  An svg for
+        any layer configuration is then a single join of those pieces.
+
+        data: contents of the svg file as bytes
+        scanned: layers found by _scan_layers
+        """
+
+        # Opening tag, allowing ">" inside quoted attribute values
+        tag_pattern = re.compile(rb"""<(?:[^>"']|"[^"]*"|'[^']*')*>""")
+
+        # Text between layer tags
+        self._chunks = []
+
+        # Index of the layer found at each tag, in the order they appear in
+        # the file
+        self._tag_order = []
+
+        # Each layer tag as written in the file and its hidden and visible
+        # versions
+        self._file_tags = []
+        self._layer_tags = []
+
+        # Byte offsets of the start of each layer's opening tag, the end of
+        # that tag and the end of its closing tag
+        self._layer_spans = []
+
+        last_end = 0
+        for i, (layer_id, start, close) in enumerate(scanned):
+
+            m = tag_pattern.match(data,start)
+            if m is None:
+                err = "Mangled xml.\n"
+                raise ValueError(err)
+
+            tag = m.group(0).decode()
+            tag_end = m.end()
+
+            # Empty layers (<g ... />) end with their opening tag
+            if tag.endswith("/>"):
+                end = tag_end
+            else:
+                end = data.index(b">",close) + 1
+
+            self._file_tags.append(tag)
+            self._layer_tags.append((self._set_tag_display(tag,False),
+                                     self._set_tag_display(tag,True)))
+            self._layer_spans.append((start,tag_end,end))
+
+            self._chunks.append(data[last_end:start].decode())
+            self._tag_order.append(i)
+
+            last_end = tag_end
+
+        self._chunks.append(data[last_end:].decode())
+
+        # Layers that contain each layer
+        self._layer_ancestors = []
+        for start, tag_end, end in self._layer_spans:
+            self._layer_ancestors.append([i for i, (s, t, e) in enumerate(self._layer_spans)
+                                          if s < start and e >= end])
+
+    def _hash_layers(self,data):
+        """
+        Hash the content of each layer, plus everything in the file that is
+        not in a layer (defs, document attributes, etc.).  A layer's own
+        visibility does not change its hash.  A layer that uses an object
+        inside another layer (i.e. a clone of it) also hashes that layer, as
+        it changes what the first layer draws.
+
+        data: contents of the svg file as bytes
+        """
+
+        self._layer_hashes = []
+        for i, (start, tag_end, end) in enumerate(self._layer_spans):
+
+            # Use the visible version of the opening tag
+            h = hashlib.md5()
+            h.update(self._layer_tags[i][1].encode())
+            h.update(data[tag_end:end])
+            self._layer_hashes.append(h.hexdigest())
+
+        # Everything outside of the layers.  Nested layers sit inside their
+        # parent's span, so only walk spans that are not inside another.
+        h = hashlib.md5()
+        last_end = 0
+        for start, tag_end, end in sorted(self._layer_spans):
+            if start < last_end:
+                continue
+            h.update(data[last_end:start])
+            h.update(b"<layer/>")
+            last_end = end
+        h.update(data[last_end:])
+
+        self._shared_hash = h.hexdigest()
+
+        # Fold in the hashes of the layers each layer (or the part of the file
+        # outside of the layers, None) draws objects from
+        depends = self._find_layer_dependencies(data)
+
+        def fold(layer_hash,layers):
+            h = hashlib.md5(layer_hash.encode())
+            for j in sorted(layers):
+                h.update(base_hashes[j].encode())
+            return h.hexdigest()
+
+        base_hashes = list(self._layer_hashes)
+        for i in range(len(self._layer_hashes)):
+            if len(depends[i]) > 0:
+                self._layer_hashes[i] = fold(base_hashes[i],depends[i])
+
+        if len(depends[None]) > 0:
+            self._shared_hash = fold(self._shared_hash,depends[None])
+
+    def _find_layer_dependencies(self,data):
+        """
+        Find the layers that each layer draws objects from through references
+        by id: clones (href="#id") and paint servers, markers, filters, etc.
+        (url(#id)).  References to objects outside of any layer are already
+        covered by the shared hash, and objects inside a layer's own span by
+        its hash, so neither counts.
+
+        data: contents of the svg file as bytes
+
+        Returns a dictionary mapping each layer index, and None for the part
+        of the file outside of the layers, to the set of layers it depends
+        on, following references through other layers.
+        """
+
+        direct = dict([(i,set()) for i in range(len(self._layer_spans))])
+        direct[None] = set()
+
+        ref_pattern = re.compile(rb"""href\s*=\s*["']#([^"']+)["']|url\(\s*["']?#([^)"'\s]+)""")
+        refs = []
+        for m in ref_pattern.finditer(data):
+            refs.append((m.start(),m.group(1) or m.group(2)))
+
+        if len(refs) == 0:
+            return direct
+
+        # Layer holding each object that is referenced
+        wanted = set([r[1] for r in refs])
+        id_pattern = re.compile(rb"""\sid\s*=\s*["']([^"']*)["']""")
+        target_layers = {}
+        for m in id_pattern.finditer(data):
+            if m.group(1) in wanted:
+                target_layers[m.group(1)] = self._find_layer_at(m.start())
+
+        for position, target in refs:
+
+            to_layer = target_layers.get(target,None)
+            if to_layer is None:
+                continue
+
+            from_layer = self._find_layer_at(position)
+            if from_layer is not None:
+
+                # Object inside the layer's own span
+                start, tag_end, end = self._layer_spans[from_layer]
+                if start <= self._layer_spans[to_layer][0] < end:
                     continue
 
-            # Grab the layer id
-            layer_id = g.attributes['id'].value
-            self._layer_list.append(layer_id)
+            direct[from_layer].add(to_layer)
+
+        # Follow references through the layers referenced
+        depends = {}
+        for i in direct:
+            seen = set()
+            to_visit = list(direct[i])
+            while len(to_visit) > 0:
+                j = to_visit.pop()
+                if j in seen:
+                    continue
+                seen.add(j)
+                to_visit.extend(direct[j])
+            seen.discard(i)
+            depends[i] = seen
 
+        return depends
 
-    def _toggle_layer(self,layer_id,layer_on):
+    def _find_layer_at(self,position):
         """
-        Edit the svg file so that layer_id is visible (layer_on = True)
-        or invisible (layer_on = False).
+        Index of the innermost layer whose span holds the byte offset
+        position, or None if it is outside all layers.
         """
 
-        # Sanity check
-        if layer_id not in self._layer_list:
-            err = "layer ({}) not in file.\n".format(layer_id)
-            raise ValueError(err)
+        found = None
+        for i, (start, tag_end, end) in enumerate(self._layer_spans):
+            if start <= position < end:
+                if found is None or start > self._layer_spans[found][0]:
+                    found = i
+
+        return found
 
-        layer_on = bool(layer_on)
+    def _set_tag_display(self,tag,layer_on):
+        """
+        Return a copy of the layer tag that is visible (layer_on = True) or
+        invisible (layer_on = False).
+        """
 
-        # Set search strings appropriately for turning on or off
         if layer_on:
-            find_string = "display:none"
-            replace_string = "display:inline"
+            display = "display:inline"
         else:
-            find_string = "display:inline"
-            replace_string = "display:none"
+            display = "display:none"
 
-        # Create string for looking for layer_id
-        layer_string = "id=\"{}\"".format(layer_id)
+        style_pattern = re.compile(r"""(\sstyle=)(["'])(.*?)\2""")
+        styles = style_pattern.findall(tag)
+
+        # Multiple style attributes in the same tag!
+        if len(styles) > 1:
+            err = "mangled xml.\n"
+            raise ValueError(err)
 
-        # Split svg text into text before the layer_id and after the
-        # layer_id.
-        layer_pattern = re.compile("id=\"{}\"".format(layer_id))
-        before, after = layer_pattern.split(self._current_svg)
+        # If there was not a style attribute already, make one
+        if len(styles) == 0:
 
-        # Take the last tag start from before the layer_id
+            if tag.endswith("/>"):
+                tag_end = len(tag) - 2
+            else:
+                tag_end = len(tag) - 1
+
+            return "{}\n     style=\"{}\"{}".format(tag[:tag_end],display,
+                                                   tag[tag_end:])
+
+        # Replace the display property in the style attribute, adding it if
+        # it is not there.
+        style = styles[0][2]
+        display_pattern = re.compile(r"display\s*:\s*[a-z-]+")
+        if display_pattern.search(style):
+            style = display_pattern.sub(display,style)
+        elif style.strip() == "":
+            style = display
+        else:
+            style = "{};{}".format(display,style)
 
-        # Iterate through all matches --> tag_start will be last match by
-        # the end of loop
-        tag_start = None
-        for tag_start in self._before_pattern.finditer(before):
-            pass
+        def replace_style(m):
+            return "{}{}{}{}".format(m.group(1),m.group(2),style,m.group(2))
+
+        return style_pattern.sub(replace_style,tag)
+
+    def _build_svg(self,processed_config,linked=False):
+        """
+        Build the svg text for a list of bools, one per layer.  If linked,
+        embedded rasters are replaced by links to files (see link_rasters).
+        """
+
+        self._load()
+
+        chunks = self._chunks
+        if linked:
+            chunks = self._get_linked_chunks()
+
+        pieces = [chunks[0]]
+        for j, i in enumerate(self._tag_order):
+            pieces.append(self._layer_tags[i][processed_config[i]])
+            pieces.append(chunks[j+1])
+
+        return "".join(pieces)
+
+    def _get_linked_chunks(self):
+        """
+        Chunks of the svg text with embedded rasters pulled out into the
+        raster store.  Done once per object; the files are released when the
+        object is deleted.
+        """
+
+        with self._raster_lock:
+
+            if self._linked_chunks is None:
+
+                raster_files = []
+                weakref.finalize(self,_raster_store.release,raster_files)
+
+                self._linked_chunks = [link_rasters(c,raster_files)
+                                       for c in self._chunks]
+
+        return self._linked_chunks
+
+    def _links_rasters(self,output_file,format,backend):
+        """
+        Whether a render can use linked rasters: inkscape renders to anything
+        but svg, which would keep the links.
+        """
+
+        if backend != "inkscape":
+            return False
+
+        if output_file is None:
+            return format != "svg"
+
+        return output_file[-3:] != "svg"
+
+    def _process_config(self,layer_config):
+        """
+        Convert a layer configuration (string like "0010" or list-like) into
+        a list of bools, one per layer.
+        """
+
+        # Sanity check
+        if len(self._layer_list) != len(layer_config):
+            err = "layer_config must have the same length as the number of layers\n"
+            raise ValueError(err)
+
+        # If user specified string like 100101, convert to int
+        if type(layer_config) is str:
+            layer_config = [int(c) for c in list(layer_config)]
+
+        # Convert to list of bool
+        return [bool(c) for c in list(layer_config)]
+
+    def get_config_hash(self,layer_config,*args):
+        """
+        Return a hash of everything that goes into rendering layer_config:
+        the content of each visible layer and the part of the file outside
+        of the layers.  Hidden layers do not contribute, so editing a layer
+        does not change the hash of configurations in which it is hidden.
+        Any extra arguments (i.e. output format) are added to the hash.
+        """
+
+        processed_config = self._process_config(layer_config)
+
+        h = hashlib.md5()
+        h.update(self._shared_hash.encode())
+        for i, on in enumerate(processed_config):
+            if on:
+                h.update(self._layer_hashes[i].encode())
+            else:
+                h.update(b"-")
+        for a in args:
+            h.update("{}".format(a).encode())
+
+        return h.hexdigest()
+
+    def set_layer_config(self,layer_config):
+        """
+        Set the layers according to the list-like object in layer_config.
+        Must have one entry per layer that can be interpreted as bool.
+        False means that layer is off, True means that layer is on.
+        Returns a string representation of the layer config as 0s and 1s.
+
+        Examples:
+
+        layer_config = "0010" would turn on the third layer of four (counting
+        from the bottom of the stack)
+
+        layer_config = [1,1,1,1,1,1] would turn on all 6 layers of 6
+
+        """
+
+        processed_config = self._process_config(layer_config)
+
+        self._load()
+
+        # Set layers according to config
+        self._current_svg = self._build_svg(processed_config)
+
+        # Create a string representation of the configuration
+        config_name = "".join(["{}".format(int(c)) for c in processed_config])
+
+        return config_name
+
+    def write_inkscape_svg(self,output_file,force=False,svg=None):
+        """
+        Write the current svg to an inkscape svg file.  Will not overwrite
+        an existing file unless force == True.  If svg is given, write that
+        svg text rather than the current svg.
+        """
+
+        if os.path.isfile(output_file) and not force:
+            err = "output file ({}) already exists\n".format(output_file)
+            raise ValueError(err)
+
+        if output_file[-4:] != ".svg":
+            err = "output file must be an svg file\n".format(output_file)
+            raise ValueError(err)
+
+        if svg is None:
+            svg = self.svg
+
+        f = open(output_file,"w")
+        f.write(svg)
+        f.close()
+
+    def write_plain_svg(self,output_file,force=False,svg=None):
+        """
+        Write the current svg to a plain svg file without using inkscape.
+        Will not overwrite an existing file unless force == True.  If svg is
+        given, write that svg text rather than the current svg.  See
+        get_plain_svg.
+        """
+
+        if os.path.isfile(output_file) and not force:
+            err = "output file ({}) already exists\n".format(output_file)
+            raise IOError(err)
+
+        if output_file[-4:] != ".svg":
+            err = "output file must be an svg file\n".format(output_file)
+            raise ValueError(err)
+
+        f = open(output_file,"w")
+        f.write(self.get_plain_svg(svg))
+        f.close()
+
+    def get_plain_svg(self,svg=None):
+        """
+        Return the current svg (or svg, if given) as plain svg text.  Hidden
+        layers are removed entirely and inkscape-only elements and attributes
+        are stripped.
+        """
+
+        if svg is None:
+            svg = self.svg
+
+        # Parse, keeping the namespace prefixes declared in the file
+        declared = []
+        parser = ElementTree.iterparse(io.StringIO(svg),events=["start-ns"])
+        for event, (prefix, uri) in parser:
+            declared.append((prefix,uri))
+        root = parser.root
+
+        layers = set(self._layer_list)
+        hidden_pattern = re.compile(r"display\s*:\s*none")
+
+        def inkscape_only(key):
+            for ns in INKSCAPE_ONLY_NAMESPACES:
+                if key.startswith("{{{}}}".format(ns)):
+                    return True
+            return False
+
+        to_visit = [root]
+        while len(to_visit) > 0:
+
+            element = to_visit.pop()
+
+            for key in list(element.attrib.keys()):
+                if inkscape_only(key):
+                    element.attrib.pop(key)
+
+            for child in list(element):
+
+                # Drop inkscape elements (i.e. sodipodi:namedview)
+                if inkscape_only(child.tag):
+                    element.remove(child)
+                    continue
+
+                # Drop hidden layers
+                if child.get("id") in layers:
+                    if hidden_pattern.search(child.get("style","")):
+                        element.remove(child)
+                        continue
+
+                to_visit.append(child)
+
+        self._set_prefixes(root,declared)
+
+        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n{}\n".format(ElementTree.tostring(root,encoding="unicode"))
+
+    def _set_prefixes(self,root,declared):
+        """
+        Write the namespaces of the elements and attributes under root as the
+        prefixes declared in the file, and declare the namespaces used on
+        root.  ElementTree then writes the names as they are rather than
+        inventing prefixes (ns0, ns1 ...) or using its process-wide prefix
+        registry.
+
+        root: root element of the svg
+        declared: list of (prefix,uri) namespace declarations in the file
+        """
+
+        # Prefix for each namespace; the default namespace ("") is only used
+        # for elements, as attributes without a prefix have no namespace
+        element_prefixes = {}
+        attribute_prefixes = {XML_NAMESPACE:"xml"}
+        for prefix, uri in declared:
+            element_prefixes[uri] = prefix
+            if prefix != "":
+                attribute_prefixes[uri] = prefix
+        for prefix, uri in declared:
+            if prefix == "":
+                element_prefixes[uri] = ""
+
+        used = {}
+
+        def get_name(name,prefixes):
+
+            if not name.startswith("{"):
+                return name
+
+            uri, local = name[1:].split("}",1)
+            try:
+                prefix = prefixes[uri]
+            except KeyError:
+                prefix = "ns{}".format(len(used))
+                prefixes[uri] = prefix
+
+            if uri != XML_NAMESPACE:
+                used[prefix] = uri
+
+            if prefix == "":
+                return local
+
+            return "{}:{}".format(prefix,local)
+
+        for element in root.iter():
+
+            if not isinstance(element.tag,str):
+                continue
+
+            element.tag = get_name(element.tag,element_prefixes)
+
+            attributes = [(get_name(k,attribute_prefixes),v)
+                          for k, v in element.attrib.items()]
+            element.attrib.clear()
+            element.attrib.update(attributes)
+
+        # Declare the namespaces on the root element, before its attributes
+        attributes = []
+        for prefix in sorted(used):
+            if prefix == "":
+                attributes.append(("xmlns",used[prefix]))
+            else:
+                attributes.append(("xmlns:{}".format(prefix),used[prefix]))
+
+        attributes.extend(root.attrib.items())
+        root.attrib.clear()
+        root.attrib.update(attributes)
+
+    def render(self,output_file,text_to_path=True,svg=None,backend="inkscape",
+               width=None,dpi=None,export_id=None,format=None):
+        """
+        Render the current state of the svg string as an image file using
+        inkscape.
+
+        output_file: filename to write.  the type of file is inferred from the
+                     extension on the file.  Can be .svg, .png, or .pdf.  An
+                     svg file will be a "plain" svg rather than an inkscape
+                     svg.  If None, return the render as bytes instead.
+        text_to_path: whether to convert text in svg to paths
+        svg: svg text to render.  If None, render the current state.
+        backend: "inkscape" renders with inkscape. "native" writes a plain
+                 svg directly, without inkscape.  It can only write svg files
+                 and ignores text_to_path.
+        width: width of a png render in pixels.  If None, inkscape picks it
+               from dpi.
+        dpi: resolution of a png render.  Ignored if width is given.  If both
+             are None, inkscape uses its default (96).
+        export_id: if given, render only the object with this id, cropped to
+                   its bounding box on a transparent background, rather than
+                   the whole page.
+        format: type of file (svg, png, pdf) to render if output_file is None.
+
+        If inkscape can read svg from stdin and write the render to stdout,
+        and the shared pool of inkscape shells is turned off, the svg is
+        piped through inkscape and nothing is written but output_file.
+        Otherwise the svg goes through a temporary file in the system
+        temporary directory.
+        """
+
+        # Figure out what kind of file we want to write
+        if output_file is None:
+            if format is None:
+                err = "format must be given if there is no output_file\n"
+                raise ValueError(err)
+            extension = format
+        else:
+            extension = output_file[-3:]
+
+        # Write svg output without launching inkscape
+        if backend == "native":
+            if output_file is None:
+                if extension != "svg":
+                    err = "the native backend can only write svg files\n"
+                    raise ValueError(err)
+                return self.get_plain_svg(svg).encode()
+
+            self.write_plain_svg(output_file,svg=svg)
+            return
+
+        if backend != "inkscape":
+            err = "backend \"{}\" not recognized\n".format(backend)
+            raise ValueError(err)
+
+        # What the installed inkscape can do.  This is only probed once per
+        # build.
+        tools = toolchain.get_toolchain()
+
+        # Map output type to inkscape flag
+        if tools.use_new_cmd_line:
+            output_flags = {"svg":["--export-type=svg","--export-plain-svg"],
+                            "pdf":["--export-type=pdf"],
+                            "png":["--export-type=png"]}
+        else:
+            output_flags = {"svg":"--export-plain-svg={}",
+                            "pdf":"--export-pdf={}",
+                            "png":"--export-png={}"}
+
+        try:
+            output_flag = output_flags[extension]
+        except KeyError:
+            err = "file type of \"{}\" not recognized\n".format(extension)
+            err = err + "\n\nfile must be one of\n\n"
+            for k in output_flags.keys():
+                err += "    {}\n".format(k)
+            raise ValueError(err)
+
+        # Don't overwrite a file if it already exists
+        if output_file is not None and os.path.isfile(output_file):
+            err = "output file ({}) already exists\n".format(output_file)
+            raise IOError(err)
+
+        if svg is None:
+            svg = self.svg
+
+        # Arguments that say what to render
+        export_args = []
+        if export_id is None:
+            export_args.append("--export-area-page")
+        else:
+            export_args.append("--export-id={}".format(export_id))
+            export_args.append("--export-id-only")
+            export_args.append("--export-background-opacity=0")
+
+        if text_to_path:
+            export_args.append("--export-text-to-path")
+
+        if width is not None:
+            export_args.append("--export-width={:d}".format(int(width)))
+        elif dpi is not None:
+            export_args.append("--export-dpi={:g}".format(dpi))
+
+        # Stream the svg through inkscape.  The inkscape shells in the pool
+        # read commands on stdin, so this is only possible without the pool.
+        pool = inkscape_pool.get_pool()
+        if pool is None and tools.supports_pipe:
+
+            cmd = [tools.path,"--pipe","{}=-".format(tools.export_filename_flag)]
+            cmd.extend(output_flag)
+            cmd.extend(export_args)
+
+            result = subprocess.run(cmd,input=svg.encode(),
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+
+            data = result.stdout
+            if result.returncode != 0 or len(data) == 0:
+                err = "inkscape failed to render (exit code {}).\n".format(result.returncode)
+                message = result.stderr.decode(errors="replace").strip()
+                if message != "":
+                    err += "inkscape said:\n\n{}\n".format(message)
+                raise IOError(err)
+
+            if output_file is None:
+                return data
+
+            f = open(output_file,"wb")
+            f.write(data)
+            f.close()
+
+            return
+
+        # Write out the inkscape svg file to a temporary file
+        tmp_dir = tempfile.mkdtemp(prefix="slidemachine_")
+        try:
+
+            tmp_file = os.path.join(tmp_dir,"render.svg")
+            self.write_inkscape_svg(tmp_file,svg=svg)
+
+            if output_file is None:
+                render_file = os.path.join(tmp_dir,"render.{}".format(extension))
+            else:
+                render_file = output_file
+
+            # Construct inkscape arguments that render the svg to the output
+            # file
+            inkscape_tmp_path = os.path.abspath(tmp_file)
+            inkscape_output_path = os.path.abspath(render_file)
+
+            if tools.use_new_cmd_line:
+                args = ["{}".format(inkscape_tmp_path)]
+                args.append("{}={}".format(tools.export_filename_flag,
+                                           inkscape_output_path))
+                args.extend(output_flag)
+            else:
+                args = ["--file={}".format(inkscape_tmp_path)]
+                args.append(output_flag.format(inkscape_output_path))
+
+            args.extend(export_args)
+
+            # Run the command, either on a running inkscape shell from the
+            # shared pool or by launching inkscape
+            if pool is not None:
+                pool.run(args)
+            else:
+                cmd = [tools.path,"-z"]
+                cmd.extend(args)
+                result = subprocess.check_output(cmd)
+
+            # Make sure the command wrote an output error
+            if not os.path.isfile(render_file):
+                err = "Unknown error. No file written out.\n"
+                raise IOError(err)
+
+            if output_file is None:
+                f = open(render_file,"rb")
+                data = f.read()
+                f.close()
+
+                return data
+
+        # Clean up
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def render_config(self,layer_config,output_file,text_to_path=True,
+                      backend="inkscape",width=None,dpi=None,format=None):
+        """
+        Render a single layer configuration to output_file without changing
+        the current state of the svg.  If output_file is None, return the
+        render as bytes.  Safe to call from several threads at once on the
+        same object.  See render for the other arguments.
+        """
+
+        linked = self._links_rasters(output_file,format,backend)
+        svg = self._build_svg(self._process_config(layer_config),linked)
+
+        return self.render(output_file,text_to_path,svg=svg,backend=backend,
+                           width=width,dpi=dpi,format=format)
+
+    def render_layers(self,output_root,
+                      format="png",
+                      text_to_path=True,
+                      layer_configs=None,
+                      backend="inkscape",
+                      width=None,
+                      dpi=None):
+        """
+        Render the layers in the specified output format. Returns a list of the
+        rendered files.
+
+        output_root: root for output file name
+        format: svg, png, pdf
+        text_to_path: whether to render text as paths in final render
+        layer_configs: list of layer configurations to render.  If None,
+                       render will go like 100, 110, 111 ... meaning that the
+                       each render will have one more layer turned on.
+        backend: "inkscape" or "native" (svg only, see render)
+        width: width of png renders in pixels (see render)
+        dpi: resolution of png renders (see render)
+        """
+
+        self._load()
+
+        # Save backup of current state -- will return to this after
+        # writing out
+        current_state = copy.deepcopy(self._current_svg)
+
+        if layer_configs is None:
+
+            layer_configs = self.default_layer_render
+
+        else:
+
+            # sanity checks on user-generated configs
+
+            try:
+                len(layer_configs)
+            except TypeError:
+                err = "layer_configs must be a list-like object\n"
+                raise ValueError(err)
+
+            if len(layer_configs) == 0:
+                err = "layer_configs must have at least one configuration\n"
+                raise ValueError(err)
+
+        configs_seen = {}
+
+        # Go through each layer configuration
+        rendered = []
+        for config in layer_configs:
+
+            # Set the layer state
+            config_name = self.set_layer_config(config)
+
+            # Render output
+            out_name = "{}_{}.{}".format(output_root,config_name,format)
+
+            # Only render if we haven't already rendered this configuration
+            try:
+                configs_seen[out_name]
+            except KeyError:
+                configs_seen[out_name] = 0
+
+                svg = None
+                if self._links_rasters(out_name,format,backend):
+                    svg = self._build_svg(self._process_config(config),True)
+
+                self.render(out_name,text_to_path,svg=svg,backend=backend,
+                            width=width,dpi=dpi)
+
+            # Record that we rendered this layer
+            rendered.append(out_name)
+
+        # Restore to pristine state
+        self._current_svg = copy.deepcopy(current_state)
+
+        # Return list of rendered files
+        return rendered
+
+    def get_layer_ancestors(self,layer_index):
+        """
+        Return the indexes of the layers that contain the layer at
+        layer_index.  A layer is only visible if all of these are visible.
+        """
+
+        return list(self._layer_ancestors[layer_index])
+
+    def render_layer(self,layer_index,output_file,text_to_path=True,
+                     width=None,dpi=None):
+        """
+        Render a single layer on its own to a transparent png cropped to the
+        bounding box of the layer.  Layers that contain it are made visible,
+        but not drawn.  If output_file is None, return the render as bytes.
+        Safe to call from several threads at once on the same object.  See
+        render for the other arguments.
+        """
+
+        config = [False for l in self._layer_list]
+        config[layer_index] = True
+        for i in self.get_layer_ancestors(layer_index):
+            config[i] = True
+
+        svg = self._build_svg(config,True)
+
+        return self.render(output_file,text_to_path,svg=svg,width=width,
+                           dpi=dpi,export_id=self._layer_list[layer_index],
+                           format="png")
+
+    def query_layer_boxes(self):
+        """
+        Ask inkscape for the bounding box of every layer.  Returns a
+        dictionary mapping layer index to (x,y,width,height) in pixels from
+        the top left of the page.  Empty layers are left out.
+        """
+
+        tools = toolchain.get_toolchain()
+
+        # Hidden layers have no bounding box, so query with every layer on
+        fd, tmp_file = tempfile.mkstemp(suffix=".svg")
+        os.close(fd)
+        self.write_inkscape_svg(tmp_file,force=True,
+                                svg=self._build_svg([True for l in self._layer_list],True))
+
+        try:
+            cmd = [tools.path]
+            if not tools.use_new_cmd_line:
+                cmd.append("-z")
+            cmd.extend(["--query-all",tmp_file])
+            result = subprocess.check_output(cmd,stderr=subprocess.DEVNULL)
+        finally:
+            os.remove(tmp_file)
+
+        layer_index = dict([(l,i) for i, l in enumerate(self._layer_list)])
+
+        boxes = {}
+        for line in result.decode(errors="replace").splitlines():
+
+            columns = line.strip().split(",")
+            if len(columns) != 5 or columns[0] not in layer_index:
+                continue
+
+            try:
+                box = tuple([float(c) for c in columns[1:]])
+            except ValueError:
+                continue
+
+            if box[2] <= 0 or box[3] <= 0:
+                continue
+
+            boxes[layer_index[columns[0]]] = box
+
+        return boxes
+
+    @property
+    def svg(self):
+        """
+        svg as text.
+        """
+
+        self._load()
+
+        if self._current_svg is None:
+            pieces = [self._chunks[0]]
+            for j, i in enumerate(self._tag_order):
+                pieces.append(self._file_tags[i])
+                pieces.append(self._chunks[j+1])
+            return "".join(pieces)
+
+        return self._current_svg
+
+    @property
+    def summary(self):
+        """
+        What is needed to list the layers and hash layer configurations of
+        this svg without reading it again.  json-serializable.
+        """
+
+        return {"version":SUMMARY_VERSION,
+                "layers":list(self._layer_list),
+                "layer_hashes":list(self._layer_hashes),
+                "shared_hash":self._shared_hash,
+                "ancestors":[list(a) for a in self._layer_ancestors],
+                "page_size":self._page_size,
+                "page_aspect":self._page_aspect}
+
+    @property
+    def layers(self):
+        """
+        List of layers to render.
+        """
+
+        return self._layer_list
+
+    def _find_page_size(self,root):
+        """
+        Width and height of the page in pixels (96 dpi), from the width and
+        height of the svg or, failing that, its viewBox.  None if neither
+        gives a page with an area (i.e. width="100%" and no viewBox).
+
+        root: attributes of the svg element (see _scan_layers)
+        """
+
+        if root is None:
+            return None
+
+        size = []
+        for attrib in ["width","height"]:
+            value = _parse_length(root.get(attrib,None))
+            if value is None or value[1] not in UNITS_TO_PX:
+                break
+            size.append(value[0]*UNITS_TO_PX[value[1]])
+
+        if len(size) == 2 and size[0] > 0 and size[1] > 0:
+            return tuple(size)
+
+        view_box = root.get("viewBox",None)
+        if view_box is not None:
+            values = re.findall(_NUMBER,view_box)
+            if len(values) == 4 and float(values[2]) > 0 and float(values[3]) > 0:
+                return float(values[2]), float(values[3])
+
+        return None
+
+    def _find_page_aspect(self,root):
+        """
+        Width over height of the page, from the viewBox or the width and
+        height of the svg.  None if neither is given.
+
+        root: attributes of the svg element (see _scan_layers)
+        """
+
+        if root is None:
+            return None
+
+        view_box = root.get("viewBox",None)
+        if view_box is not None:
+            values = re.findall(_NUMBER,view_box)
+            if len(values) == 4 and float(values[3]) > 0:
+                return float(values[2])/float(values[3])
+
+        size = []
+        for attrib in ["width","height"]:
+            value = _parse_length(root.get(attrib,None))
+            if value is None:
+                return None
+            size.append(value)
+
+        # Only comparable if both are in the same units
+        if size[0][1] != size[1][1] or size[1][0] <= 0:
+            return None
+
+        return size[0][0]/size[1][0]
+
+    @property
+    def page_size(self):
+        """
+        Width and height of the page in pixels (96 dpi), or None.
+        """
+
+        return self._page_size
+
+    @property
+    def page_aspect(self):
+        """
+        Width over height of the page, or None.
+        """
+
+        return self._page_aspect
+
+    @property
+    def default_layer_render(self):
+        """
+        Default set of layers to render.
+        """
+
+        # Construct a default set of layer configurations going like:
+        #   100, 110, 111
+        # This starts with layer one, then layer one+two, then layer
+        # one+two+three
+
+        layer_configs = []
+
+        config = [False for s in self._layer_list]
+        for i in range(len(self._layer_list)):
+            config[i] = True
+
+            layer_configs.append(copy.deepcopy(config))
+
+        return layer_configs
+
+
+class InkscapeProcessor(Processor):
+    """
+    Process and inkscape SVG file, creating individual slides from layers.
+
+    Looks for lines like this:
+
+    ![sm.inkscape](inkscape_file) 100,001,111
+
+    The list of layer configurations on the right is optional. Those strings
+    specify the layer configurations to render.  The example above would
+    render bottom layer alone, the top layer alone, and then all three
+    layers together, in that order.  It would then create three slides,
+    one for each render.  The length of each 0/1 string must be the same as
+    the number of layers in the input inkscape file.  If no configurations
+    are specified, the renderer will build the layers sequentially from
+    bottom to top (i.e. 1000, 1100, 1110, 1111).
+    """
+
+    def __init__(self,
+                 target_dir="slidemachine.data",
+                 img_format="png",
+                 text_to_path=True,
+                 pattern="!\[sm.inkscape\]",
+                 prev_build_json="prev-build.json",
+                 pool_size=4,
+                 backend="inkscape",
+                 render_cache=True,
+                 render_cache_dir=None,
+                 render_cache_size=1024,
+                 hash_names=False,
+                 optimize=False,
+                 quantize=False,
+                 variants=None,
+                 optimize_jobs=None,
+                 width=None,
+                 dpi=None,
+                 resolutions=None,
+                 layer_stack=False):
+        """
+        target_dir: directory in which to write out rendered files
+        img_format: image format (png, pdf, svg)
+        text_to_path: convert text in svg to path
+        pattern: pattern to use to look for inkscape lines in markdown
+        prev_build_json: previous build json written by older versions
+        pool_size: number of inkscape processes kept running to do renders.
+                   0 launches a new inkscape process for every render,
+                   piping the svg in and the render out if inkscape can.
+        backend: "inkscape" renders with inkscape.  "native" writes svg files
+                 directly without inkscape (img_format must be svg).
+        render_cache: whether to use the user-level render cache shared by
+                      all decks
+        render_cache_dir: directory for the render cache.  If None, use
+                          ~/.cache/slidemachine/renders
+        render_cache_size: maximum size of the render cache in MB
+        hash_names: name rendered files by their content rather than by the
+                    svg file and layer configuration
+        optimize: losslessly recompress png renders
+        quantize: reduce png renders to a 256 color palette (lossy; needs
+                  pngquant).  Implies optimize.
+        variants: list of extra formats ("webp", "avif") to write for each
+                  png render.  Implies optimize.  Browsers pick the best
+                  format they support.
+        optimize_jobs: number of processes used to optimize renders.  If
+                       None, use the number of cpus.
+        width: width of png renders in pixels.  "template" fits renders to
+               the width and height of the reveal.js slides in the template.
+               If None, the width is set by dpi.
+        dpi: resolution of png renders if width is None.  If None, use
+             inkscape's default (96).
+        resolutions: list of scale factors (i.e. [1,2]) at which to render
+                     each png.  The renders are offered to the browser with
+                     srcset, so high density displays get sharper images.
+        layer_stack: render each layer once on its own, cropped to its
+                     bounding box on a transparent background, and build
+                     each configuration in the browser by stacking the
+                     visible layers.  Only for png renders with inkscape.
+        """
+
+        self._img_format = img_format
+        self._text_to_path = text_to_path
+        self._backend = backend
+
+        if self._backend not in ["inkscape","native"]:
+            err = "backend must be \"inkscape\" or \"native\"\n"
+            raise ValueError(err)
+
+        if self._backend == "native" and self._img_format != "svg":
+            err = "the native backend can only write svg files\n"
+            raise ValueError(err)
+
+        # All InkscapeSVG renders go through the shared pool of inkscape
+        # processes
+        inkscape_pool.set_pool_size(pool_size)
+
+        # Without a usable cache directory, build without the render cache
+        self._render_cache = None
+        if render_cache:
+            try:
+                self._render_cache = RenderCache(render_cache_dir,
+                                                 render_cache_size)
+            except OSError as e:
+                warnings.warn("render cache turned off: {}".format(e))
+
+        # Optional optimization of png renders
+        if variants is None:
+            variants = []
+        self._optimizer = None
+        if optimize or quantize or len(variants) > 0:
+
+            if self._img_format != "png":
+                err = "only png renders can be optimized\n"
+                raise ValueError(err)
+
+            self._optimizer = ImageOptimizer(quantize,variants,optimize_jobs)
+
+        # Size of renders
+        if width is not None or dpi is not None or resolutions is not None:
+            if self._img_format != "png":
+                err = "width, dpi and resolutions only apply to png renders\n"
+                raise ValueError(err)
+
+        if width is not None and width != "template":
+            width = int(width)
+        self._width = width
+        self._dpi = dpi
+
+        # Scale factors each configuration is rendered at.  None means a
+        # single render at the base size.
+        if resolutions is None or len(resolutions) == 0:
+            self._scales = [None]
+        else:
+            self._scales = sorted(set([float(r) for r in resolutions]))
+
+        # Size of the reveal.js slides; see set_display_size
+        self._display_size = (960,700)
+
+        # Stack per-layer renders rather than rendering each configuration
+        self._layer_stack = bool(layer_stack)
+        if self._layer_stack:
+            if self._img_format != "png" or self._backend != "inkscape":
+                err = "layer_stack needs png renders from the inkscape backend\n"
+                raise ValueError(err)
+
+        # Bounding boxes of the layers in each svg, keyed by the md5 of the
+        # svg text
+        self._layer_boxes = {}
+
+        # Build manifest record for each InkscapeSVG object in use.  Records
+        # hold the summary of the svg and the layer bounding boxes, and stay
+        # in the build manifest after the object is released.
+        self._svg_records = {}
+
+        # InkscapeSVG objects in use, keyed by the hash of the file.  Objects
+        # are released once the line that needs them is processed, so a
+        # loaded svg is not kept for the rest of the build.
+        self._svg_objects = {}
+
+        # Formats written for each render: the main format, then variants
+        self._formats = [self._img_format]
+        if self._optimizer is not None:
+            self._formats.extend(self._optimizer.variants)
+
+        # Output files for each configuration rendered this session.  Keys
+        # are configuration hashes; values are dictionaries mapping format to
+        # file.
+        self._configs_rendered = {}
+
+        # Renders done ahead of time on a thread pool by prefetch. Keys are
+        # configuration hashes; values are futures that return the file
+        # rendered in the prefetch directory.  Renders wait on disk rather
+        # than in memory, and are dropped as soon as process uses them.
+        self._prefetched = {}
+        self._prefetch_dir = None
+        self._prefetch_count = 0
+        self._loaded_svgs = {}
+
+        super(InkscapeProcessor, self).__init__(target_dir,pattern,
+                                                prev_build_json,
+                                                hash_names=hash_names)
+
+    def _load_svg(self,svg_file):
+        """
+        Create an InkscapeSVG object and figure out what layer configurations
+        we are going to render.  Reuses objects loaded by prefetch.
+        """
+
+        try:
+            ink = self._loaded_svgs[svg_file][0]
+        except KeyError:
+            ink = self._new_svg(svg_file)
+
+        return ink
+
+    def _new_svg(self,svg_file):
+        """
+        Create an InkscapeSVG object for svg_file.  If the build manifest has
+        a summary of this version of the file, the object is made from the
+        summary and the file is only parsed if something has to be rendered.
+        """
+
+        svg_hash = self._get_file_md5(svg_file)
+
+        # Already made for another line this build
+        try:
+            return self._svg_objects[svg_hash]
+        except KeyError:
+            pass
+
+        record = self._get_record(svg_hash)
+        if record is None:
+            ink = InkscapeSVG(svg_file)
+            record = {}
+        else:
+            ink = InkscapeSVG(svg_file,summary=record["svg"])
+
+        # Layers are placed on the page as a fraction of its size
+        if self._layer_stack:
+            page_size = ink.page_size
+            if page_size is None or page_size[0] <= 0 or page_size[1] <= 0:
+                err = "layer_stack needs the size of the page in {}, but the\n".format(svg_file)
+                err += "svg has no width and height (in absolute units) or viewBox.\n"
+                raise ValueError(err)
+
+        record["svg"] = ink.summary
+        self._set_record(svg_hash,record)
+        self._svg_records[ink] = record
+        self._svg_objects[svg_hash] = ink
+
+        return ink
+
+    def _release_svg(self,svg_file,ink):
+        """
+        Forget the InkscapeSVG object for svg_file once a line is processed.
+        Its record stays in the build manifest, so another line using the
+        same file makes a new object from the summary and only reads the file
+        again if it has something new to render.  Renders still running for
+        prefetch hold on to the object until they finish.
+        """
+
+        loaded = self._loaded_svgs.get(svg_file,None)
+        if loaded is not None and loaded[0] is ink:
+            self._loaded_svgs.pop(svg_file)
+
+        for svg_hash in [k for k, v in self._svg_objects.items() if v is ink]:
+            self._svg_objects.pop(svg_hash)
+
+        self._svg_records.pop(ink,None)
+
+    def _get_layer_configs(self,ink,layer_configs):
+        """
+        Return the layer configurations to render as strings.  If
+        layer_configs is None, use the default render for the svg.
+        """
+
+        if layer_configs is None:
+            tmp_layer_configs = ink.default_layer_render
+
+            # Convert the bool lists from the InkscapeSVG object to
+            # strings.
+            layer_configs = []
+            for config in tmp_layer_configs:
+                layer_configs.append("".join([str(int(l)) for l in config]))
+
+        return layer_configs
+
+    def _get_render_size(self,ink,scale=None):
+        """
+        Return the (width,dpi) to render ink at for scale.  Both are None for
+        inkscape's default.
+        """
+
+        if scale is None:
+            scale = 1.0
+
+        width = self._width
+        if width == "template":
+
+            # Fit the page inside the slides
+            width, height = self._display_size
+            aspect = ink.page_aspect
+            if aspect is not None:
+                width = min(width,height*aspect)
+
+        if width is not None:
+            return int(round(width*scale)), None
+
+        if self._dpi is not None:
+            return None, self._dpi*scale
+
+        if scale == 1.0:
+            return None, None
+
+        return None, 96*scale
+
+    def _get_layer_boxes(self,ink):
+        """
+        Bounding boxes of the layers in ink (see InkscapeSVG.query_layer_boxes).
+        Kept for the session, in the build manifest and in the render cache,
+        so inkscape is only asked once per version of the svg.
+        """
+
+        # Hash of the whole drawing with every layer on
+        svg_hash = ink.get_config_hash(["1" for l in ink.layers],"layer-boxes")
+        try:
+            return self._layer_boxes[svg_hash]
+        except KeyError:
+            pass
+
+        record = self._svg_records.get(ink,{})
+
+        if "boxes" in record:
+            boxes = dict([(int(k),tuple(v)) for k, v in record["boxes"].items()])
+
+        elif self._render_cache is None:
+            boxes = ink.query_layer_boxes()
+
+        else:
+
+            cache_key = self._render_cache.get_key(svg_hash,
+                                                   toolchain.get_toolchain().version)
+
+            tmp_dir = tempfile.mkdtemp(prefix="slidemachine_")
+            tmp_file = os.path.join(tmp_dir,"layer-boxes.json")
+            try:
+                if self._render_cache.get(cache_key,tmp_file):
+                    boxes = json.load(open(tmp_file,'r'))
+                    boxes = dict([(int(k),tuple(v)) for k, v in boxes.items()])
+                else:
+                    boxes = ink.query_layer_boxes()
+
+                    f = open(tmp_file,'w')
+                    json.dump(boxes,f)
+                    f.close()
+                    self._render_cache.put(cache_key,tmp_file,move=True)
+            finally:
+                shutil.rmtree(tmp_dir)
+
+        self._layer_boxes[svg_hash] = boxes
+        record["boxes"] = boxes
+
+        return boxes
+
+    def _get_visible_layers(self,ink,config):
+        """
+        Indexes of the layers drawn in a configuration (string like "0110"):
+        layers that are on, inside layers that are also on, and not empty.
+        """
+
+        boxes = self._get_layer_boxes(ink)
+
+        visible = []
+        for i, on in enumerate(config):
+            if on != "1" or i not in boxes:
+                continue
+            if "0" in [config[j] for j in ink.get_layer_ancestors(i)]:
+                continue
+            visible.append(i)
+
+        return visible
+
+    def _get_config_hash(self,ink,config,scale=None):
+        """
+        Hash that changes only if the render of config at scale would
+        change.  In layer stack mode, config is the index of a layer.
+        """
+
+        extra = []
+        if self._optimizer is not None:
+            extra.extend(self._optimizer.signature)
+
+        # A single layer is hashed as the configuration in which it is drawn
+        # on its own
+        if self._layer_stack:
+            layer_config = ["0" for l in ink.layers]
+            for i in [config] + ink.get_layer_ancestors(config):
+                layer_config[i] = "1"
+            extra.extend(["layer",ink.layers[config]])
+            config = "".join(layer_config)
+
+        width, dpi = self._get_render_size(ink,scale)
+        if width is not None or dpi is not None:
+            extra.extend(["size",width,dpi])
+
+        return ink.get_config_hash(config,self._img_format,
+                                   bool(self._text_to_path),self._backend,
+                                   *extra)
 
-        # If we did not actually find the beginning of the tag
-        if tag_start is None:
-            err = "Mangled xml.\n"
-            raise ValueError(err)
+    def _get_units(self,ink,layer_configs):
+        """
+        Return a list of (config,scale,config_hash) for every render needed
+        for layer_configs: each configuration at each scale.  In layer stack
+        mode, each layer visible in any of the configurations at each scale.
+        """
 
-        # Record the position of that tag
-        tag_start = tag_start.end()
+        if self._layer_stack:
+            to_render = set()
+            for config in layer_configs:
+                to_render.update(self._get_visible_layers(ink,config))
+            layer_configs = sorted(to_render)
 
-        # Take the first tag terminator that occurs after the layer_id
-        tag_end = self._after_pattern.search(after).start()
+        units = []
+        for config in layer_configs:
+            for scale in self._scales:
+                units.append((config,scale,self._get_config_hash(ink,config,scale)))
 
-        # Replace style attribute with appropriate transition.
+        return units
 
-        # If before the layer_id
-        style_attribute_found = False
-        if self._style_pattern.search(before[tag_start:]):
+    def _get_render_name(self,out_root,config,scale):
+        """
+        Name of the render of config at scale (i.e. demo_01.png,
+        demo_01_2x.png).  Single layers are named by their position in the
+        stack (i.e. demo_layer02.png).
+        """
 
-            b1 = before[:tag_start]
-            b2 = before[tag_start:]
-            b2 = re.sub(find_string,replace_string,b2)
+        if self._layer_stack:
+            config = "layer{:02d}".format(config + 1)
 
-            before = "{}{}".format(b1,b2)
+        if scale is None or scale == 1.0:
+            return "{}_{}.{}".format(out_root,config,self._img_format)
 
-            style_attribute_found = True
+        return "{}_{}_{:g}x.{}".format(out_root,config,scale,self._img_format)
 
-        # If after the layer_id
-        if self._style_pattern.search(after[:tag_end]):
+    def set_display_size(self,width,height):
+        """
+        Set the size of the reveal.js slides, used to size renders when
+        width is "template".
+        """
 
-            # Multiple style attributes in the same tag!
-            if style_attribute_found:
-                err = "mangled xml.\n"
-                raise ValueError(err)
+        self._display_size = (width,height)
 
-            a1 = after[:tag_end]
-            a2 = after[tag_end:]
-            a1 = re.sub(find_string,replace_string,a1)
+    def _get_build_key(self,config_hash,fmt):
+        """
+        Key under which the file in format fmt for a configuration is stored
+        in the build manifest.
+        """
 
-            after = "{}{}".format(a1,a2)
+        if fmt == self._img_format:
+            return config_hash
 
-            style_attribute_found = True
+        return "{}.{}".format(config_hash,fmt)
 
-        # If there was not a style attribute already, make one
-        if not style_attribute_found:
+    def prefetch(self,lines,executor,jobs):
+        """
+        Render every layer configuration referenced in lines that will not be
+        found in the previous build, running each render as its own job on
+        executor.  process then picks up these renders instead of rendering
+        one after another.
+        """
 
-            a1 = after[:tag_end]
-            a2 = after[tag_end:]
+        # Make sure the inkscape pool has a process for each job
+        if self._backend == "inkscape":
+            pool = inkscape_pool.get_pool()
+            if pool is not None and pool.size < jobs:
+                pool.size = jobs
 
-            after = "{}\n     style=\"{}\"{}".format(a1,replace_string,a2)
+        if self._prefetch_dir is None:
+            self._prefetch_dir = tempfile.mkdtemp(prefix="slidemachine_")
 
-        # Reassemble output string
-        self._current_svg = "{}{}{}".format(before,layer_string,after)
+        for line in lines:
 
-    def set_layer_config(self,layer_config):
-        """
-        Set the layers according to the list-like object in layer_config.
-        Must have one entry per layer that can be interpreted as bool.
-        False means that layer is off, True means that layer is on.
-        Returns a string representation of the layer config as 0s and 1s.
+            if not self._pattern.match(line):
+                continue
 
-        Examples:
+            svg_file, layer_configs = self._parse_markdown_line(line)
 
-        layer_config = "0010" would turn on the third layer of four (counting
-        from the bottom of the stack)
+            # Each svg file gets its own output directory so renders of
+            # different files with the same name do not collide
+            try:
+                ink, out_root = self._loaded_svgs[svg_file]
+            except KeyError:
+                ink = self._new_svg(svg_file)
 
-        layer_config = [1,1,1,1,1,1] would turn on all 6 layers of 6
+                out_dir = "{:05d}".format(self._prefetch_count)
+                out_dir = os.path.join(self._prefetch_dir,out_dir)
+                os.mkdir(out_dir)
+                self._prefetch_count += 1
 
-        """
+                out_root = os.path.split(svg_file)[1][:-4]
+                out_root = os.path.join(out_dir,out_root)
 
-        # Sanity check
-        if len(self._layer_list) != len(layer_config):
-            err = "layer_config must have the same length as the number of layers\n"
-            raise ValueError(err)
+                self._loaded_svgs[svg_file] = (ink,out_root)
 
-        # If user specified string like 100101, convert to int
-        if type(layer_config) is str:
-            layer_config = [int(c) for c in list(layer_config)]
+            layer_configs = self._get_layer_configs(ink,layer_configs)
+            units = self._get_units(ink,layer_configs)
 
-        # Convert to list of bool
-        processed_config = [bool(c) for c in list(layer_config)]
+            already_rendered = self._find_previous_renders([u[2] for u in units])
 
-        # Set layers according to config
-        for i in range(len(self._layer_list)):
-            self._toggle_layer(layer_id=self._layer_list[i],
-                               layer_on=processed_config[i])
+            for config, scale, config_hash in units:
 
-        # Create a string representation of the configuration
-        config_name = "".join(["{}".format(int(c)) for c in processed_config])
+                if config_hash in already_rendered:
+                    continue
+                if config_hash in self._prefetched:
+                    continue
+                if config_hash in self._configs_rendered:
+                    continue
 
-        return config_name
+                out_file = self._get_render_name(out_root,config,scale)
+                self._prefetched[config_hash] = executor.submit(self._prefetch_render,
+                                                                ink,config,scale,
+                                                                config_hash,
+                                                                out_file)
 
-    def write_inkscape_svg(self,output_file,force=False):
+    def _prefetch_render(self,ink,config,scale,config_hash,out_file):
         """
-        Write the current svg to an inkscape svg file.  Will not overwrite
-        an existing file unless force == True.
+        Render a configuration for prefetch to out_file, returning out_file.
+        If renders are optimized, the optimized files are made as well so
+        process finds them in the optimizer's cache.
         """
 
-        if os.path.isfile(output_file) and not force:
-            err = "output file ({}) already exists\n".format(output_file)
-            raise ValueError(err)
+        out_file = self._render(ink,config,scale,config_hash,out_file)
+        if self._optimizer is None:
+            return out_file
 
-        if output_file[-4:] != ".svg":
-            err = "output file must be an svg file\n".format(output_file)
-            raise ValueError(err)
+        opt_dir = os.path.join(os.path.dirname(out_file),"optimized")
+        os.makedirs(opt_dir,exist_ok=True)
+        opt_root = os.path.join(opt_dir,os.path.split(out_file)[1][:-4])
+        self._optimizer.optimize(out_file,opt_root)
 
-        f = open(output_file,"w")
-        f.write(self._current_svg)
-        f.close()
+        return out_file
 
-    def render(self,output_file,text_to_path=True):
+    def _render(self,ink,config,scale,config_hash,out_file=None):
         """
-        Render the current state of the svg string as an image file using
-        inkscape.
-
-        output_file: filename to write.  the type of file is inferred from the
-                     extension on the file.  Can be .svg, .png, or .pdf.  An
-                     svg file will be a "plain" svg rather than an inkscape
-                     svg.
-        text_to_path: whether to convert text in svg to paths
+        Render a single configuration at scale to out_file, returning
+        out_file.  If out_file is None, return the render as bytes.  The
+        render is taken from the stale renders of earlier builds or the
+        render cache if it is there.
         """
 
-        # Figure out what kind of file we want to write
-        extension = output_file[-3:]
+        # Already rendered (i.e. the same configuration listed twice)
+        if out_file is not None and os.path.isfile(out_file):
+            return out_file
 
-        # Map output type to inkscape flag
-        if self._use_new_cmd_line:
-            output_flags = {"svg":["--export-type=svg","--export-plain-svg"],
-                            "pdf":["--export-type=pdf"],
-                            "png":["--export-type=png"]}
-        else:
-            output_flags = {"svg":"--export-plain-svg={}",
-                            "pdf":"--export-pdf={}",
-                            "png":"--export-png={}"}
+        # Stale files have already been optimized, so they are only used
+        # for unoptimized renders
+        if self._optimizer is None:
+            if out_file is None:
+                data = self._get_stale_data(config_hash,self._img_format)
+                if data is not None:
+                    return data
+            elif self._get_stale(config_hash,out_file):
+                return out_file
 
-        try:
-            output_flag = output_flags[extension]
-        except KeyError:
-            err = "file type of \"{}\" not recognized\n".format(output_file)
-            err = err + "\n\nfile must be one of\n\n"
-            for k in output_flags.keys():
-                err += "    {}\n".format(k)
+        if self._render_cache is not None:
 
-        # Don't overwrite a file if it already exists
-        if os.path.isfile(output_file):
-            err = "output file ({}) already exists\n".format(output_file)
-            raise IOError(err)
+            if self._backend == "native":
+                version = "native"
+            else:
+                version = toolchain.get_toolchain().version
 
-        # Write out the inkscape svg file to a temporary file
-        rand_id = "".join([random.choice(string.ascii_letters)
-                           for i in range(10)])
-        tmp_file = "tmp_{}.svg".format(rand_id)
-        self.write_inkscape_svg(tmp_file)
-
-        # Construct an inkscape command that renders the svg to the output
-        # file
-        inkscape_tmp_path = os.path.abspath(tmp_file)
-        inkscape_output_path = os.path.abspath(output_file)
-
-        if self._use_new_cmd_line:
-            cmd = ["inkscape","-z","{}".format(inkscape_tmp_path)]
-            cmd.append("--export-file={}".format(inkscape_output_path))
-            cmd.extend(output_flag)
-        else:
-            cmd = ["inkscape","-z","--file={}".format(inkscape_tmp_path)]
-            cmd.append(output_flag.format(inkscape_output_path))
+            cache_key = self._render_cache.get_key(config_hash,version)
+            if out_file is None:
+                data = self._render_cache.get_data(cache_key,self._img_format)
+                if data is not None:
+                    return data
+            elif self._render_cache.get(cache_key,out_file):
+                return out_file
 
-        cmd.append("--export-area-page")
-        if text_to_path:
-            cmd.append("--export-text-to-path")
+        width, dpi = self._get_render_size(ink,scale)
+        if self._layer_stack:
 
-        # Run the command
-        result = subprocess.check_output(cmd)
+            # Layers are cropped, so the width of the page sets the dpi
+            if width is not None:
+                dpi = 96*width/ink.page_size[0]
 
-        # Make sure the command wrote an output error
-        if not os.path.isfile(output_file):
-            err = "Unknown error. No file written out.\n"
-            raise IOError(err)
+            data = ink.render_layer(config,out_file,self._text_to_path,dpi=dpi)
+        else:
+            data = ink.render_config(config,out_file,self._text_to_path,
+                                     self._backend,width=width,dpi=dpi,
+                                     format=self._img_format)
 
-        # Clean up
-        os.remove(tmp_file)
+        if out_file is not None:
+            if self._render_cache is not None:
+                self._render_cache.put(cache_key,out_file)
+            return out_file
 
-    def render_layers(self,output_root,
-                      format="png",
-                      text_to_path=True,
-                      layer_configs=None):
-        """
-        Render the layers in the specified output format. Returns a list of the
-        rendered files.
+        if self._render_cache is not None:
+            self._render_cache.put_data(cache_key,data,self._img_format)
 
-        output_root: root for output file name
-        format: svg, png, pdf
-        text_to_path: whether to render text as paths in final render
-        layer_configs: list of layer configurations to render.  If None,
-                       render will go like 100, 110, 111 ... meaning that the
-                       each render will have one more layer turned on.
+        return data
 
+    def cleanup(self):
+        """
+        Remove anything left over from prefetch.
         """
 
-        # Save backup of current state -- will return to this after
-        # writing out
-        current_state = copy.deepcopy(self._current_svg)
-
-        if layer_configs is None:
+        if self._prefetch_dir is not None:
+            shutil.rmtree(self._prefetch_dir)
 
-            layer_configs = self.default_layer_render
+        self._prefetched = {}
+        self._prefetch_dir = None
+        self._prefetch_count = 0
+        self._loaded_svgs = {}
+        self._svg_records = {}
+        self._svg_objects = {}
 
-        else:
+    def _find_previous_renders(self,config_hashes):
+        """
+        Return a dictionary mapping each configuration hash that was rendered
+        by a previous build (and whose files still exist) to a dictionary
+        mapping format to file.
+        """
 
-            # sanity checks on user-generated configs
+        already_rendered = {}
+        for config_hash in config_hashes:
 
-            try:
-                len(layer_configs)
-            except TypeError:
-                err = "layer_configs must be a list-like object\n"
-                raise ValueError(err)
+            files = {}
+            for fmt in self._formats:
 
-            if len(layer_configs) == 0:
-                err = "layer_configs must have at least one configuration\n"
-                raise ValueError(err)
+                try:
+                    prev_output = self._prev_build_dict[self._get_build_key(config_hash,fmt)]
+                except KeyError:
+                    break
 
-        configs_seen = {}
+                # Skip anything that is not a file name (i.e. entries written
+                # by older versions of slidemachine)
+                if not isinstance(prev_output,str):
+                    break
 
-        # Go through each layer configuration
-        rendered = []
-        for config in layer_configs:
+                if not os.path.isfile(prev_output):
+                    break
 
-            # Set the layer state
-            config_name = self.set_layer_config(config)
+                files[fmt] = prev_output
 
-            # Render output
-            out_name = "{}_{}.{}".format(output_root,config_name,format)
+            if len(files) == len(self._formats):
+                already_rendered[config_hash] = files
 
-            # Only render if we haven't already rendered this configuration
-            try:
-                configs_seen[out_name]
-            except KeyError:
-                configs_seen[out_name] = 0
-                self.render(out_name,text_to_path)
+        return already_rendered
 
-            # Record that we rendered this layer
-            rendered.append(out_name)
+    def _get_markdown(self,renders):
+        """
+        Markdown for one configuration.  renders is a list of (scale,files)
+        for each scale, where files maps format to file.  Multiple scales
+        are offered with srcset; with variants, this is a <picture> element
+        so the browser can pick a format.
+        """
 
-        # Restore to pristine state
-        self._current_svg = copy.deepcopy(current_state)
+        if len(renders) == 1 and len(renders[0][1]) == 1:
+            return "![an image]({})\n".format(renders[0][1][self._img_format])
 
-        # Return list of rendered files
-        return rendered
+        return "{}\n".format(self._get_img_html(renders))
 
-    @property
-    def svg(self):
+    def _get_img_html(self,renders,style=None,alt="an image"):
         """
-        svg as text.
+        html <img> (or <picture>, with variants) for renders, a list of
+        (scale,files) as in _get_markdown.  style is an optional css style
+        for the image.
         """
 
-        return self._current_svg
+        def get_srcset(fmt):
+            if len(renders) == 1:
+                return renders[0][1][fmt]
 
-    @property
-    def layers(self):
-        """
-        List of layers to render.
-        """
+            srcset = []
+            for scale, files in renders:
+                if scale is None:
+                    scale = 1.0
+                srcset.append("{} {:g}x".format(files[fmt],scale))
 
-        return self._layer_list
+            return ", ".join(srcset)
 
-    @property
-    def default_layer_render(self):
+        # Browsers that do not understand srcset get the render closest to
+        # the base size
+        main = min(renders,key=lambda r: abs(math.log(r[0] or 1.0)))[1]
+
+        img = "<img src=\"{}\"".format(main[self._img_format])
+        if len(renders) > 1:
+            img += " srcset=\"{}\"".format(get_srcset(self._img_format))
+        if style is not None:
+            img += " style=\"{}\"".format(style)
+        img += " alt=\"{}\" />".format(alt)
+
+        if len(self._formats) == 1:
+            return img
+
+        out = ["<picture>"]
+        for fmt in self._formats[1:]:
+            out.append("<source srcset=\"{}\" type=\"image/{}\" />".format(get_srcset(fmt),fmt))
+        out.append(img)
+        out.append("</picture>")
+
+        return "".join(out)
+
+    def _get_stack_markdown(self,ink,config,renders):
         """
-        Default set of layers to render.
+        html for a configuration in layer stack mode: the visible layers as
+        images positioned over one another in a box the shape of the page.
+        renders maps layer index to a list of (scale,files) as in
+        _get_markdown.
         """
 
-        # Construct a default set of layer configurations going like:
-        #   100, 110, 111
-        # This starts with layer one, then layer one+two, then layer
-        # one+two+three
+        page_width, page_height = ink.page_size
+        boxes = self._get_layer_boxes(ink)
 
-        layer_configs = []
+        # Display width of the stack, matching a render of the whole page
+        width, dpi = self._get_render_size(ink)
+        if width is None:
+            if dpi is None:
+                dpi = 96
+            width = page_width*dpi/96
 
-        config = [False for s in self._layer_list]
-        for i in range(len(self._layer_list)):
-            config[i] = True
+        out = ["<span class=\"sm-layer-stack\" style=\"display:block;"
+               "position:relative;margin:0 auto;width:{:d}px;max-width:100%;"
+               "aspect-ratio:{:g}/{:g};\">".format(int(round(width)),
+                                                   page_width,page_height)]
 
-            layer_configs.append(copy.deepcopy(config))
+        for i in self._get_visible_layers(ink,config):
 
-        return layer_configs
+            x, y, w, h = boxes[i]
+            style = "position:absolute;margin:0;max-width:none;max-height:none;"
+            style += "left:{:.4f}%;top:{:.4f}%;width:{:.4f}%;".format(100*x/page_width,
+                                                                   100*y/page_height,
+                                                                   100*w/page_width)
 
+            out.append(self._get_img_html(renders[i],style=style,alt=""))
 
-class InkscapeProcessor(Processor):
-    """
-    Process and inkscape SVG file, creating individual slides from layers.
+        out.append("</span>\n")
 
-    Looks for lines like this:
+        return "".join(out)
 
-    ![sm.inkscape](inkscape_file) 100,001,111
+    def start_rebuild(self):
+        """
+        Start a new build in the same session.
+        """
 
-    The list of layer configurations on the right is optional. Those strings
-    specify the layer configurations to render.  The example above would
-    render bottom layer alone, the top layer alone, and then all three
-    layers together, in that order.  It would then create three slides,
-    one for each render.  The length of each 0/1 string must be the same as
-    the number of layers in the input inkscape file.  If no configurations
-    are specified, the renderer will build the layers sequentially from
-    bottom to top (i.e. 1000, 1100, 1110, 1111).
-    """
+        super(InkscapeProcessor, self).start_rebuild()
+        self._configs_rendered = {}
 
-    def __init__(self,
-                 target_dir="slidemachine.data",
-                 img_format="png",
-                 text_to_path=True,
-                 pattern="!\[sm.inkscape\]",
-                 prev_build_json="prev-build.json"):
+    def restore_slide(self,record):
         """
-        target_dir: directory in which to write out rendered files
-        img_format: image format (png, pdf, svg)
-        text_to_path: convert text in svg to path
-        pattern: pattern to use to look for inkscape lines in markdown
-        prev_build_json: file where previous build information is stored
+        Register the output files from the record of a slide that was
+        processed earlier, keeping the summaries of the svg files it uses
+        for the next build.
         """
 
-        self._img_format = img_format
-        self._text_to_path = text_to_path
-
-        self._configs_rendered = {}
+        super(InkscapeProcessor, self).restore_slide(record)
 
-        super(InkscapeProcessor, self).__init__(target_dir,pattern,
-                                                prev_build_json)
+        for input_file in record["inputs"]:
+            try:
+                self._get_record(self._get_file_md5(input_file))
+            except (FileNotFoundError,IsADirectoryError):
+                pass
 
     def process(self,line):
         """
@@ -448,68 +2093,26 @@ class InkscapeProcessor(Processor):
         svg.
         """
 
-        this_processing = {}
-
         # If the line does not match, return the original line
         if not self._pattern.match(line):
             return line
 
         svg_file, layer_configs = self._parse_markdown_line(line)
+        self._record_input(svg_file)
 
         # Create inkscape object and figure out what layer configurations
         # we are going to render
-        ink = InkscapeSVG(svg_file)
-        if layer_configs is None:
-            tmp_layer_configs = ink.default_layer_render
-
-            # Convert the bool lists from the InkscapeSVG object to
-            # strings.
-            layer_configs = []
-            for config in tmp_layer_configs:
-                layer_configs.append("".join([str(int(l)) for l in config]))
-
-        # Get the md5 of the input file.  This will change if that file
-        # changed
-        input_file_md5 = self._get_file_md5(svg_file)
-
-        already_rendered = {}
-        try:
-
-            prev_file_render = self._prev_build_dict[input_file_md5]
-
-            tmp_layer_configs = []
-            for config in layer_configs:
-                try:
-
-                    # Get file written out the last time this svg file was
-                    # rendered
-                    prev_output = prev_file_render[config]
-
-                    # If the file still exists, we don't need to render it,
-                    # so we should record it as already rendered
-                    if os.path.isfile(prev_output):
+        ink = self._load_svg(svg_file)
+        layer_configs = self._get_layer_configs(ink,layer_configs)
 
-                        try:
-                            this_processing[input_file_md5][config] = prev_output
-                        except KeyError:
-                            this_processing[input_file_md5] = {}
-                            this_processing[input_file_md5][config] = prev_output
+        # Hash each configuration at each scale.  This only changes if the
+        # layers visible in that configuration (or the defs and document they
+        # sit in) change, so editing one layer only re-renders configurations
+        # that show it.
+        units = self._get_units(ink,layer_configs)
+        config_hashes = [u[2] for u in units]
 
-                        # record that we do not actually need to render
-                        already_rendered[config] = prev_output
-
-                    # If not, raise an error
-                    else:
-                        raise KeyError
-
-                # If we get a KeyError here, we need to render this config
-                except KeyError:
-                    pass
-
-        # A KeyError here means that the input_file_md5 has never been seen --
-        # render all layers
-        except KeyError:
-            pass
+        already_rendered = self._find_previous_renders(config_hashes)
 
         # Check to see if we have already rendered this svg/layer combo during
         # this session.
@@ -522,96 +2125,150 @@ class InkscapeProcessor(Processor):
         final_file_names = []
         configs_to_render = []
 
-        for config in layer_configs:
+        for config, scale, config_hash in units:
 
             # If the file was rendered in a previous processing run, record
             # take that file
             try:
-                output_file = already_rendered[config]
+                output_file = already_rendered[config_hash]
                 final_file_names.append(output_file)
                 continue
             except KeyError:
                 pass
 
             # See if we already rendered this *this* session
-            expected_render = (svg_file,config)
             try:
-                output_file = self._configs_rendered[expected_render]
+                output_file = self._configs_rendered[config_hash]
                 final_file_names.append(output_file)
             except KeyError:
-                configs_to_render.append(config)
+                configs_to_render.append((config,scale,config_hash))
                 final_file_names.append(None)
 
         # ------ Render everything in configs_to_render -----------
 
-        # Create temporary output directory
-        id = "".join([random.choice(string.ascii_letters)
-                      for i in range(10)])
-        tmp_dir = "tmp_{}".format(id)
-        os.mkdir(tmp_dir)
-
-        # Make temporary output file root
+        # Renders are held in memory and written once, straight into the
+        # target directory.  Renders that are optimized go through files, in
+        # a temporary directory outside of the working directory; prefetched
+        # renders are copied from the prefetch directory and then removed.
         out_root = os.path.split(svg_file)[1][:-4]
-        out_root = os.path.join(tmp_dir,out_root)
 
-        if len(configs_to_render) > 0:
+        tmp_dir = None
+        if self._optimizer is not None and len(configs_to_render) > 0:
+            tmp_dir = tempfile.mkdtemp(prefix="slidemachine_")
+
+        # Do rendering, taking anything that was already rendered by prefetch
+        prefetched_files = []
+        renders = []
+        render_names = []
+        render_hashes = {}
+        for config, scale, config_hash in configs_to_render:
+
+            render_names.append(self._get_render_name(out_root,config,scale))
+
+            # The same configuration listed twice
+            if config_hash in render_hashes:
+                renders.append(renders[render_hashes[config_hash]])
+                continue
+            render_hashes[config_hash] = len(renders)
 
-            # Do rendering
-            renders = ink.render_layers(out_root,
-                                        format=self._img_format,
-                                        layer_configs=configs_to_render)
+            try:
+                renders.append(self._prefetched.pop(config_hash).result())
+                prefetched_files.append(renders[-1])
+            except KeyError:
+                if tmp_dir is None:
+                    out_file = None
+                else:
+                    out_file = os.path.join(tmp_dir,render_names[-1])
+                renders.append(self._render(ink,config,scale,config_hash,out_file))
+
+        # Optimize the new renders, all at once so they run in parallel
+        if tmp_dir is not None:
+
+            opt_dir = os.path.join(tmp_dir,"optimized")
+            os.mkdir(opt_dir)
+
+            # A configuration listed twice shares its render, so only
+            # optimize each output once
+            to_optimize = []
+            optimize_index = {}
+            which = []
+            for r in renders:
+                output_root = os.path.join(opt_dir,os.path.split(r)[1][:-4])
+                if output_root not in optimize_index:
+                    optimize_index[output_root] = len(to_optimize)
+                    to_optimize.append((r,output_root))
+                which.append(optimize_index[output_root])
+
+            optimized = self._optimizer.optimize_many(to_optimize)
+            renders = [optimized[i] for i in which]
         else:
-            renders = []
+            renders = [{self._img_format:r if isinstance(r,str) else (n,r)}
+                       for n, r in zip(render_names,renders)]
 
         # Now go through final_file_names.  Things that were rendered in
         # the past will have an actual file name.  Things we just
         # rendered will be None.  When we hit a None, grab the file from
         # the renders list and use the _copy_file method to copy it into
-        # the final output directory.  Finally, update the markdown
-        # with the final file name.
-
-        final_markdown = []
+        # the final output directory.
 
         new_render_counter = 0
         for i, out_file in enumerate(final_file_names):
             if out_file is None:
 
-                # Get the file out of the new renders
-                new_file = renders[new_render_counter]
-
-                # Copy the file from wherever it is in the filesystem to
-                # the appropriate output directory
-                out_file = self._copy_file(new_file)
+                # Get the files out of the new renders
+                new_files = renders[new_render_counter]
+
+                # Write renders held in memory, or copy files from wherever
+                # they are in the filesystem, to the appropriate output
+                # directory
+                out_file = {}
+                for fmt in self._formats:
+                    if isinstance(new_files[fmt],tuple):
+                        out_file[fmt] = self._write_data(new_files[fmt][1],
+                                                         new_files[fmt][0])
+                    else:
+                        out_file[fmt] = self._copy_file(new_files[fmt])
 
-                # Record that we rendered this file/config combo
-                key = (svg_file,configs_to_render[new_render_counter])
+                # Record that we rendered this configuration
+                key = configs_to_render[new_render_counter][2]
                 self._configs_rendered[key] = out_file
+                final_file_names[i] = out_file
 
                 # Update index to new renders
                 new_render_counter += 1
 
-            else:
-                self._output_files.append(out_file)
+            # Record that these files were processed, so they are written to
+            # the build manifest
+            for fmt in self._formats:
+                self._record_output(out_file[fmt],
+                                    build_key=self._get_build_key(config_hashes[i],fmt))
 
-            # Update markdown with the file
-            final_markdown.append("![an image]({})\n".format(out_file))
+        # Nuke temporary files
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+        for f in prefetched_files:
+            os.remove(f)
 
-            # Record that this file was processed
-            try:
-                this_processing[input_file_md5][layer_configs[i]] = out_file
-            except KeyError:
-                this_processing[input_file_md5] = {}
-                this_processing[input_file_md5][layer_configs[i]] = out_file
+        # Update markdown with the final file names, one line per
+        # configuration with all of its scales
+        final_markdown = []
+        if self._layer_stack:
 
-        # Nuke temporary files
-        shutil.rmtree(tmp_dir)
+            layer_renders = {}
+            for (layer, scale, config_hash), files in zip(units,final_file_names):
+                layer_renders.setdefault(layer,[]).append((scale,files))
 
-        # record whatever was processed in this_proc_dict so we can write
-        for k in this_processing.keys():
-            try:
-                self._this_proc_dict[k].update(this_processing[k])
-            except KeyError:
-                self._this_proc_dict[k] = copy.deepcopy(this_processing[k])
+            for config in layer_configs:
+                final_markdown.append(self._get_stack_markdown(ink,config,
+                                                               layer_renders))
+
+        else:
+
+            num_scales = len(self._scales)
+            for i in range(0,len(units),num_scales):
+                group = [(units[j][1],final_file_names[j])
+                         for j in range(i,i+num_scales)]
+                final_markdown.append(self._get_markdown(group))
 
         # If there is only one line to return, return as a string
         if len(final_markdown) == 1:
@@ -621,4 +2278,6 @@ class InkscapeProcessor(Processor):
         else:
             to_return = tuple(final_markdown)
 
+        self._release_svg(svg_file,ink)
+
         return to_return
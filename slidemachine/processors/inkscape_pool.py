@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Pool of long-lived inkscape processes driven through the inkscape shell.
+Starting inkscape is much slower than doing an export, so we keep a few
+inkscape processes around and feed them export commands for the whole build.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-16"
+
+from . import toolchain
+
+import os, subprocess, threading, queue, shlex, atexit
+
+# Endings of inkscape output that mean the shell is waiting for a command
+PROMPTS = (b"\n> ",b"\n>")
+
+class InkscapeWorkerError(Exception):
+    """
+    Raised when an inkscape shell process dies or stops responding.
+    """
+    pass
+
+class InkscapeWorker:
+    """
+    A single inkscape process running in shell mode.
+    """
+
+    def __init__(self,tools):
+        """
+        tools: InkscapeToolchain describing the inkscape binary to run.
+        """
+
+        self._tools = tools
+        self._use_new_cmd_line = tools.use_new_cmd_line
+        self._proc = None
+
+        self._start()
+
+    def _start(self):
+        """
+        Launch the inkscape shell and wait for its first prompt.
+        """
+
+        if self._use_new_cmd_line:
+            cmd = [self._tools.path,"--shell"]
+        else:
+            cmd = [self._tools.path,"-z","--shell"]
+
+        self._proc = subprocess.Popen(cmd,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        self._read_to_prompt()
+
+    def _read_to_prompt(self):
+        """
+        Read inkscape output until it prints its prompt, meaning it is ready
+        for the next command.  The prompt is ">" (old inkscape) or "> " at the
+        start of a line, with nothing after it.
+        """
+
+        fd = self._proc.stdout.fileno()
+
+        out = []
+        size = 0
+        tail = b""
+        while True:
+            chunk = os.read(fd,4096)
+            if chunk == b"":
+                err = "inkscape shell exited unexpectedly.\n"
+                raise InkscapeWorkerError(err)
+
+            out.append(chunk)
+            size += len(chunk)
+
+            # Last few bytes of the output, with a newline standing in for
+            # the start of the output
+            tail = (tail + chunk)[-3:]
+            if size == len(tail):
+                tail = b"\n" + tail
+
+            if tail.endswith(PROMPTS):
+                break
+
+        return b"".join(out).decode(errors="replace")
+
+    def _to_shell_line(self,args):
+        """
+        Convert a list of inkscape command line arguments (input file plus
+        --flags) into a single line the inkscape shell understands.
+        """
+
+        # Old inkscape shell takes command line arguments directly
+        if not self._use_new_cmd_line:
+            return " ".join([shlex.quote(a) for a in args])
+
+        # New inkscape shell takes actions.  Flags map onto actions with the
+        # same name (--export-type=png -> export-type:png).  Export options
+        # stick between commands in the shell, so the options that change
+        # from render to render are reset to inkscape's defaults first.
+        actions = ["export-width:0","export-dpi:0","export-id:",
+                   "export-id-only:false","export-area-page:false",
+                   "export-background-opacity:-1"]
+        for a in args:
+            if a.startswith("--"):
+                action = a[2:].replace("=",":",1)
+                if action.startswith("export-file:"):
+                    action = action.replace("export-file:","export-filename:",1)
+                actions.append(action)
+            else:
+                actions.insert(0,"file-open:{}".format(a))
+
+        actions.append("export-do")
+        actions.append("file-close")
+
+        return ";".join(actions)
+
+    def run(self,args):
+        """
+        Run a set of inkscape command line arguments in this shell.  If the
+        inkscape process has died, restart it and try again once.
+        """
+
+        line = self._to_shell_line(args)
+
+        for attempt in range(2):
+
+            try:
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+
+                self._proc.stdin.write("{}\n".format(line).encode())
+                self._proc.stdin.flush()
+
+                return self._read_to_prompt()
+
+            except (InkscapeWorkerError,BrokenPipeError,OSError):
+                self.close()
+                if attempt == 1:
+                    err = "inkscape shell failed running: {}\n".format(line)
+                    raise InkscapeWorkerError(err)
+
+    def close(self):
+        """
+        Shut down the inkscape process.
+        """
+
+        if self._proc is None:
+            return
+
+        try:
+            self._proc.stdin.write(b"quit\n")
+            self._proc.stdin.close()
+            self._proc.wait(timeout=5)
+        except (BrokenPipeError,OSError,subprocess.TimeoutExpired):
+            self._proc.kill()
+            self._proc.wait()
+
+        self._proc.stdout.close()
+        self._proc = None
+
+class InkscapePool:
+    """
+    Fixed-size pool of InkscapeWorker instances.  Workers are started lazily,
+    so a pool that is never used never launches inkscape.  Safe to use from
+    multiple threads.
+    """
+
+    def __init__(self,size=4):
+        """
+        size: maximum number of inkscape processes to run at once.
+        """
+
+        if size < 1:
+            err = "pool size must be at least 1\n"
+            raise ValueError(err)
+
+        self._size = size
+
+        self._idle = queue.Queue()
+        self._all_workers = []
+        self._lock = threading.Lock()
+
+        # Workers being started.  Inkscape is started outside of the lock, so
+        # several threads can start workers at once.
+        self._starting = 0
+
+    def _get_worker(self):
+        """
+        Grab an idle worker, starting a new one if the pool is not full yet.
+        Blocks until a worker is free.
+        """
+
+        with self._lock:
+
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            start_worker = len(self._all_workers) + self._starting < self._size
+            if start_worker:
+                self._starting += 1
+
+        if not start_worker:
+            return self._idle.get()
+
+        worker = None
+        try:
+            worker = InkscapeWorker(toolchain.get_toolchain())
+        finally:
+            with self._lock:
+                self._starting -= 1
+                if worker is not None:
+                    self._all_workers.append(worker)
+
+        return worker
+
+    def run(self,args):
+        """
+        Run a set of inkscape command line arguments on a free worker.
+        """
+
+        worker = self._get_worker()
+        try:
+            return worker.run(args)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        """
+        Shut down all inkscape processes.
+        """
+
+        with self._lock:
+            for w in self._all_workers:
+                w.close()
+            self._all_workers = []
+            self._idle = queue.Queue()
+
+    @property
+    def size(self):
+        return self._size
+
+    @size.setter
+    def size(self,size):
+        if size < 1:
+            err = "pool size must be at least 1\n"
+            raise ValueError(err)
+        self._size = size
+
+
+# Pool shared by every InkscapeSVG instance in this python process
+_shared_pool = None
+_shared_pool_size = 4
+
+def set_pool_size(size):
+    """
+    Set the number of inkscape processes in the shared pool.  A size of 0
+    turns the pool off, so each render launches its own inkscape process.
+    """
+
+    global _shared_pool_size
+
+    _shared_pool_size = int(size)
+
+    if _shared_pool is not None and _shared_pool_size > 0:
+        _shared_pool.size = _shared_pool_size
+
+def get_pool():
+    """
+    Return the shared InkscapePool, or None if the pool is turned off.
+    """
+
+    global _shared_pool
+
+    if _shared_pool_size < 1:
+        return None
+
+    if _shared_pool is None:
+        _shared_pool = InkscapePool(_shared_pool_size)
+
+    return _shared_pool
+
+def _close_shared_pool():
+    if _shared_pool is not None:
+        _shared_pool.close()
+
+atexit.register(_close_shared_pool)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Build manifest for a target directory.  Records what every processor wrote
+in the last build (and anything it learned about its inputs), so the next
+build can reuse it.  Stored as a small sqlite database that is read whole
+at the start of each build and updated in a single transaction at its end.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+import os, json, sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    processor TEXT NOT NULL,
+    build_key TEXT NOT NULL,
+    output_file TEXT NOT NULL,
+    PRIMARY KEY (processor,build_key)
+);
+CREATE TABLE IF NOT EXISTS files (
+    processor TEXT NOT NULL,
+    file_hash TEXT NOT NULL,
+    output_file TEXT NOT NULL,
+    PRIMARY KEY (processor,file_hash)
+);
+CREATE TABLE IF NOT EXISTS records (
+    processor TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (processor,key)
+);
+"""
+
+class BuildManifest:
+    """
+    Output files from the last build, indexed by processor and either build
+    key (i.e. the hash of an inkscape layer configuration) or the hash of the
+    file content.  Processors can also keep small json records (i.e. the
+    layers in an svg file) keyed however they like.
+
+    Each processor reads all of its entries at the start of a build (see
+    get_builds, get_files and get_records) and looks them up in memory, so
+    there are no lookups of single entries.
+    """
+
+    def __init__(self,db_file):
+        """
+        db_file: sqlite database holding the manifest.  Created if it does not
+                 exist.  A corrupt database is replaced with an empty one.
+        """
+
+        self._db_file = db_file
+
+        try:
+            self._create()
+        except sqlite3.DatabaseError:
+            os.remove(self._db_file)
+            self._create()
+
+    def _connect(self):
+        return sqlite3.connect(self._db_file)
+
+    def _create(self):
+
+        conn = self._connect()
+        try:
+            conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def _query(self,sql,args):
+
+        conn = self._connect()
+        try:
+            return conn.execute(sql,args).fetchall()
+        finally:
+            conn.close()
+
+    def get_builds(self,processor):
+        """
+        Return a dictionary mapping build keys to output files for processor.
+        """
+
+        rows = self._query("SELECT build_key, output_file FROM builds "
+                           "WHERE processor=?",(processor,))
+        return dict(rows)
+
+    def get_files(self,processor):
+        """
+        Return a dictionary mapping file hashes to output files for processor.
+        """
+
+        rows = self._query("SELECT file_hash, output_file FROM files "
+                           "WHERE processor=?",(processor,))
+        return dict(rows)
+
+    def get_records(self,processor):
+        """
+        Return a dictionary mapping keys to records for processor.
+        """
+
+        rows = self._query("SELECT key, value FROM records "
+                           "WHERE processor=?",(processor,))
+        return dict([(k,json.loads(v)) for k, v in rows])
+
+    def commit(self,entries):
+        """
+        Replace the records for a set of processors in one transaction.
+
+        entries: list of (processor,builds,files,records) tuples, where
+                 builds maps build keys to output files, files maps file
+                 hashes to output files and records maps keys to json-
+                 serializable records.
+        """
+
+        conn = self._connect()
+        try:
+            with conn:
+                for processor, builds, files, records in entries:
+                    conn.execute("DELETE FROM builds WHERE processor=?",
+                                 (processor,))
+                    conn.execute("DELETE FROM files WHERE processor=?",
+                                 (processor,))
+                    conn.execute("DELETE FROM records WHERE processor=?",
+                                 (processor,))
+                    conn.executemany("INSERT INTO builds VALUES (?,?,?)",
+                                     [(processor,k,v) for k, v in builds.items()])
+                    conn.executemany("INSERT INTO files VALUES (?,?,?)",
+                                     [(processor,k,v) for k, v in files.items()])
+                    conn.executemany("INSERT INTO records VALUES (?,?,?)",
+                                     [(processor,k,json.dumps(v))
+                                      for k, v in records.items()])
+        finally:
+            conn.close()
+
+    @property
+    def db_file(self):
+        return self._db_file
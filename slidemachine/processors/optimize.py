@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Optimization of rendered png files: lossless recompression, optional
+quantization and optional webp/avif variants.  Optimizing is slow and cpu
+bound, so it runs on a pool of processes.  Results are cached by the hash of
+the input file, so a render is only ever optimized once.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from .cache import RenderCache, get_cache_dir
+from .hashes import get_file_hash
+
+import os, shutil, struct, subprocess, zlib, threading, atexit, multiprocessing
+import warnings
+import concurrent.futures
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Variant formats, best compression first, and the program used to make each
+VARIANT_TOOLS = {"avif":"avifenc","webp":"cwebp"}
+VARIANT_ORDER = ("avif","webp")
+
+def _read_chunks(data):
+    """
+    Split the bytes of a png file into a list of (type,data) chunks.
+    """
+
+    if not data.startswith(PNG_SIGNATURE):
+        err = "not a png file\n"
+        raise ValueError(err)
+
+    chunks = []
+    i = len(PNG_SIGNATURE)
+    while i < len(data):
+        length, chunk_type = struct.unpack(">I4s",data[i:i+8])
+        chunks.append((chunk_type,data[i+8:i+8+length]))
+        i += 12 + length
+
+    return chunks
+
+def _write_chunk(f,chunk_type,chunk_data):
+    f.write(struct.pack(">I",len(chunk_data)))
+    f.write(chunk_type)
+    f.write(chunk_data)
+    f.write(struct.pack(">I",zlib.crc32(chunk_type + chunk_data) & 0xffffffff))
+
+def recompress_png(input_file,output_file):
+    """
+    Losslessly recompress a png file.  Uses oxipng or optipng if installed;
+    otherwise re-deflates the image data at maximum compression, trying a
+    few zlib strategies and keeping the smallest.  Never makes the file
+    bigger.
+    """
+
+    for tool, args in (("oxipng",["-o","4","--strip","safe","--out"]),
+                       ("optipng",["-o2","-quiet","-out"])):
+        path = shutil.which(tool)
+        if path is not None:
+            subprocess.check_call([path] + args + [output_file,input_file],
+                                  stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL)
+            return
+
+    data = open(input_file,"rb").read()
+    chunks = _read_chunks(data)
+
+    raw = zlib.decompress(b"".join([c[1] for c in chunks if c[0] == b"IDAT"]))
+
+    best = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY,zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9,zlib.DEFLATED,15,9,strategy)
+        compressed = compressor.compress(raw) + compressor.flush()
+        if best is None or len(compressed) < len(best):
+            best = compressed
+
+    f = open(output_file,"wb")
+    f.write(PNG_SIGNATURE)
+    wrote_idat = False
+    for chunk_type, chunk_data in chunks:
+        if chunk_type == b"IDAT":
+            if not wrote_idat:
+                _write_chunk(f,b"IDAT",best)
+                wrote_idat = True
+            continue
+        _write_chunk(f,chunk_type,chunk_data)
+    f.close()
+
+    if os.path.getsize(output_file) >= len(data):
+        shutil.copy(input_file,output_file)
+
+def quantize_png(input_file,output_file):
+    """
+    Reduce a png to a 256 color palette with pngquant.  Writes nothing if
+    this would not make the file smaller.
+    """
+
+    cmd = [shutil.which("pngquant"),"--force","--skip-if-larger",
+           "--quality=70-95","--output",output_file,input_file]
+    ret = subprocess.call(cmd,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+    # 98 and 99 mean the result would be bigger or worse than allowed, so
+    # pngquant wrote nothing
+    if ret not in (0,98,99):
+        raise subprocess.CalledProcessError(ret,cmd)
+
+def make_variant(input_file,output_file,variant):
+    """
+    Write a webp or avif version of a png file.
+    """
+
+    if variant == "webp":
+        cmd = [shutil.which("cwebp"),"-quiet","-q","90",input_file,"-o",output_file]
+    else:
+        cmd = [shutil.which("avifenc"),input_file,output_file]
+
+    subprocess.check_call(cmd,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL)
+
+def _optimize(input_file,output_root,quantize,variants):
+    """
+    Optimize a single png.  Runs in a worker process.  Returns a dictionary
+    mapping format (png, webp, avif) to output file.
+    """
+
+    out = {"png":"{}.png".format(output_root)}
+
+    if quantize:
+        quantize_png(input_file,out["png"])
+
+        # pngquant leaves no file if quantizing would make it bigger
+        if os.path.isfile(out["png"]):
+            input_file = out["png"]
+
+    tmp_file = "{}.tmp.png".format(output_root)
+    recompress_png(input_file,tmp_file)
+    os.replace(tmp_file,out["png"])
+
+    for v in variants:
+        out[v] = "{}.{}".format(output_root,v)
+        make_variant(out["png"],out[v],v)
+
+    return out
+
+
+# Pool of processes shared by every ImageOptimizer in this python process
+_shared_pool = None
+_shared_pool_jobs = None
+_shared_pool_lock = threading.Lock()
+
+def _get_pool(jobs):
+    """
+    Return the shared pool of jobs processes, replacing the pool if it was
+    made with a different number of processes.  Work already sent to a
+    replaced pool still finishes.  Processes are spawned rather than forked,
+    as forking while inkscape and prefetch threads are running can deadlock
+    the children.
+    """
+
+    global _shared_pool, _shared_pool_jobs
+
+    with _shared_pool_lock:
+
+        if _shared_pool is not None and _shared_pool_jobs != jobs:
+            _shared_pool.shutdown(wait=False)
+            _shared_pool = None
+
+        if _shared_pool is None:
+            context = multiprocessing.get_context("spawn")
+            _shared_pool = concurrent.futures.ProcessPoolExecutor(jobs,
+                                                                  mp_context=context)
+            _shared_pool_jobs = jobs
+
+    return _shared_pool
+
+def _close_shared_pool():
+    if _shared_pool is not None:
+        _shared_pool.shutdown(wait=True)
+
+atexit.register(_close_shared_pool)
+
+class ImageOptimizer:
+    """
+    Optimize png files on a pool of processes, caching the results by the
+    hash of the input file.  Safe to use from multiple threads.
+    """
+
+    def __init__(self,quantize=False,variants=(),jobs=None,cache_dir=None,
+                 cache_size=1024):
+        """
+        quantize: reduce images to a 256 color palette (lossy; needs pngquant)
+        variants: list of extra formats to write ("webp" needs cwebp, "avif"
+                  needs avifenc)
+        jobs: number of processes to optimize with.  If None, use the number
+              of cpus.
+        cache_dir: directory to cache optimized files.  If None, use
+                   "optimized" in the user-level slidemachine cache directory.
+        cache_size: maximum size of the cache in MB
+        """
+
+        if quantize and shutil.which("pngquant") is None:
+            err = "quantize requires pngquant, which was not found.\n"
+            raise FileNotFoundError(err)
+
+        for v in variants:
+            if v not in VARIANT_TOOLS:
+                err = "variant {} not recognized. Should be one of:\n".format(v)
+                err += "".join(["    {}\n".format(k) for k in VARIANT_ORDER])
+                raise ValueError(err)
+
+            if shutil.which(VARIANT_TOOLS[v]) is None:
+                err = "{} variants require {}, which was not found.\n".format(v,VARIANT_TOOLS[v])
+                raise FileNotFoundError(err)
+
+        self._quantize = bool(quantize)
+        self._variants = tuple([v for v in VARIANT_ORDER if v in variants])
+
+        if jobs is None:
+            jobs = os.cpu_count()
+        self._jobs = jobs
+
+        # Without a usable cache directory, optimize without the cache
+        self._cache = None
+        try:
+            if cache_dir is None:
+                cache_dir = os.path.join(get_cache_dir(),"optimized")
+            self._cache = RenderCache(cache_dir,cache_size)
+        except OSError as e:
+            warnings.warn("optimizer cache turned off: {}".format(e))
+
+    def _get_key(self,input_file):
+        if self._cache is None:
+            return None
+        return self._cache.get_key(get_file_hash(input_file),self._quantize,
+                                   self._variants)
+
+    def _from_cache(self,key,output_root):
+        """
+        Pull the optimized files for key out of the cache.  Returns None if
+        any are missing.
+        """
+
+        if self._cache is None:
+            return None
+
+        out = {}
+        for fmt in ("png",) + self._variants:
+            out[fmt] = "{}.{}".format(output_root,fmt)
+            if not self._cache.get(key,out[fmt]):
+                return None
+
+        return out
+
+    def optimize_many(self,to_optimize):
+        """
+        Optimize a list of (input_file,output_root) pairs in parallel. Returns
+        a list of dictionaries mapping format (png, webp, avif) to the
+        optimized file, which is output_root plus the format extension.
+        """
+
+        results = [None for _ in to_optimize]
+        futures = {}
+
+        for i, (input_file, output_root) in enumerate(to_optimize):
+
+            key = self._get_key(input_file)
+            results[i] = self._from_cache(key,output_root)
+            if results[i] is not None:
+                continue
+
+            pool = _get_pool(self._jobs)
+            futures[i] = (key,pool.submit(_optimize,input_file,output_root,
+                                          self._quantize,self._variants))
+
+        for i in futures:
+            key, future = futures[i]
+            results[i] = future.result()
+            if self._cache is None:
+                continue
+            for fmt in results[i]:
+                self._cache.put(key,results[i][fmt])
+
+        return results
+
+    def optimize(self,input_file,output_root):
+        """
+        Optimize a single png.  Returns a dictionary mapping format (png,
+        webp, avif) to the optimized file.
+        """
+
+        return self.optimize_many([(input_file,output_root)])[0]
+
+    @property
+    def signature(self):
+        """
+        Settings that change what the optimizer writes.
+        """
+
+        return ["optimize",self._quantize,list(self._variants)]
+
+    @property
+    def variants(self):
+        return self._variants
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Figure out what the installed inkscape can do.  The probe launches inkscape
+a couple of times, so the result is remembered for the rest of the build and
+cached on disk, keyed by the path and modification time of the binary.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-16"
+
+from .cache import get_cache_dir
+
+import os, re, json, shutil, subprocess, threading
+
+class InkscapeToolchain:
+    """
+    Capabilities of an inkscape binary.
+    """
+
+    def __init__(self,path,version,flags):
+        """
+        path: full path to the inkscape binary
+        version: version string reported by inkscape --version (i.e. 1.2.2)
+        flags: list of command line flags listed by inkscape --help
+        """
+
+        self._path = path
+        self._version = version
+        self._flags = set(flags)
+
+    def supports(self,flag):
+        """
+        Whether inkscape knows the command line flag (i.e. "--export-dpi").
+        """
+
+        return flag in self._flags
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def flags(self):
+        return sorted(self._flags)
+
+    @property
+    def use_new_cmd_line(self):
+        """
+        Whether inkscape uses the 1.x command line syntax.
+        """
+
+        return self._version.startswith("1.")
+
+    @property
+    def export_filename_flag(self):
+        """
+        Flag used to give the output file in the 1.x command line syntax.
+        """
+
+        if self.supports("--export-filename"):
+            return "--export-filename"
+        return "--export-file"
+
+    @property
+    def supports_shell(self):
+        return self.supports("--shell")
+
+    @property
+    def supports_pipe(self):
+        """
+        Whether inkscape can read svg from stdin and write to stdout.
+        """
+
+        return self.supports("--pipe") and self.supports("--export-filename")
+
+
+def _probe(path):
+    """
+    Run inkscape to find its version and command line flags.
+    """
+
+    result = subprocess.check_output([path,"--version"],
+                                     stderr=subprocess.DEVNULL)
+    version = result.split()[1].decode()
+
+    try:
+        result = subprocess.check_output([path,"--help"],
+                                         stderr=subprocess.STDOUT)
+        result = result.decode(errors="replace")
+    except subprocess.CalledProcessError as e:
+        result = e.output.decode(errors="replace")
+
+    flags = sorted(set(re.findall("--[a-z][a-z0-9-]*",result)))
+
+    return version, flags
+
+
+# Toolchain for this python process, along with the key it was probed with
+_toolchain = None
+_toolchain_key = None
+_toolchain_lock = threading.Lock()
+
+def get_toolchain(binary="inkscape"):
+    """
+    Return an InkscapeToolchain describing the inkscape binary, probing it
+    only if it has not been seen before.
+    """
+
+    global _toolchain, _toolchain_key
+
+    path = shutil.which(binary)
+    if path is None:
+        err = "inkscape binary ({}) not found.\n".format(binary)
+        raise FileNotFoundError(err)
+
+    path = os.path.realpath(path)
+    key = "{}:{}".format(path,os.stat(path).st_mtime_ns)
+
+    with _toolchain_lock:
+
+        if _toolchain is not None and _toolchain_key == key:
+            return _toolchain
+
+        # Look for a previous probe of this exact binary on disk.  The cache
+        # file is optional: without a usable cache directory, probe every
+        # time.
+        try:
+            cache_file = os.path.join(get_cache_dir(),"toolchain.json")
+        except OSError:
+            cache_file = None
+
+        cached = {}
+        if cache_file is not None:
+            try:
+                cached = json.load(open(cache_file,'r'))
+            except (OSError,ValueError):
+                pass
+
+        try:
+            version = cached[key]["version"]
+            flags = cached[key]["flags"]
+        except (KeyError,TypeError):
+            version, flags = _probe(path)
+
+            cached[key] = {"version":version,"flags":flags}
+
+            if cache_file is not None:
+                tmp_file = "{}.{}".format(cache_file,os.getpid())
+                try:
+                    f = open(tmp_file,'w')
+                    json.dump(cached,f)
+                    f.close()
+                    os.replace(tmp_file,cache_file)
+                except OSError:
+                    pass
+
+        _toolchain = InkscapeToolchain(path,version,flags)
+        _toolchain_key = key
+
+    return _toolchain
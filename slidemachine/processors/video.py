@@ -27,6 +27,7 @@ class VideoProcessor(Processor):
 
         video_file, args = self._parse_markdown_line(line,delim=None)
 
+        self._record_input(video_file)
         new_file = self._copy_file(video_file)
 
         if args is not None:
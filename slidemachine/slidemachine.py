@@ -7,9 +7,13 @@ __date__ = "2018-05-09"
 __usage__ = ""
 
 from . import processors
+from .processors import hashes
+from .processors.cache import get_cache_dir, RenderCache
+from .processors.manifest import BuildManifest
 
 import mistune
-import sys, re, copy, os, json, shutil
+import sys, re, copy, os, json, shutil, time, traceback, hashlib, itertools
+import concurrent.futures, collections
 
 class SlideMachineError(Exception):
     """
@@ -17,92 +21,250 @@ class SlideMachineError(Exception):
     """
     pass
 
+class Dispatcher:
+    """
+    Run lines through a list of processors in a single pass.  Each processor
+    can name a literal trigger (i.e. "![sm") that a line must contain for the
+    processor to change it.  The triggers are combined into one regular
+    expression, so most lines are handed back after a single search without
+    any processor seeing them.  Lines that match go through every processor
+    whose trigger they contain, in processor order.
+    """
+
+    def __init__(self,processors):
+        """
+        processors: list of Processor instances, in the order they should be
+                    applied.
+        """
+
+        self._processors = list(processors)
+        self._triggers = [p.trigger for p in self._processors]
+
+        # If any processor needs to see every line, every line has to go
+        # through the processors.
+        if None in self._triggers or len(self._triggers) == 0:
+            self._matcher = None
+        else:
+            triggers = sorted(set(self._triggers))
+            self._matcher = re.compile("|".join([re.escape(t) for t in triggers]))
+
+    def process(self,line):
+        """
+        Apply the processors to a line.  Returns a list of the resulting lines
+        (more than one if a processor expanded the line into multiple sub
+        slides) and a list of the indexes of the processors that expanded it.
+        """
+
+        if self._matcher is not None and self._matcher.search(line) is None:
+            return [line], []
+
+        lines = [line]
+        expanded_by = []
+        for i, processor in enumerate(self._processors):
+
+            trigger = self._triggers[i]
+
+            new_lines = []
+            for l in lines:
+
+                if trigger is not None and trigger not in l:
+                    new_lines.append(l)
+                    continue
+
+                new_line = processor.process(l)
+                if type(new_line) is tuple:
+                    new_lines.extend(new_line)
+                    if i not in expanded_by:
+                        expanded_by.append(i)
+                else:
+                    new_lines.append(new_line)
+
+            lines = new_lines
+
+        return lines, expanded_by
+
+    @property
+    def processors(self):
+        return self._processors
+
 class Slide:
     """
     Hold a representation of a single markdown slide.  This may consist of
     multiple sub-slides generated by processors.
+
+    Each sub-slide is a tuple of segments, each of which is a tuple of lines.
+    When a line expands into several sub-slides, the new sub-slides share the
+    segments before and after that line and differ only in a one-line
+    segment holding the expanded line.  Nothing is copied.
     """
 
+    __slots__ = ["_slide_lines","_sub_slides","_override_transition",
+                 "_records","_html","_processed"]
+
     def __init__(self,slide_lines):
         """
         slide_lines: list of lines that constitute a slide.
         """
 
-        self._slide_lines = copy.deepcopy(slide_lines)
-        self._sub_slides = [copy.deepcopy(self._slide_lines)]
+        self._slide_lines = tuple(slide_lines)
+        self._sub_slides = ((self._slide_lines,),)
 
         # Whether or not to override the default transition with "none".
         # Gets set to "True" when the slide expands into multiple sub-slides
         self._override_transition = False
 
-    def apply(self,processor):
+        # Files read and written by each processor for this slide. Keys are
+        # processor names.
+        self._records = {}
+
+        # html is generated once, the first time it is requested
+        self._html = None
+
+        # Set to True once every processor has been applied
+        self._processed = False
+
+    def dispatch(self,dispatcher):
         """
-        Apply an instance of a subclass of Processor to each line in the slide.
+        Apply every processor in a Dispatcher to each line in the slide in a
+        single pass.  Gives the same sub-slides as applying each processor in
+        turn to the whole slide.
         """
 
-        processor_expanded_slide = False
+        processors = dispatcher.processors
+        for processor in processors:
+            processor.start_slide()
+        try:
+            self._dispatch(dispatcher)
+        finally:
+            for processor in processors:
+                self._records[processor.name] = processor.end_slide()
 
-        new_sub_slides = []
-        for sub_slide in self._sub_slides:
+        self._html = None
+
+    def _dispatch(self,dispatcher):
+        """
+        Run each line in the slide through dispatcher.
+        """
 
-            expanded_line = -1
+        # Unexpanded lines, grouped into the segments between expanded lines
+        segments = []
+        current = []
 
-            new_lines = []
-            for i, line in enumerate(sub_slide):
+        # (index of first processor that expanded it, lines) for each line
+        # that expanded
+        expanded = []
 
-                # Process the line.  If the processor does nothing, it returns the
-                # input line.  If it did something somewhat interesting, the line will
-                # be slightly different than input.  If it interprets the input line
-                # as creating multiple other slidies, it will return a tuple of lines.
-                new_line = processor.process(line)
+        expanded_by_processor = set()
+        for line in self._slide_lines:
 
-                new_lines.append(new_line)
+            new_lines, expanded_by = dispatcher.process(line)
+            if len(expanded_by) == 0:
+                current.append(new_lines[0])
+                continue
 
-                # new_line will be a tuple if the processor has broken the one initial
-                # slide into multiple sub_slides
-                if type(new_line) is tuple:
+            for i in expanded_by:
 
-                    if expanded_line >= 0:
-                        err =  "Error in {}.".format(processor)
-                        err += "A slide cannot contain more than one tag of the same "
-                        err += "type that expand into multiple slides.\n\n"
-                        err += "Offending slide:\n\n"
-                        err += "".join(self._slide_lines)
+                if i in expanded_by_processor:
+                    err =  "Error in {}.".format(dispatcher.processors[i])
+                    err += "A slide cannot contain more than one tag of the same "
+                    err += "type that expand into multiple slides.\n\n"
+                    err += "Offending slide:\n\n"
+                    err += "".join(self._slide_lines)
 
-                        raise SlideMachineError(err)
+                    raise SlideMachineError(err)
 
-                    processor_expanded_slide = True
-                    expanded_line = i
+                expanded_by_processor.add(i)
 
-            # If the slide was expanded, append multiple new sub_slides
-            if expanded_line >= 0:
+            segments.append(tuple(current))
+            current = []
+            expanded.append((expanded_by[0],new_lines))
 
-                # Break slide in half at the expanded line
-                first_half = new_lines[:expanded_line]
-                second_half = new_lines[(expanded_line+1):]
+        segments.append(tuple(current))
 
-                # Now build a new sub_slide for each rendered file
-                for i, t in enumerate(new_lines[expanded_line]):
-                    out = copy.deepcopy(first_half)
-                    out.append(t)
-                    out.extend(second_half)
+        if len(expanded) == 0:
+            self._sub_slides = ((segments[0],),)
+            return
 
-                    new_sub_slides.append(out)
+        # Sub-slides are ordered as they would be if each processor were
+        # applied to the whole slide in turn: the expansion from the first
+        # processor varies slowest.
+        order = sorted(range(len(expanded)),key=lambda k: expanded[k][0])
 
-            # No expansion, just record the lines as a single slide
-            else:
-                new_sub_slides.append(new_lines)
+        new_sub_slides = []
+        for choice in itertools.product(*[expanded[k][1] for k in order]):
 
-        # Record the final result in the sub_slides attribute
-        self._sub_slides = copy.deepcopy(new_sub_slides)
+            chosen = [None for _ in expanded]
+            for k, line in zip(order,choice):
+                chosen[k] = line
 
-        if processor_expanded_slide:
-            self._override_transition = True
+            sub_slide = [segments[0]]
+            for k in range(len(expanded)):
+                sub_slide.append((chosen[k],))
+                sub_slide.append(segments[k+1])
+
+            new_sub_slides.append(tuple([seg for seg in sub_slide
+                                         if len(seg) > 0]))
+
+        self._sub_slides = tuple(new_sub_slides)
+        self._override_transition = True
+
+    def load_cached(self,html,records):
+        """
+        Fill in a slide from the slide cache: its final html and the records
+        of the files processors used for it.
+        """
+
+        self._html = html
+        self._records = copy.deepcopy(records)
+        self._processed = True
+
+    def restore(self,processors):
+        """
+        Tell processors about the files this slide used when it was
+        processed, without processing it again.
+        """
+
+        for processor in processors:
+            try:
+                processor.restore_slide(self._records[processor.name])
+            except KeyError:
+                pass
 
     @property
     def markdown(self):
         return "".join(self._slide_lines)
 
+    @property
+    def processed(self):
+        """
+        Whether every processor has been applied to this slide.
+        """
+
+        return self._processed
+
+    @processed.setter
+    def processed(self,processed):
+        self._processed = bool(processed)
+
+    @property
+    def records(self):
+        """
+        Files read and written by each processor for this slide.
+        """
+
+        return self._records
+
+    @property
+    def inputs(self):
+        """
+        Set of files read by processors while processing this slide.
+        """
+
+        inputs = set()
+        for record in self._records.values():
+            inputs.update(record["inputs"])
+
+        return inputs
 
     @property
     def html(self):
@@ -111,6 +273,9 @@ class Slide:
         compatible html.
         """
 
+        if self._html is not None:
+            return self._html
+
         markdown = mistune.Markdown()
 
         # Construct html, with each subslide separted by <section>
@@ -126,7 +291,7 @@ class Slide:
             else:
                 start = "<section>\n"
 
-            middle = markdown("".join(s))
+            middle = markdown("".join(itertools.chain.from_iterable(s)))
 
             middle = middle.split("\n")
             middle = "".join(["  {:}\n".format(m) for m in middle])
@@ -136,7 +301,9 @@ class Slide:
 
             out.append("{}{}{}".format(start,middle,end))
 
-        return "".join(out)
+        self._html = "".join(out)
+
+        return self._html
 
 class SlideMachine:
     """
@@ -145,7 +312,7 @@ class SlideMachine:
     """
 
     def __init__(self,md_file,json_file=None,target_dir=None,force=False,
-                 wipe=False):
+                 wipe=False,jobs=1,stream=False):
         """
         md_file: markdown file to be processed
         json_file: json file with configuration information.  If None, a
@@ -155,6 +322,11 @@ class SlideMachine:
         force: overwrite existing html file
         wipe: delete slidemachine output directories, such that all files must
               be rewritten from scratch
+        jobs: number of renders to run in parallel
+        stream: read, process and write one slide at a time rather than
+                holding the whole deck in memory.  Memory use is bounded by
+                the largest slide.  The slide cache and watch mode are not
+                used when streaming.
         """
 
         self._md_file = md_file
@@ -162,12 +334,35 @@ class SlideMachine:
         self._target_dir = target_dir
         self._force = force
         self._wipe = wipe
+        self._jobs = jobs
+        self._stream = stream
 
         self._slide_break = ">>>"
+        self._slide_cache_json = "slide-cache.json"
+        self._manifest_name = "build-manifest.db"
+
+        # Size (MB) and age (days) limits of the stale render area kept for
+        # each target directory.  A size of 0 turns it off.
+        self._stale_size = 256
+        self._stale_max_age = 30
+        self._file_hashes_json = "file-hashes.json"
+        self._hash_algorithm = "md5"
+
+        self._display_size = (960,700)
+
+        # Contents of each template and where its slides go, keyed by
+        # template file.  Kept across rebuilds in watch mode.
+        self._reveal_entries = {}
 
         self._load_json()
         self._prep_target_dirs()
-        self._read_md_file()
+
+        # In streaming mode, the markdown is read as it is processed
+        if self._stream:
+            self._md_file_content = []
+            self._slides = []
+        else:
+            self._read_md_file()
 
     def _load_json(self):
         """
@@ -184,6 +379,12 @@ class SlideMachine:
         # Read json file
         json_input = json.load(open(self._json_file,'r'))
 
+        # Processor settings.  Cached slides are only valid for the same
+        # settings.
+        self._processor_config = json.dumps([json_input.get("processors",{}),
+                                             self._target_dir],
+                                            sort_keys=True)
+
         # Try to parse a "processors" key, which indicates which processors
         # to use
         self._processors = []
@@ -212,11 +413,16 @@ class SlideMachine:
         except KeyError:
             pass
 
+        # Single-pass dispatch of lines to processors
+        self._dispatcher = Dispatcher(self._processors)
+
         # Remaining keys should set attributes of this class
         for key in json_input:
             new_key = "_{}".format(key)
             setattr(self,new_key,json_input[key])
 
+        hashes.set_hash_algorithm(self._hash_algorithm)
+
     def _prep_target_dirs(self):
         """
         Set up target directories.  Depending on user options, this will
@@ -227,61 +433,109 @@ class SlideMachine:
         """
 
         self._prev_proc = []
-        self._existing_files = []
+        self._existing_files = set()
 
-        # Go through each processor
+        # Group processors by target directory, keeping the order in which
+        # directories first appear
+        self._target_groups = []
         for p in self._processors:
+            for target_dir, group in self._target_groups:
+                if target_dir == p.target_dir:
+                    group.append(p)
+                    break
+            else:
+                self._target_groups.append((p.target_dir,[p]))
 
-            # Key for looking up processor in prev-build.json
-            processor_name = p.name
+        # Each target directory has one build manifest and is scanned once
+        self._manifests = {}
+        for target_dir, group in self._target_groups:
 
             # Either make the output directory, nuke the old version and remake
             # or leave alone
-            if os.path.isdir(p.target_dir):
+            if os.path.isdir(target_dir):
                 if self._wipe:
-                    shutil.rmtree(p.target_dir)
-                    os.mkdir(p.target_dir)
+                    shutil.rmtree(target_dir)
+                    os.mkdir(target_dir)
             else:
-                os.mkdir(p.target_dir)
-
-            # Read a json file that indicates what has been done previously
-            try:
-                prev_json = json.load(open(p.prev_build_json,'r'))
-                prev_proc = prev_json[processor_name]
-
-                p.add_previous_build_information(prev_proc)
-
-            except (FileNotFoundError,KeyError):
-                pass
-
-            # Record all files in the directory
-            existing_files = [os.path.join(p.target_dir,f)
-                              for f in os.listdir(p.target_dir)]
+                os.mkdir(target_dir)
+
+            # Renders no longer used by the deck are kept in the user cache
+            # directory, not the target directory.  If there is no usable
+            # cache directory, they are simply deleted.
+            stale_store = None
+            if self._stale_size > 0:
+                try:
+                    stale_dir = os.path.abspath(target_dir).encode()
+                    stale_dir = hashlib.md5(stale_dir).hexdigest()
+                    stale_dir = os.path.join(get_cache_dir(),"stale",stale_dir)
+                    if self._wipe and os.path.isdir(stale_dir):
+                        shutil.rmtree(stale_dir)
+
+                    stale_store = RenderCache(stale_dir,self._stale_size,
+                                              self._stale_max_age)
+                except OSError:
+                    stale_store = None
+
+            for p in group:
+                p.stale_store = stale_store
+
+            manifest_file = os.path.join(target_dir,self._manifest_name)
+            manifest = BuildManifest(manifest_file)
+            self._manifests[target_dir] = manifest
+
+            # Load what has been done previously
+            for p in group:
+
+                prev_builds = manifest.get_builds(p.name)
+                prev_files = manifest.get_files(p.name)
+                prev_records = manifest.get_records(p.name)
+
+                # Fall back on json written by older versions.  It is deleted
+                # as a leftover file at the end of the build.
+                if len(prev_builds) == 0 and len(prev_files) == 0:
+                    try:
+                        prev_builds = json.load(open(p.prev_build_json,'r'))[p.name]
+                    except (FileNotFoundError,ValueError,KeyError):
+                        pass
+
+                p.add_previous_build_information(prev_builds,prev_files,
+                                                 prev_records)
+
+            # Record all files in the directory, except the manifest itself
+            for entry in os.scandir(target_dir):
+                if not entry.name.startswith(self._manifest_name):
+                    self._existing_files.add(entry.path)
+
+        # Read the slide cache, which lives in the first target directory
+        self._slide_cache = {}
+        self._slide_cache_file = None
+        if len(self._processors) > 0:
+            self._slide_cache_file = os.path.join(self._processors[0].target_dir,
+                                                  self._slide_cache_json)
+            self._existing_files.discard(self._slide_cache_file)
 
-            # Make sure this does not have prev-build.json.  (If it did, we
-            # would delete it later as a leftover file)
             try:
-                existing_files.remove(p.prev_build_json)
-            except ValueError:
+                self._slide_cache = json.load(open(self._slide_cache_file,'r'))
+            except (FileNotFoundError,ValueError):
                 pass
 
-            self._existing_files.extend(existing_files)
-
-        # Set of all files already present in output directory(s)
-        self._existing_files = set(self._existing_files)
+        # Hashes of the files used in the last build, so unchanged files are
+        # not read again.  Lives next to the slide cache.
+        self._file_hashes_file = None
+        if len(self._processors) > 0:
+            self._file_hashes_file = os.path.join(self._processors[0].target_dir,
+                                                  self._file_hashes_json)
+            self._existing_files.discard(self._file_hashes_file)
 
-        # Remove any previous build information
-        for p in self._processors:
-            try:
-                os.remove(p.prev_build_json)
-            except FileNotFoundError:
-                pass
+            hashes.get_hash_cache().load(self._file_hashes_file)
 
-    def _read_md_file(self):
+    def _read_md_file(self,reusable=None):
         """
         Read a markdown file, looking for a pattern that breaks markdown
         into slides.  Populates self._slides with a Slide instance for
         each slide.
+
+        reusable: see _split_slides
         """
 
         # Read contents of md file as a set of lines
@@ -293,6 +547,27 @@ class SlideMachine:
             err = "No markdown file specified.\n"
             raise ValueError(err)
 
+        self._split_slides(reusable)
+
+    def _split_slides(self,reusable=None):
+        """
+        Break the markdown into slides, populating self._slides.
+
+        reusable: dictionary keyed by slide markdown whose values are lists
+                  of Slide instances that were already processed.  Slides
+                  with matching markdown are taken from here rather than
+                  created from scratch.
+        """
+
+        if reusable is None:
+            reusable = {}
+
+        def make_slide(slide_content):
+            try:
+                return reusable["".join(slide_content)].pop(0)
+            except (KeyError,IndexError):
+                return Slide(slide_content)
+
         # pattern for slide break
         slide_break = re.compile(self._slide_break)
 
@@ -302,76 +577,460 @@ class SlideMachine:
         for line in self._md_file_content:
 
             if slide_break.search(line):
-                self._slides.append(Slide(slide_content))
+                self._slides.append(make_slide(slide_content))
                 slide_content = []
             else:
                 slide_content.append(line)
-        self._slides.append(Slide(slide_content))
+        self._slides.append(make_slide(slide_content))
+
+    def _iter_slides(self):
+        """
+        Read the markdown file, yielding a Slide instance for each slide as
+        soon as it has been read.
+        """
+
+        if self._md_file is None:
+            err = "No markdown file specified.\n"
+            raise ValueError(err)
+
+        # pattern for slide break
+        slide_break = re.compile(self._slide_break)
 
+        slide_content = []
+        with open(self._md_file,'r') as lines:
+            for line in lines:
+
+                if slide_break.search(line):
+                    yield Slide(slide_content)
+                    slide_content = []
+                else:
+                    slide_content.append(line)
+
+        yield Slide(slide_content)
+
+    def _find_reveal_split(self,content):
+        """
+        Find where slides go in the contents of a reveal html file: just after
+        the first tag with the attribute class="slides".
 
-    def _merge_with_reveal_file(self,reveal_file):
+        Returns the index at which to split content, the indentation for the
+        slides, and the whitespace that starts the html after the slides.
+        """
+
+        m = re.search("class=\"slides\"",content)
+        if m is None:
+            err = "Template has no element with class=\"slides\".\n"
+            raise ValueError(err)
+
+        # Line holding the slides tag
+        line_start = content.rfind("\n",0,m.start()) + 1
+        line_end = content.find("\n",m.end())
+        if line_end == -1:
+            line_end = len(content)
+        else:
+            line_end += 1
+        l = content[line_start:line_end]
+
+        attrib_end = m.end() - line_start
+        end_of_tag = re.search(">",l[attrib_end:])
+        if end_of_tag is None:
+            err = "Could not find the end of the class=\"slides\" tag.\n"
+            raise ValueError(err)
+
+        split = line_start + attrib_end + end_of_tag.end()
+        indent = (len(l) - len(l.lstrip()) + 2)*" "
+        bottom_pad = (len(l) - len(l.strip()))*" "
+
+        return split, indent, bottom_pad
+
+    def _find_reveal_size(self,content):
+        """
+        Find the width and height of the slides set in Reveal.initialize in
+        the contents of a reveal html file.  Falls back on the reveal.js
+        defaults (960x700).
+        """
+
+        size = [960,700]
+
+        m = re.search(r"Reveal\.initialize",content)
+        if m is None:
+            return size
+
+        for i, dim in enumerate(["width","height"]):
+            value = re.search(r"{}\s*:\s*(\d+)\s*[,}}\n]".format(dim),content[m.end():])
+            if value is not None:
+                size[i] = int(value.group(1))
+
+        return size
+
+    def _get_reveal_entry(self,reveal_file):
+        """
+        Return the contents of reveal_file and a dictionary describing it:
+        where the slides go and the size of the slides.  Both are kept for
+        the session and keyed by the modification time, size and md5 of the
+        file, so the file is only read again when it is touched and only
+        searched again when it changes.
+        """
+
+        key = os.path.abspath(reveal_file)
+        stat = os.stat(reveal_file)
+        stamp = (stat.st_mtime_ns,stat.st_size)
+
+        cached = self._reveal_entries.get(key,None)
+        if cached is not None and cached["stamp"] == stamp:
+            return cached["content"], cached["entry"]
+
+        with open(reveal_file,"r") as f:
+            content = f.read()
+
+        # Touched but not changed; only the stamp needs updating
+        file_hash = hashlib.md5(content.encode()).hexdigest()
+        if cached is not None and cached["md5"] == file_hash:
+            entry = cached["entry"]
+        else:
+            split, indent, bottom_pad = self._find_reveal_split(content)
+            entry = {"split":split,"indent":indent,"bottom_pad":bottom_pad,
+                     "size":self._find_reveal_size(content)}
+
+        self._reveal_entries[key] = {"stamp":stamp,"md5":file_hash,
+                                     "content":content,"entry":entry}
+
+        return content, entry
+
+    def _read_reveal_file(self,reveal_file):
         """
         reveal_file: an html_file with a tag that has has the slides
         class.
 
-        Returns the current html constructed from the markdown inserted
-        in the "slides" div.
+        Returns the html before the slides, the indentation for the slides
+        and the html after the slides.
         """
 
-        # Read in a reveal html file, breaking at first tag with the attribute
-        # class="slides".  Populate reveal_top and reveal_bottom.
-        # Slide content will be inserted between these blocks.
+        content, entry = self._get_reveal_entry(reveal_file)
 
-        search_pattern = re.compile("class=\"slides\"")
+        split = entry["split"]
 
-        filling_top = True
-        top = []
-        bottom = []
-        with open(reveal_file,"r") as lines:
-            for l in lines:
+        reveal_top = "{}\n\n".format(content[:split])
+        reveal_bottom = "\n{}{}".format(entry["bottom_pad"],content[split:])
 
-                if filling_top:
-                    m = search_pattern.search(l)
-                    if m:
+        return reveal_top, entry["indent"], reveal_bottom
 
-                        attrib_end = m.end()
-                        end_of_tag = re.search(">",l[attrib_end:]).end()
+    def _set_display_size(self,reveal_html_file=None):
+        """
+        Tell the processors the size of the slides in the template, so
+        renders can be sized to fit.  Without a template, use the reveal.js
+        defaults.
+        """
 
-                        break_index = attrib_end + end_of_tag + 1
-                        with_top = l[:(break_index-1)]
+        width, height = 960, 700
+        if reveal_html_file is not None:
+            width, height = self._get_reveal_entry(reveal_html_file)[1]["size"]
 
-                        try:
-                            with_bottom = l[(break_index-1):]
-                        except IndexError:
-                            with_bottom = ""
+        self._display_size = (width,height)
+        for processor in self._processors:
+            processor.set_display_size(width,height)
 
-                        indent = (len(l) - len(l.lstrip()) + 2)*" "
+    def _write_html(self,f,html,indent):
+        """
+        Write one slide worth of html to the file f, indented by indent.
+        """
 
-                        top.append(with_top)
-                        top.append("\n\n")
+        if indent == "":
+            f.write(html)
+        else:
+            f.write(html.replace("\n","\n{}".format(indent)))
 
-                        bottom.append("\n")
-                        bottom.append((len(l) - len(l.strip()))*" ")
-                        bottom.append(with_bottom)
+    def _get_slide_key(self,slide):
+        """
+        Key for looking up a slide in the slide cache.
+        """
 
-                        filling_top = False
+        h = hashlib.md5()
+        h.update(self._processor_config.encode())
+        h.update("{}x{}".format(*self._display_size).encode())
+        h.update(slide.markdown.encode())
 
-                        continue
-                    else:
-                        top.append(l)
-                else:
-                    bottom.append(l)
+        return h.hexdigest()
+
+    def _get_input_hash(self,input_file):
+        """
+        md5 of an input file, only calculated once per build.
+        """
+
+        try:
+            return self._input_hashes[input_file]
+        except KeyError:
+            pass
+
+        try:
+            file_hash = hashes.get_file_hash(input_file)
+        except (FileNotFoundError,IsADirectoryError):
+            file_hash = None
+
+        self._input_hashes[input_file] = file_hash
+
+        return file_hash
+
+    def _load_cached_slides(self):
+        """
+        Fill in slides that have not been processed from the slide cache.  A
+        slide is taken from the cache if its markdown, the processor settings
+        and every file it read are the same as when it was cached, and every
+        file it wrote still exists.
+        """
+
+        for slide in self._slides:
+
+            if slide.processed:
+                continue
+
+            try:
+                entry = self._slide_cache[self._get_slide_key(slide)]
+            except KeyError:
+                continue
+
+            usable = True
+            for input_file, file_hash in entry["inputs"].items():
+                if self._get_input_hash(input_file) != file_hash:
+                    usable = False
+                    break
+
+            for record in entry["records"].values():
+                for output_file, file_hash, build_key in record["outputs"]:
+                    if not os.path.isfile(output_file):
+                        usable = False
+                        break
+
+            if usable:
+                slide.load_cached(entry["html"],entry["records"])
+
+    def _write_slide_cache(self):
+        """
+        Write the html and records for every slide to the slide cache.
+        """
+
+        if self._slide_cache_file is None:
+            return
+
+        self._slide_cache = {}
+        for slide in self._slides:
+
+            inputs = {}
+            for input_file in slide.inputs:
+                inputs[input_file] = self._get_input_hash(input_file)
+
+            self._slide_cache[self._get_slide_key(slide)] = {"inputs":inputs,
+                                                             "html":slide.html,
+                                                             "records":slide.records}
+
+        f = open(self._slide_cache_file,'w')
+        json.dump(self._slide_cache,f)
+        f.close()
+
+    def _build(self,output_file,reveal_html_file=None):
+        """
+        Build the slides, taking anything already processed (or in the slide
+        cache) as is and running processors on everything else.
+        """
+
+        # Input files are hashed at most once per build
+        self._input_hashes = {}
+
+        self._set_display_size(reveal_html_file)
+        self._load_cached_slides()
+
+        # Tell the processors about the files used by slides we are keeping
+        # before processing anything new, so unchanged files are not copied
+        # again.
+        to_process = []
+        for i, slide in enumerate(self._slides):
+            if slide.processed:
+                slide.restore(self._processors)
+            else:
+                to_process.append(i)
+
+        self._apply_processors(to_process)
+        self._write_output(output_file,reveal_html_file)
+        self._write_slide_cache()
+
+    def _apply_processors(self,slide_indexes):
+        """
+        Apply every processor to the slides in slide_indexes.
+        """
+
+        # In parallel mode, let the processors start their slow work (i.e.
+        # renders) for every slide at once on a pool of threads.  Slides are
+        # then processed in order below, so the output is identical to a
+        # serial build.
+        executor = None
+        if self._jobs > 1 and len(slide_indexes) > 0:
+            executor = concurrent.futures.ThreadPoolExecutor(self._jobs)
+
+            lines = []
+            for i in slide_indexes:
+                lines.extend(self._slides[i].markdown.splitlines(keepends=True))
+
+            for processor in self._processors:
+                processor.prefetch(lines,executor,self._jobs)
+
+        # Apply processors
+        try:
+            for i in slide_indexes:
+                print("Processing slide {} of {}\n".format(i+1,len(self._slides)))
+                self._slides[i].dispatch(self._dispatcher)
+                self._slides[i].processed = True
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            for processor in self._processors:
+                processor.cleanup()
+
+    def _stream_build(self,output_file,reveal_html_file=None):
+        """
+        Read, process and write out one slide at a time.  When running
+        parallel jobs, renders for the next few slides are started while the
+        current slide is processed.
+        """
+
+        if reveal_html_file is not None:
+            reveal_top, indent, reveal_bottom = self._read_reveal_file(reveal_html_file)
+        else:
+            reveal_top, indent, reveal_bottom = "", "", ""
+
+        self._set_display_size(reveal_html_file)
+
+        executor = None
+        if self._jobs > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(self._jobs)
+
+        # Write to a temporary file so a failed build does not leave a
+        # partial output file behind
+        tmp_file = "{}.tmp".format(output_file)
+        f = open(tmp_file,'w')
+
+        try:
+
+            f.write(reveal_top)
+            f.write(indent)
+
+            slides = self._iter_slides()
+            window = collections.deque()
+            counter = 0
+            while True:
+
+                # Read ahead, starting slow work for upcoming slides
+                while len(window) < self._jobs:
+
+                    try:
+                        slide = next(slides)
+                    except StopIteration:
+                        break
+
+                    if executor is not None:
+                        lines = slide.markdown.splitlines(keepends=True)
+                        for processor in self._processors:
+                            processor.prefetch(lines,executor,self._jobs)
+
+                    window.append(slide)
+
+                if len(window) == 0:
+                    break
+
+                slide = window.popleft()
+                counter += 1
+
+                print("Processing slide {}\n".format(counter))
+                slide.dispatch(self._dispatcher)
+                slide.processed = True
+
+                self._write_html(f,slide.html,indent)
+
+            f.write(reveal_bottom)
+            f.close()
+
+            os.replace(tmp_file,output_file)
+
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            for processor in self._processors:
+                processor.cleanup()
+
+            if not f.closed:
+                f.close()
+                os.remove(tmp_file)
+
+        self._write_build_info()
+
+    def _write_build_info(self):
+        """
+        Write out build information and remove files left over from the last
+        build.
+        """
+
+        # Record what we did in each build manifest, all at once
+        for target_dir, group in self._target_groups:
+            entries = [(p.name,p.build_info,p.file_info,p.record_info)
+                       for p in group]
+            self._manifests[target_dir].commit(entries)
+
+        # Set of all output files written out by the processor (or that would
+        # have been written out if they hadn't been written out by a previous
+        # render)
+        all_output_files = set()
+        for p in self._processors:
+            all_output_files.update(p.output_files)
 
-        reveal_top = "".join(top)
-        reveal_bottom = "".join(bottom)
+        # Get list of files we saw in the initial directory that would
+        # not have been written out by slidemachine.  Delete them as they
+        # are leftover from the last render
+        leftover_files = self._existing_files.difference(all_output_files)
+
+        # Files the previous build made for a build key (i.e. renders) are
+        # kept in the stale area in case they are needed again
+        for p in self._processors:
+            for build_key, f in p.prev_build_info.items():
+                if type(f) is str and f in leftover_files:
+                    try:
+                        p.retire(build_key,f)
+                    except FileNotFoundError:
+                        pass
+                    leftover_files.discard(f)
+
+        for f in leftover_files:
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+
+        # What is in the output directories now
+        self._existing_files = all_output_files
+
+        if self._file_hashes_file is not None:
+            hashes.get_hash_cache().save(self._file_hashes_file)
+
+    def _write_output(self,output_file,reveal_html_file=None):
+        """
+        Write out build information, remove files left over from the last
+        build, and write the html.
+        """
 
-        # Add appropriate indentation
-        html = self._html.split("\n")
-        html = "\n".join(["{}{}".format(indent,h) for h in html])
+        self._write_build_info()
 
-        out = "{}{}{}".format(reveal_top,html,reveal_bottom)
+        # If a reveal html file is given, put the slides inside it
+        if reveal_html_file is not None:
+            reveal_top, indent, reveal_bottom = self._read_reveal_file(reveal_html_file)
+        else:
+            reveal_top, indent, reveal_bottom = "", "", ""
 
-        return out
+        # Write out output a piece at a time rather than joining everything
+        f = open(output_file,'w')
+        f.write(reveal_top)
+        f.write(indent)
+        for slide in self._slides:
+            self._write_html(f,slide.html,indent)
+        f.write(reveal_bottom)
+        f.close()
 
     def process(self,output_file,reveal_html_file=None):
         """
@@ -392,49 +1051,128 @@ class SlideMachine:
                 err += "Use --force to overwrite."
                 raise IOError(err)
 
-        # Apply processors
-        for i, slide in enumerate(self._slides):
-            print("Processing slide {} of {}\n".format(i+1,len(self._slides)))
-            for processor in self._processors:
-                slide.apply(processor)
+        if self._stream:
+            self._stream_build(output_file,reveal_html_file)
+        else:
+            self._build(output_file,reveal_html_file)
 
-        # Write out a json file describing what we did
-        all_output_files = []
-        for p in self._processors:
-            p.write_build_json()
-            all_output_files.extend(p.output_files)
+    def update(self,output_file,reveal_html_file=None,changed_files=()):
+        """
+        Rebuild after some files changed, only re-running processors on
+        slides whose markdown or input files changed.  Must be called after
+        process.
 
-        # Set of all output files written out by the processor (or that would
-        # have been written out if they hadn't been written out by a previous
-        # render)
-        all_output_files = set(all_output_files)
+        output_file: html file to write results
+        reveal_html_file: html file with a class="slides" element that the
+                          slides will be pasted in to.
+        changed_files: list of files that changed since the last build
+        """
 
-        # Get list of files we saw in the initial directory that would
-        # not have been written out by slidemachine.  Delete them as they
-        # are leftover from the last render
-        leftover_files = self._existing_files.difference(all_output_files)
-        for f in leftover_files:
-            os.remove(f)
+        if self._stream:
+            err = "Slides are not kept when streaming, so they cannot be updated.\n"
+            raise ValueError(err)
 
-        # Grab slide html
-        html = []
+        changed = set([os.path.abspath(f) for f in changed_files])
+
+        # A new configuration means new processors, so start over
+        if os.path.abspath(self._json_file) in changed:
+            self._load_json()
+            self._prep_target_dirs()
+            self._read_md_file()
+            self._build(output_file,reveal_html_file)
+            return
+
+        # Slides whose input files did not change can be used as is
+        reusable = {}
         for slide in self._slides:
-            html.append(slide.html)
 
-        # Make final html for object
-        self._html = "".join(html)
+            if not slide.processed:
+                continue
 
-        # If a reveal html file is given, merge the new slides output
-        # with that.
-        if reveal_html_file is not None:
-            out = self._merge_with_reveal_file(reveal_html_file)
+            inputs = set([os.path.abspath(f) for f in slide.inputs])
+            if len(inputs.intersection(changed)) > 0:
+                continue
+
+            try:
+                reusable[slide.markdown].append(slide)
+            except KeyError:
+                reusable[slide.markdown] = [slide]
+
+        if os.path.abspath(self._md_file) in changed:
+            self._read_md_file(reusable)
         else:
-            out = self.html
+            self._split_slides(reusable)
 
-        # Write out output
-        f = open(output_file,'w')
-        f.write(out)
-        f.close()
+        for p in self._processors:
+            p.start_rebuild()
+
+        self._build(output_file,reveal_html_file)
+
+    def _get_file_stamps(self,reveal_html_file=None):
+        """
+        Return a dictionary mapping every file the build depends on to its
+        modification time and size (None if the file does not exist).
+        """
+
+        files = [self._md_file,self._json_file]
+        if reveal_html_file is not None:
+            files.append(reveal_html_file)
+        for slide in self._slides:
+            files.extend(slide.inputs)
+
+        stamps = {}
+        for f in files:
+            f = os.path.abspath(f)
+            try:
+                stat = os.stat(f)
+                stamps[f] = (stat.st_mtime_ns,stat.st_size)
+            except FileNotFoundError:
+                stamps[f] = None
+
+        return stamps
+
+    def watch(self,output_file,reveal_html_file=None,interval=0.5):
+        """
+        Build, then watch the markdown, configuration, template and every
+        file used by the slides.  When something changes, rebuild only the
+        slides it affects.  Runs until interrupted.
+
+        output_file: html file to write results
+        reveal_html_file: html file with a class="slides" element that the
+                          slides will be pasted in to.
+        interval: how often to check for changes (seconds)
+        """
+
+        self.process(output_file,reveal_html_file)
+
+        stamps = self._get_file_stamps(reveal_html_file)
+        print("Watching for changes. Press Ctrl-C to stop.\n")
+
+        try:
+            while True:
+
+                time.sleep(interval)
+
+                new_stamps = self._get_file_stamps(reveal_html_file)
+                changed = [f for f in new_stamps
+                           if stamps.get(f,None) != new_stamps[f]]
+                if len(changed) == 0:
+                    continue
+
+                for f in changed:
+                    print("{} changed\n".format(f))
+
+                # Keep watching if the build fails; the user can fix
+                # whatever broke it.
+                try:
+                    self.update(output_file,reveal_html_file,changed)
+                except Exception:
+                    traceback.print_exc()
+
+                stamps = self._get_file_stamps(reveal_html_file)
+
+        except KeyboardInterrupt:
+            pass
 
     @property
     def markdown(self):
@@ -450,4 +1188,4 @@ class SlideMachine:
         Final html.
         """
 
-        return self._html
+        return "".join([slide.html for slide in self._slides])
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for putting input files into the target directory by copying, hard
+linking, reflinking or symlinking.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.base import Processor, copy_with_mode
+
+import os, shutil, tempfile, unittest
+from unittest import mock
+
+class CopyModeTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+        self._input_file = os.path.join(self._tmp_dir,"figure.png")
+        f = open(self._input_file,"wb")
+        f.write(b"image")
+        f.close()
+
+        self._target_dir = os.path.join(self._tmp_dir,"media")
+        os.mkdir(self._target_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _check_copy(self,output_file):
+        """
+        output_file holds the image and is not tied to the input file.
+        """
+
+        self.assertEqual(open(output_file,"rb").read(),b"image")
+        self.assertFalse(os.path.islink(output_file))
+        self.assertFalse(os.path.samefile(output_file,self._input_file))
+
+    def test_copy(self):
+
+        output_file = os.path.join(self._target_dir,"copy.png")
+        copy_with_mode(self._input_file,output_file,"copy")
+        self._check_copy(output_file)
+
+    def test_hardlink(self):
+
+        output_file = os.path.join(self._target_dir,"hardlink.png")
+        copy_with_mode(self._input_file,output_file,"hardlink")
+
+        self.assertFalse(os.path.islink(output_file))
+        self.assertTrue(os.path.samefile(output_file,self._input_file))
+
+    def test_symlink(self):
+
+        output_file = os.path.join(self._target_dir,"symlink.png")
+        copy_with_mode(self._input_file,output_file,"symlink")
+
+        self.assertTrue(os.path.islink(output_file))
+        self.assertEqual(os.readlink(output_file),
+                         os.path.realpath(self._input_file))
+
+    def test_reflink(self):
+
+        # Copy-on-write clones look like copies whether or not the
+        # filesystem can make them
+        output_file = os.path.join(self._target_dir,"reflink.png")
+        copy_with_mode(self._input_file,output_file,"reflink")
+        self._check_copy(output_file)
+
+    def test_fallback(self):
+
+        # Modes that are not possible (i.e. links across filesystems) copy
+        for mode, function in [("hardlink","os.link"),
+                               ("symlink","os.symlink")]:
+            output_file = os.path.join(self._target_dir,"{}.png".format(mode))
+            with mock.patch(function,side_effect=OSError("not possible")):
+                copy_with_mode(self._input_file,output_file,mode)
+            self._check_copy(output_file)
+
+    def test_processor_copy_mode(self):
+
+        self.assertRaises(ValueError,Processor,self._target_dir,
+                          copy_mode="move")
+
+        p = Processor(self._target_dir,copy_mode="hardlink")
+        output_file = p._copy_file(self._input_file)
+
+        self.assertEqual(output_file,os.path.join(self._target_dir,"figure.png"))
+        self.assertTrue(os.path.samefile(output_file,self._input_file))
+
+if __name__ == "__main__":
+    unittest.main()
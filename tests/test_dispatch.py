@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for dispatching the lines of a slide to processors in a single pass.
+The sub-slides must come out as they did when each processor was applied to
+the whole slide in turn.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.slidemachine import Slide, Dispatcher, SlideMachineError
+
+import itertools, unittest
+
+class FakeProcessor:
+    """
+    Stands in for a Processor.  Lines starting with tag are replaced by
+    replacement, or expanded into several lines if replacement is a tuple.
+    """
+
+    def __init__(self,name,tag,replacement,trigger="![sm"):
+
+        self.name = name
+        self.trigger = trigger
+
+        self._tag = tag
+        self._replacement = replacement
+
+        self.seen = []
+
+    def process(self,line):
+
+        self.seen.append(line)
+
+        if not line.startswith(self._tag):
+            return line
+
+        if type(self._replacement) is tuple:
+            return tuple(["{}\n".format(r) for r in self._replacement])
+
+        return "{}\n".format(self._replacement)
+
+    def start_slide(self):
+        pass
+
+    def end_slide(self):
+        return {"inputs":[],"outputs":[]}
+
+def get_sub_slides(slide):
+    """
+    Lines of each sub-slide of a slide, with the newlines stripped.
+    """
+
+    out = []
+    for sub_slide in slide._sub_slides:
+        out.append([l.strip() for l in itertools.chain.from_iterable(sub_slide)])
+
+    return out
+
+class DispatchTest(unittest.TestCase):
+
+    def test_triggers(self):
+
+        tagged = FakeProcessor("tagged","![sm.a]","A")
+        every = FakeProcessor("every","x","X",trigger=None)
+
+        slide = Slide(["x\n","![sm.a]\n","y\n"])
+        slide.dispatch(Dispatcher([tagged,every]))
+
+        # Only lines with the trigger reach a processor that has one
+        self.assertEqual(tagged.seen,["![sm.a]\n"])
+        self.assertEqual(every.seen,["x\n","A\n","y\n"])
+        self.assertEqual(get_sub_slides(slide),[["X","A","y"]])
+        self.assertFalse(slide._override_transition)
+
+    def test_processor_order(self):
+
+        # The second processor sees what the first wrote
+        first = FakeProcessor("first","![sm.a]","![sm.b]")
+        second = FakeProcessor("second","![sm.b]","B")
+
+        slide = Slide(["![sm.a]\n"])
+        slide.dispatch(Dispatcher([first,second]))
+        self.assertEqual(get_sub_slides(slide),[["B"]])
+
+        # ... but not the other way around
+        first = FakeProcessor("first","![sm.a]","![sm.b]")
+        second = FakeProcessor("second","![sm.b]","B")
+
+        slide = Slide(["![sm.a]\n"])
+        slide.dispatch(Dispatcher([second,first]))
+        self.assertEqual(get_sub_slides(slide),[["![sm.b]"]])
+
+    def test_expansion_order(self):
+
+        a = FakeProcessor("a","![sm.a]",("a0","a1"))
+        c = FakeProcessor("c","![sm.c]",("c0","c1"))
+
+        slide = Slide(["top\n","![sm.c]\n","middle\n","![sm.a]\n","bottom\n"])
+        slide.dispatch(Dispatcher([a,c]))
+
+        # The expansion by the first processor varies slowest, wherever its
+        # line is in the slide
+        expected = [["top","c0","middle","a0","bottom"],
+                    ["top","c1","middle","a0","bottom"],
+                    ["top","c0","middle","a1","bottom"],
+                    ["top","c1","middle","a1","bottom"]]
+        self.assertEqual(get_sub_slides(slide),expected)
+        self.assertTrue(slide._override_transition)
+
+    def test_expanded_lines_processed(self):
+
+        # Each line from an expansion goes through the later processors
+        a = FakeProcessor("a","![sm.a]",("![sm.b] 0","![sm.b] 1"))
+        b = FakeProcessor("b","![sm.b]","B")
+
+        slide = Slide(["![sm.a]\n"])
+        slide.dispatch(Dispatcher([a,b]))
+
+        self.assertEqual(b.seen,["![sm.b] 0\n","![sm.b] 1\n"])
+        self.assertEqual(get_sub_slides(slide),[["B"],["B"]])
+
+    def test_one_expansion_per_processor(self):
+
+        a = FakeProcessor("a","![sm.a]",("a0","a1"))
+
+        slide = Slide(["![sm.a]\n","![sm.a]\n"])
+        self.assertRaises(SlideMachineError,slide.dispatch,Dispatcher([a]))
+
+if __name__ == "__main__":
+    unittest.main()
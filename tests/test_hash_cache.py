@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for hashing files and caching the hashes by file stamp.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors import hashes
+from slidemachine.processors.hashes import FileHashCache, hash_file
+
+import os, time, shutil, hashlib, tempfile, unittest
+
+class FileHashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+        self._file = os.path.join(self._tmp_dir,"figure.png")
+
+        # Count the files actually read
+        self._read = []
+        def counting_hash_file(input_file,algorithm="md5"):
+            self._read.append(input_file)
+            return hash_file(input_file,algorithm)
+        hashes.hash_file = counting_hash_file
+
+    def tearDown(self):
+        hashes.hash_file = hash_file
+        shutil.rmtree(self._tmp_dir)
+
+    def _write(self,data,mtime=None):
+        """
+        Write data to the test file, setting its modification time to mtime
+        (default an hour ago).
+        """
+
+        f = open(self._file,"wb")
+        f.write(data)
+        f.close()
+
+        if mtime is None:
+            mtime = time.time() - 3600
+        os.utime(self._file,(mtime,mtime))
+
+    def test_hash_file(self):
+
+        self._write(b"x"*(3*1024*1024 + 5))
+
+        expected = hashlib.md5(b"x"*(3*1024*1024 + 5)).hexdigest()
+        self.assertEqual(hash_file(self._file),expected)
+
+        expected = hashlib.sha256(b"x"*(3*1024*1024 + 5)).hexdigest()
+        self.assertEqual(hash_file(self._file,"sha256"),expected)
+
+        self.assertRaises(ValueError,FileHashCache,"crc32")
+
+    def test_unchanged_file_not_read(self):
+
+        cache = FileHashCache()
+        self._write(b"render one")
+
+        first = cache.get_hash(self._file)
+        self.assertEqual(cache.get_hash(self._file),first)
+        self.assertEqual(len(self._read),1)
+
+    def test_stat_invalidation(self):
+
+        cache = FileHashCache()
+        self._write(b"render one")
+        first = cache.get_hash(self._file)
+
+        # Same size, different modification time
+        mtime = time.time() - 1800
+        self._write(b"render two",mtime)
+        self.assertEqual(cache.get_hash(self._file),
+                         hashlib.md5(b"render two").hexdigest())
+
+        # Same modification time, different size
+        self._write(b"render three",mtime)
+        self.assertEqual(cache.get_hash(self._file),
+                         hashlib.md5(b"render three").hexdigest())
+
+        # A new file at the same path
+        os.remove(self._file)
+        self._write(b"render one")
+        self.assertEqual(cache.get_hash(self._file),first)
+
+        self.assertEqual(len(self._read),4)
+
+    def test_recent_file_not_cached(self):
+
+        # A file changed just now could change again within the resolution
+        # of its modification time, so it is hashed every time
+        cache = FileHashCache()
+        self._write(b"render one",time.time())
+
+        cache.get_hash(self._file)
+        cache.get_hash(self._file)
+        self.assertEqual(len(self._read),2)
+
+    def test_save_and_load(self):
+
+        json_file = os.path.join(self._tmp_dir,"file-hashes.json")
+
+        cache = FileHashCache()
+        self._write(b"render one")
+        first = cache.get_hash(self._file)
+        cache.save(json_file)
+
+        cache = FileHashCache()
+        cache.load(json_file)
+        self.assertEqual(cache.get_hash(self._file),first)
+        self.assertEqual(len(self._read),1)
+
+        # Hashes made with another algorithm are not used
+        cache = FileHashCache("sha1")
+        cache.load(json_file)
+        self.assertEqual(cache.get_hash(self._file),
+                         hashlib.sha1(b"render one").hexdigest())
+        self.assertEqual(len(self._read),2)
+
+if __name__ == "__main__":
+    unittest.main()
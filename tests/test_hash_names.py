@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for naming output files by their content.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.base import Processor
+from slidemachine.processors.hashes import get_data_hash
+
+import os, shutil, tempfile, unittest
+
+class HashNamesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _get_hashed_name(self,data,name,ext=".png"):
+        return os.path.join(self._tmp_dir,"{}.{}{}".format(name,
+                                                           get_data_hash(data)[:12],
+                                                           ext))
+
+    def test_write_data_hash_names(self):
+
+        p = Processor(self._tmp_dir,hash_names=True)
+
+        data = b"render one"
+
+        out = p._write_data(data,"figure.png")
+        self.assertEqual(out,self._get_hashed_name(data,"figure"))
+        self.assertEqual(open(out,"rb").read(),data)
+
+        # Naming by content means a new processor finds the file in place
+        p = Processor(self._tmp_dir,hash_names=True)
+        self.assertEqual(p._write_data(data,"renamed.png"),
+                         self._get_hashed_name(data,"renamed"))
+
+        # A name that already holds the hash does not get it twice
+        p = Processor(self._tmp_dir,hash_names=True)
+        self.assertEqual(p._write_data(data,os.path.split(out)[1]),out)
+
+    def test_skip_if_present(self):
+
+        data = b"render one"
+        out = self._get_hashed_name(data,"figure")
+
+        p = Processor(self._tmp_dir,hash_names=True)
+        p._write_data(data,"figure.png")
+        stat = os.stat(out)
+
+        # A later build does not write the file again
+        p = Processor(self._tmp_dir,hash_names=True)
+        written = []
+        def write(new_file):
+            written.append(new_file)
+        self.assertEqual(p._place_file("figure.png",get_data_hash(data),write),
+                         out)
+        self.assertEqual(written,[])
+        self.assertEqual(os.stat(out).st_ino,stat.st_ino)
+
+    def test_interrupted_write(self):
+
+        data = b"render one"
+        out = self._get_hashed_name(data,"figure")
+
+        # A write that fails part way leaves nothing under the hashed name
+        def write(new_file):
+            f = open(new_file,"wb")
+            f.write(data[:3])
+            f.close()
+            raise KeyboardInterrupt
+
+        p = Processor(self._tmp_dir,hash_names=True)
+        self.assertRaises(KeyboardInterrupt,p._place_file,"figure.png",
+                          get_data_hash(data),write)
+        self.assertFalse(os.path.exists(out))
+
+        # ... so the next build writes the whole file
+        p = Processor(self._tmp_dir,hash_names=True)
+        self.assertEqual(p._write_data(data,"figure.png"),out)
+        self.assertEqual(open(out,"rb").read(),data)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for finding the layers of an inkscape svg and building the svg for a
+layer configuration from the indexed file.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.inkscape import InkscapeSVG
+
+import os, shutil, tempfile, unittest
+
+# Layered svg with non-ascii text before and inside the layers (so byte and
+# character offsets differ), a nested layer, an empty self-closing layer and
+# a ">" inside an attribute of a layer tag.  Every layer is visible, so
+# rebuilding with every layer on gives back the file.
+SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="200" height="100" viewBox="0 0 200 100">
+  <title>Dépôt — ünïcødé ✓</title>
+  <g inkscape:groupmode="layer" id="layer1" inkscape:label="a > b" style="display:inline">
+    <rect id="r1" fill="red" width="10" height="10" />
+    <g inkscape:groupmode="layer" id="layer2" style="display:inline">
+      <text>naïve café</text>
+    </g>
+  </g>
+  <g inkscape:groupmode="layer" id="layer3" style="display:inline" />
+  <g inkscape:groupmode="layer" id="layer4" style="display:inline">
+    <circle r="5" />
+  </g>
+</svg>
+"""
+
+class InkscapeLayersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+        self._svg_file = os.path.join(self._tmp_dir,"test.svg")
+        f = open(self._svg_file,"w",encoding="utf-8")
+        f.write(SVG)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_layers(self):
+
+        ink = InkscapeSVG(self._svg_file)
+
+        self.assertEqual(ink.layers,["layer1","layer2","layer3","layer4"])
+        self.assertEqual(ink.get_layer_ancestors(1),[0])
+        self.assertEqual(ink.get_layer_ancestors(3),[])
+        self.assertEqual(ink.page_size,(200.0,100.0))
+
+    def test_build_svg_round_trip(self):
+
+        ink = InkscapeSVG(self._svg_file)
+
+        self.assertEqual(ink._build_svg([True,True,True,True]),SVG)
+        self.assertEqual(ink.svg,SVG)
+
+    def test_build_svg_hides_layers(self):
+
+        ink = InkscapeSVG(self._svg_file)
+
+        svg = ink._build_svg([True,False,True,False])
+
+        expected = SVG.replace('id="layer2" style="display:inline"',
+                               'id="layer2" style="display:none"')
+        expected = expected.replace('id="layer4" style="display:inline"',
+                                    'id="layer4" style="display:none"')
+        self.assertEqual(svg,expected)
+
+    def test_set_layer_config(self):
+
+        ink = InkscapeSVG(self._svg_file)
+
+        self.assertEqual(ink.set_layer_config("1001"),"1001")
+        self.assertIn('id="layer2" style="display:none"',ink.svg)
+        self.assertIn('id="layer4" style="display:inline"',ink.svg)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for hashing layer configurations by the content of the layers they
+show.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.inkscape import InkscapeSVG
+
+import os, shutil, tempfile, unittest
+
+# Four layers; the fill of the first and the radius in the last can be
+# changed.  layer4 uses a gradient from defs.
+SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="200" height="100">
+  <defs><linearGradient id="grad"><stop offset="0" /></linearGradient></defs>
+  <g inkscape:groupmode="layer" id="layer1" style="display:inline">
+    <rect id="r1" fill="{fill}" width="10" height="10" />
+    <g inkscape:groupmode="layer" id="layer2" style="display:inline">
+      <text>text</text>
+    </g>
+  </g>
+  <g inkscape:groupmode="layer" id="layer3" style="display:inline" />
+  <g inkscape:groupmode="layer" id="layer4" style="display:inline">
+    <circle r="{radius}" fill="url(#grad)" />
+  </g>
+</svg>
+"""
+
+# A visible layer that clones an object inside another layer
+CLONE_SVG = """<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="100" height="100">
+<g inkscape:groupmode="layer" id="layer1" style="display:none"><rect id="r1" fill="{fill}" width="10" height="10"/></g>
+<g inkscape:groupmode="layer" id="layer2"><use xlink:href="#r1" x="20"/></g>
+</svg>
+"""
+
+class LayerHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _load(self,text,name):
+
+        svg_file = os.path.join(self._tmp_dir,name)
+        f = open(svg_file,"w",encoding="utf-8")
+        f.write(text)
+        f.close()
+
+        return InkscapeSVG(svg_file)
+
+    def test_config_hash_per_layer(self):
+
+        ink = self._load(SVG.format(fill="red",radius=5),"test.svg")
+
+        # Change only the content of layer4
+        edited = self._load(SVG.format(fill="red",radius=6),"edited.svg")
+
+        self.assertEqual(ink.get_config_hash("1110"),
+                         edited.get_config_hash("1110"))
+        self.assertNotEqual(ink.get_config_hash("0001"),
+                            edited.get_config_hash("0001"))
+
+        # Change only the content of layer1, which holds layer2
+        edited = self._load(SVG.format(fill="blue",radius=5),"parent.svg")
+
+        self.assertNotEqual(ink.get_config_hash("1100"),
+                            edited.get_config_hash("1100"))
+        self.assertEqual(ink.get_config_hash("0011"),
+                         edited.get_config_hash("0011"))
+
+    def test_config_hash_ignores_file_visibility(self):
+
+        ink = self._load(SVG.format(fill="red",radius=5),"test.svg")
+
+        hidden = SVG.format(fill="red",radius=5)
+        hidden = hidden.replace('id="layer3" style="display:inline"',
+                                'id="layer3" style="display:none"')
+        hidden = self._load(hidden,"hidden.svg")
+
+        self.assertEqual(ink.get_config_hash("1111"),
+                         hidden.get_config_hash("1111"))
+
+    def test_config_hash_args(self):
+
+        ink = self._load(SVG.format(fill="red",radius=5),"test.svg")
+
+        self.assertNotEqual(ink.get_config_hash("1111"),
+                            ink.get_config_hash("1110"))
+        self.assertNotEqual(ink.get_config_hash("1111","png"),
+                            ink.get_config_hash("1111","svg"))
+
+    def test_config_hash_follows_clones(self):
+
+        hashes = []
+        for fill in ["red","blue"]:
+            ink = self._load(CLONE_SVG.format(fill=fill),"{}.svg".format(fill))
+            hashes.append(ink.get_config_hash("01"))
+
+        self.assertNotEqual(hashes[0],hashes[1])
+
+if __name__ == "__main__":
+    unittest.main()
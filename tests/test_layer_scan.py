@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for finding layers and the page size of an svg with a streaming xml
+parser.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors import inkscape
+from slidemachine.processors.inkscape import InkscapeSVG
+
+import os, shutil, tempfile, unittest
+from unittest import mock
+
+# Non-ascii text between the layers, so byte and character offsets differ
+SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" {size}>
+  <title>ünïcødé ✓</title>
+  <g inkscape:groupmode="layer" id="layer1" style="display:inline">
+    <text>naïve café</text>
+    <g id="group1"><rect width="10" height="10" /></g>
+  </g>
+  <g id="Layer_2"><circle r="5" /></g>
+  <g inkscape:groupmode="layer" id="top" style="display:inline"><text>✓✓✓</text></g>
+</svg>
+"""
+
+class LayerScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_svg(self,text,name="test.svg"):
+
+        svg_file = os.path.join(self._tmp_dir,name)
+        f = open(svg_file,"w",encoding="utf-8")
+        f.write(text)
+        f.close()
+
+        return svg_file
+
+    def test_layers(self):
+
+        text = SVG.format(size='width="200" height="100"')
+        ink = InkscapeSVG(self._write_svg(text))
+
+        # Groups with layer ids count as layers (illustrator); other groups
+        # do not
+        self.assertEqual(ink.layers,["layer1","Layer_2","top"])
+        self.assertEqual(ink.svg,text)
+
+    def test_small_blocks(self):
+
+        # Layers are found the same way when tags are split across the
+        # blocks fed to the parser
+        text = SVG.format(size='width="200" height="100"')
+        svg_file = self._write_svg(text)
+        expected = InkscapeSVG(svg_file)
+
+        with mock.patch.object(inkscape,"_SCAN_BLOCK_SIZE",7):
+            ink = InkscapeSVG(svg_file)
+
+        self.assertEqual(ink.layers,expected.layers)
+        self.assertEqual(ink.summary,expected.summary)
+        self.assertEqual(ink._build_svg([False,True,False]),
+                         expected._build_svg([False,True,False]))
+
+    def test_mangled_xml(self):
+
+        text = SVG.format(size='width="200" height="100"')
+        self.assertRaises(ValueError,InkscapeSVG,self._write_svg(text[:-20]))
+
+        # The same layer id twice
+        text = text.replace('id="top"','id="layer1"')
+        self.assertRaises(ValueError,InkscapeSVG,self._write_svg(text))
+
+    def test_page_size(self):
+
+        sizes = [('width="200" height="100"',(200.0,100.0),2.0),
+                 ('width="2in" height="1in"',(192.0,96.0),2.0),
+                 ('width="20mm" height="10mm" viewBox="0 0 40 10"',
+                  (20*96/25.4,10*96/25.4),4.0),
+                 ('width="100%" height="100%" viewBox="0,0,30,10"',
+                  (30.0,10.0),3.0),
+                 ('width="100%" height="50%"',None,None),
+                 ('',None,None)]
+
+        for size, page_size, page_aspect in sizes:
+            ink = InkscapeSVG(self._write_svg(SVG.format(size=size)))
+            if page_size is None:
+                self.assertIsNone(ink.page_size)
+            else:
+                self.assertAlmostEqual(ink.page_size[0],page_size[0])
+                self.assertAlmostEqual(ink.page_size[1],page_size[1])
+            self.assertEqual(ink.page_aspect,page_aspect)
+
+    def test_page_size_from_document_element(self):
+
+        # An svg tag inside a comment is not the document element
+        text = SVG.format(size='width="200" height="100"')
+        text = text.replace("<svg ",'<!-- <svg width="1" height="1"> -->\n<svg ',1)
+
+        ink = InkscapeSVG(self._write_svg(text))
+        self.assertEqual(ink.page_size,(200.0,100.0))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for the build manifest kept in each target directory.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.manifest import BuildManifest
+
+import os, shutil, tempfile, unittest
+
+class BuildManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+        self._db_file = os.path.join(self._tmp_dir,"build-manifest.db")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_commit(self):
+
+        manifest = BuildManifest(self._db_file)
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),{})
+
+        manifest.commit([("InkscapeProcessor",{"key1":"media/a.png"},
+                          {"hash1":"media/a.png"},
+                          {"demo.svg":{"layers":["layer1","layer2"]}}),
+                         ("ImageProcessor",{},{"hash2":"media/b.png"},{})])
+
+        # Entries are read back by a new manifest on the same file
+        manifest = BuildManifest(self._db_file)
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),
+                         {"key1":"media/a.png"})
+        self.assertEqual(manifest.get_files("InkscapeProcessor"),
+                         {"hash1":"media/a.png"})
+        self.assertEqual(manifest.get_records("InkscapeProcessor"),
+                         {"demo.svg":{"layers":["layer1","layer2"]}})
+        self.assertEqual(manifest.get_files("ImageProcessor"),
+                         {"hash2":"media/b.png"})
+
+        # A commit replaces everything for the processors it names and
+        # leaves the others alone
+        manifest.commit([("InkscapeProcessor",{"key3":"media/c.png"},{},{})])
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),
+                         {"key3":"media/c.png"})
+        self.assertEqual(manifest.get_files("InkscapeProcessor"),{})
+        self.assertEqual(manifest.get_records("InkscapeProcessor"),{})
+        self.assertEqual(manifest.get_files("ImageProcessor"),
+                         {"hash2":"media/b.png"})
+
+    def test_rollback(self):
+
+        manifest = BuildManifest(self._db_file)
+        manifest.commit([("InkscapeProcessor",{"key1":"media/a.png"},{},{}),
+                         ("ImageProcessor",{},{"hash2":"media/b.png"},{})])
+
+        # A record that cannot be written fails the whole commit, including
+        # the processors before it
+        self.assertRaises(TypeError,manifest.commit,
+                          [("InkscapeProcessor",{"key3":"media/c.png"},{},{}),
+                           ("ImageProcessor",{},{},{"bad":object()})])
+
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),
+                         {"key1":"media/a.png"})
+        self.assertEqual(manifest.get_files("ImageProcessor"),
+                         {"hash2":"media/b.png"})
+
+    def test_corrupt_database(self):
+
+        f = open(self._db_file,"wb")
+        f.write(b"this is not a database"*100)
+        f.close()
+
+        manifest = BuildManifest(self._db_file)
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),{})
+
+        manifest.commit([("InkscapeProcessor",{"key1":"media/a.png"},{},{})])
+        self.assertEqual(manifest.get_builds("InkscapeProcessor"),
+                         {"key1":"media/a.png"})
+
+if __name__ == "__main__":
+    unittest.main()
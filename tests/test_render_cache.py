@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for the user-level render cache shared by every deck.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.cache import RenderCache
+from slidemachine.processors.inkscape import InkscapeProcessor
+
+import os, time, shutil, tempfile, unittest, warnings
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+        self._cache_dir = os.path.join(self._tmp_dir,"cache")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _set_age(self,cache,key,seconds):
+        """
+        Make the cached png for key look like it was last used seconds ago.
+        """
+
+        cache_file = cache._get_path(key,"png")
+        then = time.time() - seconds
+        os.utime(cache_file,(then,then))
+
+    def test_get_and_put(self):
+
+        cache = RenderCache(self._cache_dir)
+        key = cache.get_key("figure.svg","1010","png")
+
+        self.assertEqual(cache.get_key("figure.svg","1010","png"),key)
+        self.assertNotEqual(cache.get_key("figure.svg","1011","png"),key)
+
+        self.assertIsNone(cache.get_data(key,"png"))
+        cache.put_data(key,b"render","png")
+        self.assertEqual(cache.get_data(key,"png"),b"render")
+
+        out_file = os.path.join(self._tmp_dir,"out.png")
+        self.assertTrue(cache.get(key,out_file))
+        self.assertEqual(open(out_file,"rb").read(),b"render")
+        self.assertFalse(cache.get(cache.get_key("other"),out_file))
+
+    def test_evicts_least_recently_used(self):
+
+        # Room for two 1 kB renders, but not three
+        cache = RenderCache(self._cache_dir,max_size=2.5/1024)
+        data = b"x"*1024
+
+        keys = [cache.get_key(name) for name in ["a","b","c"]]
+        cache.put_data(keys[0],data,"png")
+        cache.put_data(keys[1],data,"png")
+
+        # a is older than b, but is then used again
+        self._set_age(cache,keys[0],100)
+        self._set_age(cache,keys[1],50)
+        self.assertEqual(cache.get_data(keys[0],"png"),data)
+
+        cache.put_data(keys[2],data,"png")
+
+        self.assertEqual(cache.get_data(keys[0],"png"),data)
+        self.assertIsNone(cache.get_data(keys[1],"png"))
+        self.assertEqual(cache.get_data(keys[2],"png"),data)
+
+    def test_evicts_old_files(self):
+
+        cache = RenderCache(self._cache_dir,max_age=1)
+
+        old = cache.get_key("old")
+        cache.put_data(old,b"render","png")
+        self._set_age(cache,old,2*24*3600)
+
+        # Old files are looked for the first time a cache stores something
+        cache = RenderCache(self._cache_dir,max_age=1)
+        cache.put_data(cache.get_key("new"),b"render","png")
+
+        self.assertIsNone(cache.get_data(old,"png"))
+
+    def test_unusable_cache_dir(self):
+
+        # A cache directory that cannot be made turns the cache off
+        blocker = os.path.join(self._tmp_dir,"not_a_dir")
+        open(blocker,"w").close()
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            p = InkscapeProcessor(target_dir=self._tmp_dir,pool_size=0,
+                                  render_cache_dir=os.path.join(blocker,"cache"))
+
+        self.assertIsNone(p._render_cache)
+        self.assertEqual(len(caught),1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for keeping renders the deck no longer uses in a stale store, so they
+can be brought back rather than rendered again.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.slidemachine import SlideMachine
+from slidemachine.processors.base import Processor
+from slidemachine.processors.cache import RenderCache
+from slidemachine.processors.inkscape import InkscapeSVG
+
+import os, json, time, shutil, tempfile, unittest
+from unittest import mock
+
+SVG = """<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="100" height="100">
+<g inkscape:groupmode="layer" id="layer1"><rect width="10" height="10"/></g>
+<g inkscape:groupmode="layer" id="layer2"><circle r="5"/></g>
+</svg>
+"""
+
+class StaleStoreTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+        self._target_dir = os.path.join(self._tmp_dir,"media")
+        os.mkdir(self._target_dir)
+
+        self._stale_dir = os.path.join(self._tmp_dir,"stale")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_render(self,name,data):
+
+        output_file = os.path.join(self._target_dir,name)
+        f = open(output_file,"wb")
+        f.write(data)
+        f.close()
+
+        return output_file
+
+    def test_retire_and_restore(self):
+
+        p = Processor(self._target_dir)
+        p.stale_store = RenderCache(self._stale_dir)
+
+        output_file = self._write_render("demo_10.png",b"render")
+        p.retire("key1",output_file)
+        self.assertFalse(os.path.exists(output_file))
+
+        # Brought back as a file or as bytes
+        self.assertTrue(p._get_stale("key1",output_file))
+        self.assertEqual(open(output_file,"rb").read(),b"render")
+        self.assertEqual(p._get_stale_data("key1","png"),b"render")
+
+        self.assertFalse(p._get_stale("key2",output_file))
+        self.assertIsNone(p._get_stale_data("key2","png"))
+
+    def test_no_stale_store(self):
+
+        p = Processor(self._target_dir)
+
+        output_file = self._write_render("demo_10.png",b"render")
+        p.retire("key1",output_file)
+
+        self.assertFalse(os.path.exists(output_file))
+        self.assertFalse(p._get_stale("key1",output_file))
+        self.assertIsNone(p._get_stale_data("key1","png"))
+
+    def test_eviction(self):
+
+        # Room for two 1 kB renders
+        p = Processor(self._target_dir)
+        p.stale_store = RenderCache(self._stale_dir,max_size=2.5/1024)
+
+        for i, key in enumerate(["key1","key2","key3"]):
+
+            output_file = self._write_render("demo.png",b"x"*1024)
+            p.retire(key,output_file)
+
+            # Make each retired render older than the next
+            cache_file = p.stale_store._get_path(p._get_stale_key(key),"png")
+            then = time.time() - 100 + i
+            os.utime(cache_file,(then,then))
+
+        self.assertIsNone(p._get_stale_data("key1","png"))
+        self.assertIsNotNone(p._get_stale_data("key2","png"))
+        self.assertIsNotNone(p._get_stale_data("key3","png"))
+
+    def test_build_restores_stale_render(self):
+
+        cwd = os.getcwd()
+        xdg = os.environ.get("XDG_CACHE_HOME",None)
+        os.chdir(self._tmp_dir)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self._tmp_dir,"cache")
+
+        try:
+
+            f = open("demo.svg","w")
+            f.write(SVG)
+            f.close()
+
+            config = {"processors":{"InkscapeProcessor":{"target_dir":"media",
+                                                         "img_format":"svg",
+                                                         "backend":"native",
+                                                         "pool_size":0,
+                                                         "render_cache":False}}}
+            f = open("config.json","w")
+            json.dump(config,f)
+            f.close()
+
+            def build(layer_config):
+
+                f = open("deck.md","w")
+                f.write("![sm.inkscape](demo.svg) {}\n".format(layer_config))
+                f.close()
+
+                sm = SlideMachine("deck.md",json_file="config.json",force=True)
+                sm.process("index.html")
+
+                return sorted(os.listdir("media"))
+
+            first = build("10")
+            renders = [f for f in first if f.endswith(".svg")]
+            self.assertEqual(len(renders),1)
+            data = open(os.path.join("media",renders[0]),"rb").read()
+
+            # The render is no longer used, so it leaves the target directory
+            self.assertNotIn(renders[0],build("01"))
+
+            # ... and comes back from the stale store without rendering
+            with mock.patch.object(InkscapeSVG,"render_config",
+                                   side_effect=AssertionError("rendered")):
+                self.assertEqual(build("10"),first)
+
+            self.assertEqual(open(os.path.join("media",renders[0]),"rb").read(),
+                             data)
+
+        finally:
+            os.chdir(cwd)
+            if xdg is None:
+                os.environ.pop("XDG_CACHE_HOME")
+            else:
+                os.environ["XDG_CACHE_HOME"] = xdg
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for the streaming build mode.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.slidemachine import SlideMachine
+from slidemachine.console.slidemachine import main
+
+import os, io, json, shutil, tempfile, unittest, contextlib
+
+DECK = """# title
+
+plain text
+
+>>>
+
+![sm.image](a.png) width="50%"
+
+>>>
+
+![sm.image](b.png)
+
+>>>
+
+![sm.image](a.png)
+"""
+
+TEMPLATE = """<html>
+<body>
+  <div class="reveal">
+    <div class="slides">
+    </div>
+  </div>
+</body>
+</html>
+"""
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+        self._cwd = os.getcwd()
+        os.chdir(self._tmp_dir)
+
+        # Keep stale renders out of the user's cache
+        self._xdg = os.environ.get("XDG_CACHE_HOME",None)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self._tmp_dir,"cache")
+
+        self._write("a.png","image a")
+        self._write("b.png","image b")
+        self._write("deck.md",DECK)
+        self._write("template.html",TEMPLATE)
+
+        config = {"processors":{"ImageProcessor":{"target_dir":"media",
+                                                  "pattern":r"!\[sm.image\]"}}}
+        self._write("config.json",json.dumps(config))
+
+    def tearDown(self):
+
+        os.chdir(self._cwd)
+        if self._xdg is None:
+            os.environ.pop("XDG_CACHE_HOME")
+        else:
+            os.environ["XDG_CACHE_HOME"] = self._xdg
+
+        shutil.rmtree(self._tmp_dir)
+
+    def _write(self,file_name,text):
+
+        f = open(file_name,"w")
+        f.write(text)
+        f.close()
+
+    def test_same_output(self):
+
+        for stream, output_file in [(False,"index.html"),(True,"stream.html")]:
+            sm = SlideMachine("deck.md",json_file="config.json",stream=stream)
+            sm.process(output_file,"template.html")
+
+        html = open("index.html").read()
+        self.assertEqual(html.count("<section>"),4)
+        self.assertEqual(html.count('src="media/a.png"'),2)
+        self.assertEqual(open("stream.html").read(),html)
+
+        # Nothing is kept in memory, so there is nothing to update
+        self.assertRaises(ValueError,sm.update,"stream.html")
+
+    def test_watch_and_stream(self):
+
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            with self.assertRaises(SystemExit) as cm:
+                main(["deck.md","--watch","--stream"])
+
+        self.assertEqual(cm.exception.code,2)
+        self.assertIn("not allowed with argument",err.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
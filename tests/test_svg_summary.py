@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for making InkscapeSVG objects from the summary kept in the build
+manifest, so unchanged svg files are not parsed again.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.slidemachine import SlideMachine
+from slidemachine.processors.inkscape import InkscapeSVG
+
+import os, json, shutil, tempfile, unittest
+from unittest import mock
+
+SVG = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="200" height="100" viewBox="0 0 200 100">
+  <defs><linearGradient id="grad"><stop offset="0" /></linearGradient></defs>
+  <g inkscape:groupmode="layer" id="layer1" style="display:inline">
+    <rect id="r1" fill="red" width="10" height="10" />
+    <g inkscape:groupmode="layer" id="layer2" style="display:inline">
+      <text>text</text>
+    </g>
+  </g>
+  <g inkscape:groupmode="layer" id="layer3" style="display:none" />
+  <g inkscape:groupmode="layer" id="layer4" style="display:inline">
+    <circle r="5" fill="url(#grad)" />
+  </g>
+</svg>
+"""
+
+class SummaryTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+        self._svg_file = os.path.join(self._tmp_dir,"demo.svg")
+        f = open(self._svg_file,"w",encoding="utf-8")
+        f.write(SVG)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_summary_lazy_load(self):
+
+        ink = InkscapeSVG(self._svg_file)
+        lazy = InkscapeSVG(self._svg_file,summary=ink.summary)
+
+        # Layers and hashes come from the summary without reading the file
+        self.assertFalse(lazy._loaded)
+        self.assertEqual(lazy.layers,ink.layers)
+        self.assertEqual(lazy.page_size,ink.page_size)
+        self.assertEqual(lazy.page_aspect,ink.page_aspect)
+        self.assertEqual(lazy.get_layer_ancestors(1),[0])
+        for config in ["1111","1010","0001"]:
+            self.assertEqual(lazy.get_config_hash(config,"png"),
+                             ink.get_config_hash(config,"png"))
+        self.assertFalse(lazy._loaded)
+
+        # The file is read once something needs its content
+        self.assertEqual(lazy._build_svg([True,False,False,True]),
+                         ink._build_svg([True,False,False,True]))
+        self.assertTrue(lazy._loaded)
+        self.assertEqual(lazy.summary,ink.summary)
+
+    def test_summary_round_trip(self):
+
+        # Summaries are kept in the build manifest as json
+        summary = json.loads(json.dumps(InkscapeSVG(self._svg_file).summary))
+
+        lazy = InkscapeSVG(self._svg_file,summary=summary)
+        self.assertFalse(lazy._loaded)
+        self.assertEqual(lazy.page_size,(200.0,100.0))
+        self.assertEqual(json.loads(json.dumps(lazy.summary)),summary)
+
+    def test_old_summary_version(self):
+
+        summary = InkscapeSVG(self._svg_file).summary
+        summary["version"] -= 1
+
+        ink = InkscapeSVG(self._svg_file,summary=summary)
+        self.assertTrue(ink._loaded)
+
+    def test_build_without_parsing(self):
+
+        cwd = os.getcwd()
+        xdg = os.environ.get("XDG_CACHE_HOME",None)
+        os.chdir(self._tmp_dir)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self._tmp_dir,"cache")
+
+        try:
+
+            config = {"processors":{"InkscapeProcessor":{"target_dir":"media",
+                                                         "img_format":"svg",
+                                                         "backend":"native",
+                                                         "pool_size":0,
+                                                         "render_cache":False}}}
+            f = open("config.json","w")
+            json.dump(config,f)
+            f.close()
+
+            f = open("deck.md","w")
+            f.write("![sm.inkscape](demo.svg) 1001,1101\n")
+            f.close()
+
+            sm = SlideMachine("deck.md",json_file="config.json")
+            sm.process("index.html")
+            media = sorted(os.listdir("media"))
+
+            # A new slide (so the slide cache cannot be used) with nothing new
+            # to render.  The next build never reads the svg.
+            f = open("deck.md","w")
+            f.write("new text\n\n![sm.inkscape](demo.svg) 1101\n")
+            f.close()
+
+            seen = []
+            load = InkscapeSVG._load
+            def record(ink):
+                seen.append(ink)
+                load(ink)
+
+            with mock.patch.object(InkscapeSVG,"_load",record):
+                sm = SlideMachine("deck.md",json_file="config.json",force=True)
+                sm.process("index.html")
+
+            self.assertEqual(seen,[])
+            self.assertIn("new text",open("index.html").read())
+            self.assertTrue(set(os.listdir("media")).issubset(set(media)))
+
+        finally:
+            os.chdir(cwd)
+            if xdg is None:
+                os.environ.pop("XDG_CACHE_HOME")
+            else:
+                os.environ["XDG_CACHE_HOME"] = xdg
+
+if __name__ == "__main__":
+    unittest.main()
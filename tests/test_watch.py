@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for incremental rebuilds in watch mode.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.slidemachine import SlideMachine
+
+import os, re, json, shutil, tempfile, unittest
+
+DECK = """# title
+
+plain text
+
+>>>
+
+![sm.image](a.png)
+
+>>>
+
+![sm.image](b.png)
+"""
+
+class WatchTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+        self._cwd = os.getcwd()
+        os.chdir(self._tmp_dir)
+
+        # Keep stale renders out of the user's cache
+        self._xdg = os.environ.get("XDG_CACHE_HOME",None)
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self._tmp_dir,"cache")
+
+        self._write("a.png",b"image a")
+        self._write("b.png",b"image b")
+        self._write("deck.md",DECK.encode())
+
+        config = {"processors":{"ImageProcessor":{"target_dir":"media",
+                                                  "pattern":r"!\[sm.image\]"}}}
+        self._write("config.json",json.dumps(config).encode())
+
+    def tearDown(self):
+
+        os.chdir(self._cwd)
+        if self._xdg is None:
+            os.environ.pop("XDG_CACHE_HOME")
+        else:
+            os.environ["XDG_CACHE_HOME"] = self._xdg
+
+        shutil.rmtree(self._tmp_dir)
+
+    def _write(self,file_name,data):
+
+        f = open(file_name,"wb")
+        f.write(data)
+        f.close()
+
+    def _build(self):
+        """
+        Build the deck, recording every line the image processor sees.
+        """
+
+        sm = SlideMachine("deck.md",json_file="config.json",force=True)
+
+        seen = []
+        processor = sm._processors[0]
+        process = processor.process
+        def record(line):
+            seen.append(line)
+            return process(line)
+        processor.process = record
+
+        sm.process("index.html")
+
+        return sm, seen
+
+    def _get_images(self):
+        """
+        Contents of every image in index.html, in order.
+        """
+
+        html = open("index.html").read()
+
+        return [open(f,"rb").read() for f in re.findall(r'src="([^"]*)"',html)]
+
+    def test_update_changed_input(self):
+
+        sm, seen = self._build()
+        self.assertEqual(len(seen),2)
+
+        # Only the slide that uses b.png goes through the processor again
+        self._write("b.png",b"image b, edited")
+        del seen[:]
+        sm.update("index.html",changed_files=["b.png"])
+
+        self.assertEqual(seen,["![sm.image](b.png)\n"])
+        self.assertEqual(self._get_images(),[b"image a",b"image b, edited"])
+
+    def test_update_changed_markdown(self):
+
+        sm, seen = self._build()
+
+        # Slides with the same markdown are reused; only the new one is
+        # processed
+        self._write("deck.md",(DECK + ">>>\n\n![sm.image](b.png) width=\"50%\"\n").encode())
+        del seen[:]
+        sm.update("index.html",changed_files=["deck.md"])
+
+        self.assertEqual(seen,["![sm.image](b.png) width=\"50%\"\n"])
+        self.assertEqual(self._get_images(),[b"image a",b"image b",b"image b"])
+
+    def test_file_stamps(self):
+
+        sm, seen = self._build()
+
+        stamps = sm._get_file_stamps()
+        for f in ["deck.md","config.json","a.png","b.png"]:
+            self.assertIn(os.path.abspath(f),stamps)
+
+        # A missing input is watched for, not an error
+        os.remove("a.png")
+        self.assertIsNone(sm._get_file_stamps()[os.path.abspath("a.png")])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+__description__ = \
+"""
+Tests for writing renders held in memory into the target directory.
+"""
+__author__ = "Michael J. Harms"
+__date__ = "2026-10-17"
+
+from slidemachine.processors.base import Processor
+from slidemachine.processors.hashes import get_data_hash
+
+import os, shutil, tempfile, unittest
+
+class WriteDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp(prefix="slidemachine_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_write_data(self):
+
+        p = Processor(self._tmp_dir)
+
+        first = p._write_data(b"render one","somewhere/figure.png")
+        self.assertEqual(first,os.path.join(self._tmp_dir,"figure.png"))
+        self.assertEqual(open(first,"rb").read(),b"render one")
+
+        # Same content is only written once, whatever it is called
+        self.assertEqual(p._write_data(b"render one","other.png"),first)
+        self.assertEqual(os.listdir(self._tmp_dir),["figure.png"])
+
+        # Different content with the same name gets a new name
+        second = p._write_data(b"render two","figure.png")
+        self.assertEqual(second,os.path.join(self._tmp_dir,"00000_figure.png"))
+        self.assertEqual(open(second,"rb").read(),b"render two")
+
+        self.assertEqual(p.output_files,[first,first,second])
+
+    def test_reuse_previous_build(self):
+
+        p = Processor(self._tmp_dir)
+        first = p._write_data(b"render one","figure.png")
+        mtime = os.stat(first).st_mtime_ns
+
+        # The next build finds the file it wrote last time and leaves it be
+        p = Processor(self._tmp_dir)
+        p.add_previous_build_information({},{get_data_hash(b"render one"):first})
+
+        self.assertEqual(p._write_data(b"render one","renamed.png"),first)
+        self.assertEqual(os.listdir(self._tmp_dir),["figure.png"])
+        self.assertEqual(os.stat(first).st_mtime_ns,mtime)
+
+        # ... unless it changed since
+        f = open(first,"wb")
+        f.write(b"edited")
+        f.close()
+
+        p = Processor(self._tmp_dir)
+        p.add_previous_build_information({},{get_data_hash(b"render one"):first})
+
+        out = p._write_data(b"render one","figure.png")
+        self.assertNotEqual(out,first)
+        self.assertEqual(open(out,"rb").read(),b"render one")
+
+if __name__ == "__main__":
+    unittest.main()